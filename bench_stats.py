@@ -0,0 +1,142 @@
+# -------------- bench_stats.py: подсчёт статистики (Python / NumPy), память каптов, задержка event loop --------------
+# Запуск: python bench_stats.py [строк]   (по умолчанию 100000 строк капт-игрок)
+import asyncio, gc, json, os, random, sys, tempfile, time, tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import bot, botcore
+from botcore import codec, np, CaptColumns, RollingStats
+
+PLAYERS_PER_CAPT = 10
+
+def make_capts(rows: int) -> list:
+    """Случайные капты за последние 90 дней: rows строк капт-игрок"""
+    random.seed(1)
+    base = datetime.now(timezone.utc)
+    capts = []
+    for i in range(rows // PLAYERS_PER_CAPT):
+        uids = [random.randint(1, 500) for _ in range(PLAYERS_PER_CAPT)]
+        capts.append({
+            "vs": f"Семья {i % 50}",
+            "date": (base - timedelta(days=random.uniform(0, 90))).isoformat(),
+            "win": random.random() < 0.5,
+            "players": [
+                {
+                    "user_id": uid,
+                    "user_name": f"Игрок {uid}",
+                    "damage": random.randint(0, 8000),
+                    "kills": random.randint(0, 10)
+                }
+                for uid in uids
+            ]
+        })
+    return capts
+
+def best_of(func, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def held_memory(build) -> float:
+    """Сколько памяти (МБ) удерживает результат build()"""
+    gc.collect()
+    tracemalloc.start()
+    value = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del value
+    return size / 1024 / 1024
+
+def report_memory(capts: list):
+    """Память истории после загрузки с диска: словари против записей на слотах"""
+    raw = json.dumps(capts, ensure_ascii=False)
+    as_dicts = held_memory(lambda: json.loads(raw))
+    as_records = held_memory(lambda: botcore.capts_from_json(json.loads(raw)))
+    print(f"Память {len(capts):,} каптов: словари {as_dicts:.1f} МБ, записи {as_records:.1f} МБ "
+          f"({(1 - as_records / as_dicts) * 100:.0f}% меньше)")
+
+async def max_loop_lag(store: "botcore.DataStore", cached: bool) -> float:
+    """Максимальная задержка event loop (мс), пока пишется capts.json.
+    cached=False - как раньше: вся история кодируется и пишется в loop;
+    cached=True - изменился один капт: в loop - только он, склейка и запись - в потоке store-io"""
+    monitor = botcore.LoopLagMonitor(0.001)
+    running = True
+
+    async def ticker():
+        while running:
+            monitor.tick()
+            await asyncio.sleep(monitor.interval)
+
+    store.pieces["capts"].clear()
+    if cached:
+        store.mark_dirty("capts")
+        store.flush(wait=True)  # первая запись собирает кэш записей (как после запуска бота)
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.05)
+    monitor.max = 0.0
+    if cached:
+        capt = store.data["capts"][-1]
+        capt["win"] = not capt["win"]
+        store.mark_dirty("capts", capt["id"])
+        store.flush()
+    else:
+        botcore.write_atomic(store.files["capts"][0], codec.dumps(store.data["capts"]))
+    # Дождаться фоновой записи: поток store-io выполняет задачи по очереди
+    await asyncio.get_running_loop().run_in_executor(store.io, lambda: None)
+    await asyncio.sleep(0.05)
+    running = False
+    await task
+    return monitor.max * 1000
+
+def report_loop_lag(capts: list):
+    """Запись истории целиком в event loop (как раньше) против записи из кэша записей в потоке store-io"""
+    with tempfile.TemporaryDirectory() as tmp:
+        store = botcore.DataStore({"capts": (os.path.join(tmp, "capts.json"), list, botcore.capts_from_json)})
+        store.data["capts"] = botcore.capts_from_json(capts)
+        botcore.CaptIdIndex(lambda: store.data["capts"]).rebuild(store.data["capts"])
+        blocking = asyncio.run(max_loop_lag(store, cached=False))
+        offloaded = asyncio.run(max_loop_lag(store, cached=True))
+        store.io.shutdown()
+    print(f"Задержка event loop при записи {len(capts):,} каптов ({codec.name}): всё в loop {blocking:.1f} мс, "
+          f"кэш записей + поток store-io {offloaded:.1f} мс")
+
+def rebuild_windows(capts: list, columns: bool) -> list:
+    """Пересборка окон "всё время"/неделя/месяц, как rolling_reload в ботах"""
+    windows = [RollingStats(days) for days in (None, 7, 30)]
+    built = CaptColumns.build(capts) if columns else None
+    for window in windows:
+        window.rebuild(capts, built)
+    return windows
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    capts = make_capts(rows)
+    week = (datetime.now(timezone.utc) - timedelta(days=7)).timestamp()
+    week_capts = lambda: [c for c in capts if botcore.capt_ts(c["date"]) >= week]
+
+    print(f"Строк капт-игрок: {rows:,}, каптов: {len(capts):,}")
+    report_memory(capts)
+    report_loop_lag(capts)
+    print(f"Python, всё время:   {best_of(lambda: bot.calculate_stats(capts)):8.1f} мс")
+    print(f"Python, неделя:      {best_of(lambda: bot.calculate_stats(week_capts())):8.1f} мс")
+    records = botcore.capts_from_json(capts)
+    print(f"Python, пересборка окон: {best_of(lambda: rebuild_windows(records, False), 3):5.1f} мс")
+
+    if np is None:
+        print("NumPy не установлен - колоночный подсчёт недоступен")
+        sys.exit(0)
+
+    columns = CaptColumns(capts)
+    assert columns.stats() == bot.calculate_stats(capts)
+    assert columns.stats(week) == bot.calculate_stats(week_capts())
+    print(f"NumPy, сборка колонок: {best_of(lambda: CaptColumns(capts)):6.1f} мс (один раз после изменения)")
+    print(f"NumPy, всё время:   {best_of(lambda: columns.stats()):8.1f} мс")
+    print(f"NumPy, неделя:      {best_of(lambda: columns.stats(week)):8.1f} мс")
+
+    by_python, by_numpy = rebuild_windows(records, False), rebuild_windows(records, True)
+    for a, b in zip(by_python, by_numpy):
+        assert a.stats == b.stats and a.wins == b.wins and a.members == b.members
+        assert [(ts, id(c)) for ts, _, c in a.heap] == [(ts, id(c)) for ts, _, c in b.heap]
+    print(f"NumPy, пересборка окон: {best_of(lambda: rebuild_windows(records, True), 3):6.1f} мс (со сборкой колонок)")
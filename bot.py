@@ -1,9 +1,14 @@
 # -------------- bot.py (исправленная версия 3.1 - БЕЗ ОШИБОК) --------------
-import discord, json, os, asyncio, re, time, glob, shutil
+import discord, json, os, asyncio, hashlib, time
 from datetime import datetime, timedelta, timezone
 from discord.ext import tasks
 from discord import app_commands
 from discord.ui import Button, View
+from botcore import (
+    Capt, PlayerEntry, capts_from_json, codec, DataStore, JournalStore, SqliteStore, StoreWriter,
+    OutboundQueue, CaptDateIndex, CaptIdIndex, CaptTally, build_leaderboards, CaptColumns, RollingStats,
+    resolve_members, MemberNameCache, RefreshScheduler, LoopLagMonitor
+)
 
 # ==================== НАСТРОЙКИ ====================
 TOKEN = os.getenv("TOKEN")
@@ -23,10 +28,16 @@ RAFFLE_CHANNEL_ID = 1454645262323810376
 EVERYONE_ROLE_ID = 1430087806952411230
 DEDUCT_ROLE_ID = 1430214760724430968
 
+# Сколько запросов fetch_member выполнять одновременно при массовой загрузке
+MEMBER_FETCH_CONCURRENCY = int(os.getenv("MEMBER_FETCH_CONCURRENCY", "5"))
+# Время жизни имени участника в кэше (сек)
+MEMBER_NAME_TTL = 3600
+
 # DB файлы
 DB_RAFFLES = "raffle.json"
 DB_WEEKLY_CONFIG = "weekly_config.json"
 DB_MESSAGES = "messages.json"
+DB_BOT_STATE = "bot_state.json"
 
 intents = discord.Intents.default()
 intents.message_content = True
@@ -37,65 +48,108 @@ tree = app_commands.CommandTree(client)
 DB_STATS = "stats.json"
 DB_CAPTS = "capts.json"
 
+# Бэкенд хранения: "json" (файлы), "journal" (снапшот + журнал мутаций) или "sqlite" (DB_SQLITE, точечная запись изменений)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+DB_SQLITE = "bot.db"
+DB_SNAPSHOT = "snapshot.json"
+DB_JOURNAL = "journal.jsonl"
+# Период фонового сжатия журнала в снапшот (мин)
+JOURNAL_COMPACT_MINUTES = 10
+# Бэкенд journal: при сжатии переписывать и stats.json/capts.json (нужно, чтобы вернуться на бэкенд json)
+JOURNAL_MIRROR_FILES = os.getenv("JOURNAL_MIRROR_FILES", "0") == "1"
+
+# Задержка отложенной записи на диск (сек): изменения за это окно пишутся одним разом
+FLUSH_DELAY = 5
+# Окно группового коммита (сек): записи журнала и ожидания store.durable() за это окно - одна запись с fsync
+GROUP_COMMIT_DELAY = 0.05
+# Период замера задержки event loop (сек): насколько опаздывает таймер из-за блокирующей работы
+LOOP_LAG_INTERVAL = 1
+# Исходящие запросы к Discord: сколько фоновых запросов идёт одновременно, минимальный интервал
+# между запросами в один канал (сек; лимит Discord - 5 сообщений за 5 сек) и ёмкость очередей
+# по классам запросов (порядок классов - их приоритет)
+OUTBOUND_WORKERS = 2
+OUTBOUND_CHANNEL_INTERVAL = 1.0
+OUTBOUND_LIMITS = {"visible": 200, "tags": 100, "log": 100}
+
+# Период снятия устаревших каптов из недельных/месячных агрегатов (мин)
+ROLLING_EXPIRE_MINUTES = 15
+
+# Окно накопления запросов на обновление топов и списка каптов (сек)
+REFRESH_DEBOUNCE = 2
+
+# ==================== ХРАНИЛИЩЕ ====================
+# id каптов (нужны и хранилищу SQLite: игроки в базе привязаны к id капта)
+capt_ids = CaptIdIndex(lambda: load_capts())
+
+STORE_FILES = {
+    "stats": (DB_STATS, dict, None),
+    "capts": (DB_CAPTS, list, capts_from_json),
+    "raffles": (DB_RAFFLES, list, None),
+    "weekly_config": (DB_WEEKLY_CONFIG, dict, None),
+    "messages": (DB_MESSAGES, dict, None),
+    "bot_state": (DB_BOT_STATE, dict, None),
+}
+STORE_OPTIONS = {"flush_delay": FLUSH_DELAY, "group_commit_delay": GROUP_COMMIT_DELAY}
+if STORAGE_BACKEND == "sqlite":
+    store = SqliteStore(STORE_FILES, DB_SQLITE, capt_ids, **STORE_OPTIONS)
+elif STORAGE_BACKEND == "journal":
+    store = JournalStore(STORE_FILES, DB_SNAPSHOT, DB_JOURNAL, JOURNAL_MIRROR_FILES, **STORE_OPTIONS)
+else:
+    store = DataStore(STORE_FILES, **STORE_OPTIONS)
+
+# ==================== ИСХОДЯЩИЕ ЗАПРОСЫ ====================
+outbound = OutboundQueue(OUTBOUND_WORKERS, OUTBOUND_CHANNEL_INTERVAL, OUTBOUND_LIMITS)
+
 # ==================== УТИЛИТЫ ====================
 def now():
     """Получить текущее время UTC"""
     return datetime.now(timezone.utc)
 
 def load_stats() -> dict:
-    try:
-        with open(DB_STATS, "r", encoding="utf-8") as f:
-            return json.load(f) or {}
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+    return store.get("stats")
 
-def save_stats(data: dict):
-    with open(DB_STATS, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def save_stats(data: dict, *uids):
+    """uids - чьи записи изменились; без них рейтинги пересобираются (и файл пишется) целиком"""
+    store.set("stats", data, *map(str, uids))
+    if uids:
+        leaderboards_touch(*uids)
+    else:
+        leaderboards_reload()
 
 def load_capts() -> list:
-    try:
-        with open(DB_CAPTS, "r", encoding="utf-8") as f:
-            return json.load(f) or []
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
+    return store.get("capts")
 
 def save_capts(data: list):
-    with open(DB_CAPTS, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    data = capts_from_json(data)
+    store.set("capts", data)
+    capt_ids.rebuild(data)
+    capt_tally.rebuild(data)
+    capt_dates.rebuild(data)
+    rolling_reload()
 
 def load_raffles() -> list:
-    try:
-        with open(DB_RAFFLES, "r", encoding="utf-8") as f:
-            return json.load(f) or []
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
+    return store.get("raffles")
 
 def save_raffles(data: list):
-    with open(DB_RAFFLES, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+    store.set("raffles", data)
 
 def load_weekly_config() -> dict:
-    try:
-        with open(DB_WEEKLY_CONFIG, "r", encoding="utf-8") as f:
-            return json.load(f) or {}
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+    return store.get("weekly_config")
 
 def save_weekly_config(cfg: dict):
-    with open(DB_WEEKLY_CONFIG, "w", encoding="utf-8") as f:
-        json.dump(cfg, f, ensure_ascii=False, indent=2, default=str)
+    store.set("weekly_config", cfg)
 
 def load_message_map() -> dict:
-    try:
-        with open(DB_MESSAGES, "r", encoding="utf-8") as f:
-            return json.load(f) or {}
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+    return store.get("messages")
 
 def save_message_map(m: dict):
-    with open(DB_MESSAGES, "w", encoding="utf-8") as f:
-        json.dump(m, f, ensure_ascii=False, indent=2)
+    store.set("messages", m)
+
+def load_bot_state() -> dict:
+    return store.get("bot_state")
+
+def save_bot_state(state: dict):
+    store.set("bot_state", state)
 
 def has_role(member: discord.Member, roles):
     return any(r.name in roles for r in member.roles)
@@ -112,14 +166,15 @@ def progress_bar(percent: int, length: int = 10):
 def medal(pos: int) -> str:
     return {1: "🥇", 2: "🥈", 3: "🥉"}.get(pos, "")
 
+capt_dates = CaptDateIndex()
+
+capt_tally = CaptTally()
+
 def get_capts_in_period(days: int = None):
-    """Получить капты за период"""
-    capts = load_capts()
+    """Получить капты за период: без периода - все в порядке добавления, иначе по индексу дат"""
     if days is None:
-        return capts
-    
-    cutoff = now() - timedelta(days=days)
-    return [c for c in capts if datetime.fromisoformat(c["date"]).replace(tzinfo=timezone.utc) >= cutoff]
+        return load_capts()
+    return capt_dates.since(period_cutoff(days))
 
 def calculate_stats(capts_list: list) -> dict:
     """Рассчитать статистику из списка каптов"""
@@ -151,7 +206,7 @@ async def log_action(guild: discord.Guild, user: discord.Member, action: str, de
     embed.set_author(name=user.display_name, icon_url=user.display_avatar.url)
     
     try:
-        await channel.send(embed=embed)
+        outbound.post("log", channel.id, lambda: channel.send(embed=embed))
     except:
         pass
 
@@ -168,63 +223,347 @@ def calculate_stats(capts_list: list) -> dict:
             stats[uid]["games"] += 1
     return stats
 
+PERIOD_DAYS = {"week": 7, "month": 30}
+
+def period_cutoff(days: int = None):
+    return None if days is None else (now() - timedelta(days=days)).timestamp()
+
+def get_period_stats(days: int = None) -> dict:
+    """Статистика игроков за период: вся история и неделя/месяц - из скользящих агрегатов,
+    остальное - по индексу дат"""
+    if days in rolling:
+        rolling[days].expire()
+        return rolling[days].stats
+    return calculate_stats(get_capts_in_period(days))
+
+def get_capts_summary(days: int = None) -> tuple:
+    """Количество каптов и побед за период: вся история и неделя/месяц - из счётчиков"""
+    if days is None:
+        return capt_tally.total, capt_tally.wins
+    if days in rolling:
+        rolling[days].expire()
+        return len(rolling[days].members), rolling[days].wins
+    capts = get_capts_in_period(days)
+    return len(capts), sum(1 for c in capts if c["win"])
+
+def get_capts_page(days: int, offset: int, limit: int) -> list:
+    """Страница каптов за период, от новых к старым. Берётся срезом с конца истории
+    (или индекса дат для периода) - стоимость зависит от размера страницы, а не истории"""
+    if days is not None:
+        return capt_dates.newest(period_cutoff(days), offset, limit)
+    capts = load_capts()
+    end = max(0, len(capts) - offset)
+    return capts[max(0, end - limit):end][::-1]
+
+# Рейтинги за всё время: обновляются мутациями статистики, пересобираются при загрузке
+leaderboards = build_leaderboards({})
+
+def leaderboards_touch(*uids):
+    for board in leaderboards.values():
+        for uid in uids:
+            board.update(str(uid))
+
+def leaderboards_reload():
+    for board in leaderboards.values():
+        board.rebuild(load_stats())
+
+def get_leaderboards(days: int = None) -> dict:
+    """Рейтинги по каптам за период: за всё время и за неделю/месяц - готовые, иначе по выборке.
+    Посты с топами строятся по stats.json (leaderboards), команды - по истории каптов"""
+    if days in rolling:
+        rolling[days].expire()
+        return rolling[days].boards
+    return build_leaderboards(get_period_stats(days))
+
+# Окна "За всё время" (None) / "За неделю" / "За месяц": дни -> агрегаты по каптам
+rolling = {days: RollingStats(days) for days in (None, *PERIOD_DAYS.values())}
+
+def rolling_add(capt: dict):
+    for window in rolling.values():
+        window.add(capt)
+
+def rolling_remove(capt: dict):
+    for window in rolling.values():
+        window.remove(capt)
+
+def rolling_reload():
+    """Пересобрать окна по всей истории; с NumPy колонки строятся один раз на все окна"""
+    capts = load_capts()
+    columns = CaptColumns.build(capts)
+    for window in rolling.values():
+        window.rebuild(capts, columns)
+
+member_names = MemberNameCache(MEMBER_NAME_TTL)
+
+# ==================== МУТАЦИИ ====================
+# Все изменения каптов и статистики проходят через store.commit(op, ...):
+# так их можно писать в журнал и доигрывать при запуске.
+# Обработчики команд не вызывают commit сами, а ставят мутацию в очередь store_writer.
+def capt_id_by_number(номер: int):
+    """Номер капта, который видит пользователь (1 = последний) -> id капта или None.
+    Номер переводится в id один раз, дальше капт ищется только по id"""
+    capts = load_capts()
+    if номер < 1 or номер > len(capts):
+        return None
+    return capts[-номер]["id"]
+
+def stats_add_player(st: dict, player: dict):
+    uid = str(player["user_id"])
+    if uid not in st:
+        st[uid] = {"damage": 0, "kills": 0, "games": 0}
+    st[uid]["damage"] += player["damage"]
+    st[uid]["kills"] += player["kills"]
+    st[uid]["games"] += 1
+    store.touch("stats", uid)
+    leaderboards_touch(uid)
+
+def stats_remove_player(st: dict, player: dict):
+    uid = str(player["user_id"])
+    if uid in st:
+        st[uid]["damage"] -= player["damage"]
+        st[uid]["kills"] -= player["kills"]
+        st[uid]["games"] -= 1
+        if st[uid]["games"] <= 0:
+            del st[uid]
+        store.touch("stats", uid)
+        leaderboards_touch(uid)
+
+@store.mutation("capt_created", "capts", "stats")
+def m_capt_created(capt: dict):
+    if not capt.get("id"):
+        # id пишем в аргументы: журнал сохранит его, и доигрывание даст тот же id
+        capt["id"] = capt_ids.new_id()
+    capt = Capt.from_dict(capt)
+    load_capts().append(capt)
+    store.touch("capts", capt["id"])
+    capt_ids.add(capt)
+    capt_tally.add(capt)
+    capt_dates.add(capt)
+    rolling_add(capt)
+    st = load_stats()
+    for player in capt["players"]:
+        stats_add_player(st, player)
+    return capt
+
+@store.mutation("player_added", "capts", "stats")
+def m_player_added(idx: int, player: dict):
+    """None - игрок уже в капте: проверка здесь, в очереди писателя, без гонок"""
+    player = PlayerEntry.from_dict(player)
+    capt = load_capts()[idx]
+    if capt.player(player["user_id"]):
+        return None
+    rolling_remove(capt)
+    capt.add_players([player])
+    rolling_add(capt)
+    store.touch("capts", capt["id"])
+    stats_add_player(load_stats(), player)
+    return player
+
+@store.mutation("players_added", "capts", "stats")
+def m_players_added(idx: int, players: list):
+    """Возвращает реально добавленных: уже бывшие в капте и повторы пропускаются"""
+    capt = load_capts()[idx]
+    added = {}
+    for p in players:
+        player = PlayerEntry.from_dict(p)
+        if player["user_id"] not in added and not capt.player(player["user_id"]):
+            added[player["user_id"]] = player
+    players = list(added.values())
+    if not players:
+        return players
+    rolling_remove(capt)
+    capt.add_players(players)
+    rolling_add(capt)
+    store.touch("capts", capt["id"])
+    st = load_stats()
+    for player in players:
+        stats_add_player(st, player)
+    return players
+
+@store.mutation("capt_deleted", "capts", "stats")
+def m_capt_deleted(idx: int):
+    removed = load_capts().pop(idx)
+    store.touch("capts", removed["id"])
+    capt_ids.remove(removed)
+    capt_tally.remove(removed)
+    capt_dates.remove(removed)
+    rolling_remove(removed)
+    st = load_stats()
+    for player in removed["players"]:
+        stats_remove_player(st, player)
+    return removed
+
+@store.mutation("stats_reset", "capts", "stats")
+def m_stats_reset():
+    store.data["stats"] = {}
+    store.data["capts"] = []
+    store.touch("stats")
+    store.touch("capts")
+    leaderboards_reload()
+    capt_ids.rebuild([])
+    capt_tally.rebuild([])
+    capt_dates.rebuild([])
+    rolling_reload()
+
+@store.mutation("capt_edited", "capts")
+def m_capt_edited(idx: int, **fields):
+    capt = load_capts()[idx]
+    # Окна недели/месяца считают и дату, и победы - при их смене капт переставляется
+    moved = "date" in fields or "win" in fields
+    if "date" in fields:
+        capt_dates.remove(capt)
+    if moved:
+        rolling_remove(capt)
+    capt_tally.remove(capt)
+    capt.update(fields)
+    capt_tally.add(capt)
+    store.touch("capts", capt["id"])
+    if "date" in fields:
+        capt_dates.add(capt)
+    if moved:
+        rolling_add(capt)
+    return capt
+
+@store.mutation("player_edited", "capts", "stats")
+def m_player_edited(idx: int, user_id: str, damage: int, kills: int):
+    capt = load_capts()[idx]
+    player = capt.player(user_id)
+    if not player:
+        return None
+    old_d = int(player.get("damage", 0))
+    old_k = int(player.get("kills", 0))
+    rolling_remove(capt)
+    capt.edit_player(player, damage, kills)
+    rolling_add(capt)
+    store.touch("capts", capt["id"])
+    st = load_stats()
+    if user_id in st:
+        st[user_id]["damage"] = max(0, st[user_id].get("damage", 0) - old_d + damage)
+        st[user_id]["kills"] = max(0, st[user_id].get("kills", 0) - old_k + kills)
+    else:
+        st[user_id] = {"damage": damage, "kills": kills, "games": 1, "points": 0.0}
+    store.touch("stats", user_id)
+    leaderboards_touch(user_id)
+    return player
+
+@store.mutation("points_adjusted", "stats")
+def m_points_adjusted(user_id: str, delta: float):
+    st = load_stats()
+    if user_id not in st:
+        st[user_id] = {"damage": 0, "kills": 0, "games": 0, "points": 0.0}
+    st[user_id]["points"] = max(0.0, round(st[user_id].get("points", 0.0) + delta, 3))
+    store.touch("stats", user_id)
+    return st[user_id]["points"]
+
+@store.mutation("member_stats_set", "stats")
+def m_member_stats_set(user_id: str, damage: int, kills: int, games: int):
+    load_stats()[user_id] = {"damage": damage, "kills": kills, "games": games, "points": 0.0}
+    store.touch("stats", user_id)
+    leaderboards_touch(user_id)
+
+@store.mutation("member_removed", "stats")
+def m_member_removed(user_id: str):
+    removed = load_stats().pop(user_id, None)
+    if removed is not None:
+        store.touch("stats", user_id)
+        leaderboards_touch(user_id)
+    return removed
+
+store_writer = StoreWriter(store, capt_ids)
+
 # ==================== VIEW ДЛЯ СПИСКА КАПТОВ ====================
 class CaptsListView(View):
-    def __init__(self, guild: discord.Guild, period: str = "all"):
+    """Список каптов за период. На каждый период при запуске регистрируется один view
+    (get_capts_list_view), он обслуживает все сообщения со списком: период записан в custom_id
+    кнопок, страница - в подписи счётчика страниц самого сообщения. Поэтому после
+    перезапуска кнопки работают без правки опубликованных постов"""
+
+    def __init__(self, period: str = "all"):
         super().__init__(timeout=None)
-        self.guild = guild
         self.period = period
         self.current_page = 0
         self.capts_per_page = 10
+        self.days = PERIOD_DAYS.get(period)
+        self.token = None
+        self.shown = {}  # id сообщения -> версия данных, с которой оно отрисовано
+        for button in (self.previous_page, self.page_info, self.next_page, self.refresh):
+            button.custom_id = f"{button.custom_id}:{period}"
+        self.show(0)
+
+    def data_token(self) -> tuple:
+        """Версия данных списка: правки каптов меняют версию хранилища, сдвиг окна периода - сводку"""
+        return store.versions.get("capts", 0), get_capts_summary(self.days)
+
+    def update_data(self) -> tuple:
+        """Подтянуть сводку, если данные изменились. Возвращает версию данных"""
+        token = self.data_token()
+        if token != self.token:
+            self.token = token
+            self.total, self.wins = token[1]
+            self.total_pages = max(1, (self.total + self.capts_per_page - 1) // self.capts_per_page)
+        return token
+
+    def page_of(self, interaction: discord.Interaction) -> int:
+        """Страница, показанная в сообщении: по подписи счётчика ("3/5")"""
+        for row in interaction.message.components:
+            for child in getattr(row, "children", []):
+                if getattr(child, "custom_id", None) == self.page_info.custom_id:
+                    try:
+                        return int(child.label.split("/")[0]) - 1
+                    except (AttributeError, ValueError):
+                        return 0
+        return 0
+
+    def show(self, page: int):
+        """Перейти на страницу (в пределах текущих данных) и обновить кнопки"""
         self.update_data()
+        self.current_page = max(0, min(page, self.total_pages - 1))
+        self.update_buttons()
 
-    def update_data(self):
-        if self.period == "week":
-            self.capts = get_capts_in_period(7)
-        elif self.period == "month":
-            self.capts = get_capts_in_period(30)
-        else:
-            self.capts = load_capts()
-        
-        self.total_pages = max(1, (len(self.capts) + self.capts_per_page - 1) // self.capts_per_page)
-        if self.current_page >= self.total_pages:
-            self.current_page = max(0, self.total_pages - 1)
+    def remember(self, message_id: int):
+        """Запомнить версию данных, с которой отрисовано сообщение (хранятся последние 500)"""
+        self.shown.pop(message_id, None)
+        self.shown[message_id] = self.token
+        if len(self.shown) > 500:
+            self.shown.pop(next(iter(self.shown)))
 
     @discord.ui.button(label="⬅️", style=discord.ButtonStyle.secondary, custom_id="capts_prev")
     async def previous_page(self, interaction: discord.Interaction, button: Button):
-        if self.current_page > 0:
-            self.current_page -= 1
-            await self.update_message(interaction)
+        page = self.page_of(interaction)
+        if page > 0:
+            await self.update_message(interaction, page - 1)
         else:
             await interaction.response.defer()
 
-    @discord.ui.button(label="1/1", style=discord.ButtonStyle.primary, custom_id="capts_page")
+    @discord.ui.button(label="1/1", style=discord.ButtonStyle.primary, custom_id="capts_page", disabled=True)
     async def page_info(self, interaction: discord.Interaction, button: Button):
         await interaction.response.defer()
 
     @discord.ui.button(label="➡️", style=discord.ButtonStyle.secondary, custom_id="capts_next")
     async def next_page(self, interaction: discord.Interaction, button: Button):
-        if self.current_page < self.total_pages - 1:
-            self.current_page += 1
-            await self.update_message(interaction)
+        page = self.page_of(interaction)
+        self.update_data()
+        if page < self.total_pages - 1:
+            await self.update_message(interaction, page + 1)
         else:
             await interaction.response.defer()
 
     @discord.ui.button(label="🔄", style=discord.ButtonStyle.success, custom_id="capts_refresh")
     async def refresh(self, interaction: discord.Interaction, button: Button):
-        self.update_data()
-        await self.update_message(interaction)
+        if self.shown.get(interaction.message.id) == self.update_data():
+            await interaction.response.defer()
+            return
+        await self.update_message(interaction, self.page_of(interaction))
+
+    def update_buttons(self):
+        self.page_info.label = f"{self.current_page + 1}/{self.total_pages}"
+        self.previous_page.disabled = self.current_page == 0
+        self.next_page.disabled = self.current_page >= self.total_pages - 1
 
-    async def update_message(self, interaction: discord.Interaction):
+    async def update_message(self, interaction: discord.Interaction, page: int):
+        self.show(page)
         embed = await self.create_embed()
-        for child in self.children:
-            if isinstance(child, Button):
-                if child.custom_id == "capts_page":
-                    child.label = f"{self.current_page + 1}/{self.total_pages}"
-                elif child.custom_id == "capts_prev":
-                    child.disabled = self.current_page == 0
-                elif child.custom_id == "capts_next":
-                    child.disabled = self.current_page >= self.total_pages - 1
+        self.remember(interaction.message.id)
 
         try:
             await interaction.response.edit_message(embed=embed, view=self)
@@ -247,30 +586,28 @@ class CaptsListView(View):
             timestamp=now()
         )
 
-        if not self.capts:
+        if not self.total:
             embed.description = "📭 Нет каптов за этот период"
         else:
-            reversed_capts = list(reversed(self.capts))
             start = self.current_page * self.capts_per_page
-            end = min(start + self.capts_per_page, len(reversed_capts))
+            page = get_capts_page(self.days, start, self.capts_per_page)
 
             desc = ""
-            for i in range(start, end):
-                capt = reversed_capts[i]
-                num = len(self.capts) - i
+            for i, capt in enumerate(page, start):
+                num = self.total - i
                 date = datetime.fromisoformat(capt["date"]).strftime("%d.%m.%Y %H:%M")
                 result = "✅" if capt["win"] else "❌"
                 players = len(capt["players"])
-                damage = sum(p["damage"] for p in capt["players"])
-                kills = sum(p["kills"] for p in capt["players"])
+                damage = capt.total_damage
+                kills = capt.total_kills
 
                 desc += f"**#{num}. Семья vs {capt['vs']}** {result}\n"
                 desc += f"🕐 {date} │ 👥 {players} │ 💥 {damage:,} │ ☠️ {kills}\n\n"
 
             embed.description = desc
 
-            wins = sum(1 for c in self.capts if c["win"])
-            total = len(self.capts)
+            wins = self.wins
+            total = self.total
             winrate = (wins/total*100) if total > 0 else 0
 
             embed.add_field(
@@ -282,11 +619,26 @@ class CaptsListView(View):
         embed.set_footer(text=f"Страница {self.current_page+1}/{self.total_pages}")
         return embed
 
+capts_list_views = {}  # период -> зарегистрированный CaptsListView
+
+def get_capts_list_view(period: str) -> CaptsListView:
+    """View списка каптов за период: создаётся и регистрируется в клиенте один раз"""
+    view = capts_list_views.get(period)
+    if view is None:
+        view = capts_list_views[period] = CaptsListView(period)
+        client.add_view(view)
+    return view
+
 # ==================== VIEW ДЛЯ РОЗЫГРЫШЕЙ ====================
 class RaffleView(View):
+    """Кнопки розыгрыша. id розыгрыша записан в custom_id, view каждого розыгрыша
+    регистрируется при запуске (setup_hook) - кнопки работают и после перезапуска"""
+
     def __init__(self, raffle_id: str):
         super().__init__(timeout=None)
         self.raffle_id = raffle_id
+        for button in (self.join, self.leave, self.pick):
+            button.custom_id = f"{button.custom_id}:{raffle_id}"
 
     @discord.ui.button(label="Участвовать", style=discord.ButtonStyle.success, custom_id="raffle_join")
     async def join(self, interaction: discord.Interaction, button: Button):
@@ -365,11 +717,7 @@ class AdminPanelView(View):
         else:
             desc = ""
             for uid, data in sorted(st.items(), key=lambda x: x[1]["games"], reverse=True)[:20]:
-                try:
-                    member = await interaction.guild.fetch_member(int(uid))
-                    name = member.display_name
-                except:
-                    name = f"ID {uid}"
+                name = await member_names.resolve(interaction.guild, uid) or f"ID {uid}"
                 desc += f"**{name}** - {data['games']} игр, {data['damage']:,} урона\n"
             embed.description = desc
         await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -385,10 +733,10 @@ class AdminPanelView(View):
             kills = discord.ui.TextInput(label="Киллов", placeholder="0", default="0")
             async def on_submit(self, modal_interaction: discord.Interaction):
                 try:
-                    st = load_stats()
-                    uid = str(int(self.user_id.value))
-                    st[uid] = {"damage": int(self.damage.value), "kills": int(self.kills.value), "games": int(self.games.value), "points": 0.0}
-                    save_stats(st)
+                    await store_writer.submit(
+                        "member_stats_set", user_id=str(int(self.user_id.value)),
+                        damage=int(self.damage.value), kills=int(self.kills.value), games=int(self.games.value)
+                    )
                     await modal_interaction.response.send_message(f"✅ Участник добавлен", ephemeral=True)
                 except Exception as e:
                     await modal_interaction.response.send_message(f"❌ Ошибка: {str(e)}", ephemeral=True)
@@ -402,11 +750,8 @@ class AdminPanelView(View):
             user_id = discord.ui.TextInput(label="ID участника", placeholder="12345")
             async def on_submit(self, modal_interaction: discord.Interaction):
                 try:
-                    st = load_stats()
                     uid = str(int(self.user_id.value))
-                    if uid in st:
-                        del st[uid]
-                        save_stats(st)
+                    if await store_writer.submit("member_removed", user_id=uid) is not None:
                         await modal_interaction.response.send_message(f"✅ Участник удален", ephemeral=True)
                     else:
                         await modal_interaction.response.send_message(f"❌ Участник не найден", ephemeral=True)
@@ -425,25 +770,22 @@ class AdminPanelView(View):
             результат = discord.ui.TextInput(label="Результат (win/lose) (опционально)", required=False)
             async def on_submit(self, modal_interaction: discord.Interaction):
                 try:
-                    номер = int(self.номер.value)
-                    capts = load_capts()
-                    if номер < 1 or номер > len(capts):
+                    capt_id = capt_id_by_number(int(self.номер.value))
+                    if capt_id is None:
                         return await modal_interaction.response.send_message("❌ Капт не найден", ephemeral=True)
-                    capt = capts[-номер]
+                    fields = {}
                     if self.vs.value:
-                        capt['vs'] = self.vs.value
+                        fields['vs'] = self.vs.value
                     if self.дата.value:
                         try:
                             dt = datetime.strptime(self.дата.value, "%d.%m.%Y %H:%M")
-                            capt['date'] = dt.replace(tzinfo=MSK_TZ).isoformat()
+                            fields['date'] = dt.replace(tzinfo=MSK_TZ).isoformat()
                         except:
                             pass
                     if self.результат.value:
-                        capt['win'] = self.результат.value.strip().lower() in ['win','победа','в']
-                    save_capts(capts)
-                    asyncio.create_task(update_capts_list())
-                    asyncio.create_task(update_avg_top())
-                    asyncio.create_task(update_kills_top())
+                        fields['win'] = self.результат.value.strip().lower() in ['win','победа','в']
+                    await store_writer.submit("capt_edited", capt_id=capt_id, **fields)
+                    refresh.request("capts_list", "avg_top", "kills_top")
                     await modal_interaction.response.send_message("✅ Капт обновлён", ephemeral=True)
                 except Exception as e:
                     await modal_interaction.response.send_message(f"❌ Ошибка: {str(e)}", ephemeral=True)
@@ -464,27 +806,14 @@ class AdminPanelView(View):
                     uid = str(int(self.user_id.value))
                     new_damage = int(self.damage.value)
                     new_kills = int(self.kills.value)
-                    capts = load_capts()
-                    if номер < 1 or номер > len(capts):
+                    capt_id = capt_id_by_number(номер)
+                    if capt_id is None:
                         return await modal_interaction.response.send_message("❌ Капт не найден", ephemeral=True)
-                    capt = capts[-номер]
-                    player = next((p for p in capt.get('players', []) if str(p.get('user_id')) == uid), None)
-                    st = load_stats()
+                    player = await store_writer.submit(
+                        "player_edited", capt_id=capt_id, user_id=uid, damage=new_damage, kills=new_kills
+                    )
                     if player:
-                        old_d = int(player.get('damage',0))
-                        old_k = int(player.get('kills',0))
-                        player['damage'] = new_damage
-                        player['kills'] = new_kills
-                        if uid in st:
-                            st[uid]['damage'] = max(0, st[uid].get('damage',0) - old_d + new_damage)
-                            st[uid]['kills'] = max(0, st[uid].get('kills',0) - old_k + new_kills)
-                        else:
-                            st[uid] = {'damage': new_damage, 'kills': new_kills, 'games': 1, 'points': 0.0}
-                        save_stats(st)
-                        save_capts(capts)
-                        asyncio.create_task(update_capts_list())
-                        asyncio.create_task(update_avg_top())
-                        asyncio.create_task(update_kills_top())
+                        refresh.request("capts_list", "avg_top", "kills_top")
                         await modal_interaction.response.send_message("✅ Игрок обновлён", ephemeral=True)
                     else:
                         await modal_interaction.response.send_message("❌ Игрок не найден в капте", ephemeral=True)
@@ -501,14 +830,10 @@ class AdminPanelView(View):
             points = discord.ui.TextInput(label="Баллы (+/-)", placeholder="10")
             async def on_submit(self, modal_interaction: discord.Interaction):
                 try:
-                    st = load_stats()
                     uid = str(int(self.user_id.value))
-                    if uid not in st:
-                        st[uid] = {"damage": 0, "kills": 0, "games": 0, "points": 0.0}
                     delta = float(self.points.value)
-                    st[uid]["points"] = max(0.0, round(st[uid].get("points", 0.0) + delta, 3))
-                    save_stats(st)
-                    await modal_interaction.response.send_message(f"✅ Баллы обновлены: {st[uid]['points']}", ephemeral=True)
+                    points = await store_writer.submit("points_adjusted", user_id=uid, delta=delta)
+                    await modal_interaction.response.send_message(f"✅ Баллы обновлены: {points}", ephemeral=True)
                 except Exception as e:
                     await modal_interaction.response.send_message(f"❌ Ошибка: {str(e)}", ephemeral=True)
         await interaction.response.send_modal(PointsModal())
@@ -526,19 +851,11 @@ class AdminPanelView(View):
             top_kills = sorted(st.items(), key=lambda x: x[1]["kills"], reverse=True)[:5]
             desc = "**ТОП-5 ПО УРОНУ:**\n"
             for i, (uid, data) in enumerate(top_damage, 1):
-                try:
-                    member = await interaction.guild.fetch_member(int(uid))
-                    name = member.display_name
-                except:
-                    name = f"ID {uid}"
+                name = await member_names.resolve(interaction.guild, uid) or f"ID {uid}"
                 desc += f"{i}. {name} - {data['damage']:,}\n"
             desc += "\n**ТОП-5 ПО КИЛЛАМ:**\n"
             for i, (uid, data) in enumerate(top_kills, 1):
-                try:
-                    member = await interaction.guild.fetch_member(int(uid))
-                    name = member.display_name
-                except:
-                    name = f"ID {uid}"
+                name = await member_names.resolve(interaction.guild, uid) or f"ID {uid}"
                 desc += f"{i}. {name} - {data['kills']}\n"
             embed.description = desc
         await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -575,10 +892,15 @@ class AdminPanelView(View):
                     if not channel or not role:
                         await modal_interaction.response.send_message("❌ Канал или роль не найдены", ephemeral=True)
                         return
+                    text = f"{role.mention}\n{self.message.value if self.message.value else ''}"
+                    queued = 0
                     for _ in range(times):
-                        await channel.send(f"{role.mention}\n{self.message.value if self.message.value else ''}")
-                        await asyncio.sleep(2)
-                    await modal_interaction.response.send_message("✅ Теги отправлены", ephemeral=True)
+                        try:
+                            outbound.post("tags", channel.id, lambda: channel.send(text))
+                        except asyncio.QueueFull:
+                            break
+                        queued += 1
+                    await modal_interaction.response.send_message(f"✅ Тегов в очереди на отправку: {queued}", ephemeral=True)
                 except Exception as e:
                     await modal_interaction.response.send_message(f"❌ Ошибка: {str(e)}", ephemeral=True)
         await interaction.response.send_modal(TagModal())
@@ -588,7 +910,11 @@ class AdminPanelView(View):
         if not has_role(interaction.user, ADMIN_ROLES):
             return await interaction.response.send_message("Нет доступа", ephemeral=True)
         try:
-            synced = await tree.sync(guild=discord.Object(GUILD_ID))
+            synced = await sync_commands_if_changed()
+            if synced is None:
+                return await interaction.response.send_message(
+                    "Commands unchanged, sync skipped (force: /sync принудительно:True)", ephemeral=True
+                )
             await interaction.response.send_message(f"Синхronized {len(synced)} commands", ephemeral=True)
         except Exception as e:
             await interaction.response.send_message(f"Error: {str(e)}", ephemeral=True)
@@ -627,11 +953,11 @@ async def add_capt(inter: discord.Interaction, против: str, результ
         "players": []
     }
     
-    capts = load_capts()
-    capts.append(new_capt)
-    save_capts(capts)
+    await store_writer.submit("capt_created", capt=new_capt)
+    # Отвечаем, когда капт уже на диске
+    await store.durable("capts")
     
-    asyncio.create_task(update_capts_list())
+    refresh.request("capts_list")
     
     await log_action(
         inter.guild, inter.user,
@@ -691,37 +1017,25 @@ async def add_player(inter: discord.Interaction, игрок: str, урон: int,
     if not member:
         return await inter.response.send_message(f"Player not found: {mention_text}", ephemeral=True)
 
-    capts = load_capts()
-    if номер_капта < 1 or номер_капта > len(capts):
+    capt_id = capt_id_by_number(номер_капта)
+    if capt_id is None:
         return await inter.response.send_message("Capt not found", ephemeral=True)
 
-    capt = capts[-номер_капта]
-    
-    if any(p["user_id"] == user_id for p in capt["players"]):
+    # Дубль проверяет мутация: между проверкой здесь и записью игрока могли добавить
+    try:
+        added = await store_writer.submit("player_added", capt_id=capt_id, player={
+            "user_id": user_id,
+            "user_name": member.display_name,
+            "damage": урон,
+            "kills": киллы
+        })
+    except LookupError:
+        return await inter.response.send_message("❌ Капт не найден", ephemeral=True)
+    if added is None:
         return await inter.response.send_message(f"Already added: {member.display_name}", ephemeral=True)
-
-    capt["players"].append({
-        "user_id": user_id,
-        "user_name": member.display_name,
-        "damage": урон,
-        "kills": киллы
-    })
-
-    st = load_stats()
-    uid = str(user_id)
-    if uid not in st:
-        st[uid] = {"damage": 0, "kills": 0, "games": 0}
+    capt = capt_ids.get(capt_id)
     
-    st[uid]["damage"] += урон
-    st[uid]["kills"] += киллы
-    st[uid]["games"] += 1
-    
-    save_stats(st)
-    save_capts(capts)
-    
-    asyncio.create_task(update_capts_list())
-    asyncio.create_task(update_avg_top())
-    asyncio.create_task(update_kills_top())
+    refresh.request("capts_list", "avg_top", "kills_top")
     
     await log_action(
         inter.guild, inter.user,
@@ -752,18 +1066,19 @@ async def upload_players(inter: discord.Interaction, данные: str, номе
     
     try:
         capts = load_capts()
-        if номер_капта < 1 or номер_капта > len(capts):
+        capt_id = capt_id_by_number(номер_капта)
+        if capt_id is None:
             if defer_used:
                 await inter.followup.send("❌ Капт не найден", ephemeral=True)
             else:
                 await inter.response.send_message("❌ Капт не найден", ephemeral=True)
             return
         
-        capt = capts[-номер_капта]
         lines = данные.strip().split('\n')
-        added = 0
         errors = []
         
+        # 1. Разбираем и проверяем всю пачку целиком
+        parsed = []
         for line in lines:
             line = line.strip()
             if not line:
@@ -782,39 +1097,48 @@ async def upload_players(inter: discord.Interaction, данные: str, номе
                 errors.append(f"❌ Ошибка парсинга: {line}")
                 continue
             
-            try:
-                member = await inter.guild.fetch_member(user_id)
-            except:
+            parsed.append((user_id, damage, kills))
+        
+        # 2. Участников получаем параллельно
+        members, _ = await resolve_members(inter.guild, [user_id for user_id, _, _ in parsed], MEMBER_FETCH_CONCURRENCY)
+        
+        seen = set()  # повторы внутри пачки; уже бывших в капте отсеивает мутация
+        players = []
+        for user_id, damage, kills in parsed:
+            member = members.get(user_id)
+            if not member:
                 errors.append(f"❌ Игрок {user_id} не найден")
                 continue
             
-            if any(p["user_id"] == user_id for p in capt["players"]):
+            if user_id in seen:
                 errors.append(f"⚠️ {member.display_name} уже добавлен")
                 continue
+            seen.add(user_id)
             
-            capt["players"].append({
+            players.append({
                 "user_id": user_id,
                 "user_name": member.display_name,
                 "damage": damage,
                 "kills": kills
             })
-            
-            st = load_stats()
-            uid = str(user_id)
-            if uid not in st:
-                st[uid] = {"damage": 0, "kills": 0, "games": 0}
-            st[uid]["damage"] += damage
-            st[uid]["kills"] += kills
-            st[uid]["games"] += 1
-            save_stats(st)
-            
-            added += 1
         
-        save_capts(capts)
+        # 3. Все игроки - одной мутацией и одной записью
+        if players:
+            # Капт передаём по id: пока ждали участников, список мог измениться
+            try:
+                added_ids = {p["user_id"] for p in await store_writer.submit(
+                    "players_added", capt_id=capt_id, players=players)}
+            except LookupError:
+                players = []
+                errors.append("❌ Капт удалён во время загрузки")
+            else:
+                for p in players:
+                    if p["user_id"] not in added_ids:
+                        errors.append(f"⚠️ {p['user_name']} уже добавлен")
+                players = [p for p in players if p["user_id"] in added_ids]
+        added = len(players)
         
-        asyncio.create_task(update_capts_list())
-        asyncio.create_task(update_avg_top())
-        asyncio.create_task(update_kills_top())
+        refresh.request("capts_list", "avg_top", "kills_top")
         
         await log_action(
             inter.guild, inter.user,
@@ -855,13 +1179,12 @@ async def upload_capts(inter: discord.Interaction, данные: str):
         pass
     
     try:
-        capts = load_capts()
-        st = load_stats()
         lines = данные.strip().split('\n')
         
         added_capts = 0
         current_capt_info = None
         current_players = []
+        new_capts = []
         
         for line in lines:
             line = line.strip()
@@ -878,7 +1201,7 @@ async def upload_capts(inter: discord.Interaction, данные: str):
                         "win": current_capt_info["win"],
                         "players": current_players
                     }
-                    capts.append(new_capt)
+                    new_capts.append(new_capt)
                     added_capts += 1
                 
                 # Parse header
@@ -919,27 +1242,12 @@ async def upload_capts(inter: discord.Interaction, данные: str):
                     kills = int(parts[2].replace("k", "").replace("K", ""))
                     damage = int(parts[3].replace("dmg", "").replace("k", "000").replace("K", "000"))
                     
-                    # Get user name
-                    try:
-                        member = await inter.guild.fetch_member(user_id)
-                        user_name = member.display_name
-                    except:
-                        user_name = f"User {user_id}"
-                    
                     current_players.append({
                         "user_id": user_id,
-                        "user_name": user_name,
+                        "user_name": None,
                         "damage": damage,
                         "kills": kills
                     })
-                    
-                    # Update stats
-                    uid = str(user_id)
-                    if uid not in st:
-                        st[uid] = {"damage": 0, "kills": 0, "games": 0}
-                    st[uid]["damage"] += damage
-                    st[uid]["kills"] += kills
-                    st[uid]["games"] += 1
                 except Exception as e:
                     print(f"[ERROR] Player parse error: {e}")
                     continue
@@ -952,20 +1260,27 @@ async def upload_capts(inter: discord.Interaction, данные: str):
                 "win": current_capt_info["win"],
                 "players": current_players
             }
-            capts.append(new_capt)
+            new_capts.append(new_capt)
             added_capts += 1
         
-        save_capts(capts)
-        save_stats(st)
+        # Resolve names once per id: gateway cache first, the rest concurrently
+        members, lookup = await resolve_members(
+            inter.guild, [p["user_id"] for c in new_capts for p in c["players"]], MEMBER_FETCH_CONCURRENCY
+        )
+        for new_capt in new_capts:
+            for player in new_capt["players"]:
+                member = members.get(player["user_id"])
+                player["user_name"] = member.display_name if member else f"User {player['user_id']}"
+            await store_writer.submit("capt_created", capt=new_capt)
+        await store.durable("capts", "stats")
+        msg = f"Loaded: {added_capts} capts\nMembers: {lookup['cache']} from cache, {lookup['api']} via API"
         
-        asyncio.create_task(update_capts_list())
-        asyncio.create_task(update_avg_top())
-        asyncio.create_task(update_kills_top())
+        refresh.request("capts_list", "avg_top", "kills_top")
         
         try:
-            await inter.followup.send(f"Loaded: {added_capts} capts", ephemeral=True)
+            await inter.followup.send(msg, ephemeral=True)
         except:
-            await inter.response.send_message(f"Loaded: {added_capts} capts", ephemeral=True)
+            await inter.response.send_message(msg, ephemeral=True)
         
     except Exception as e:
         print(f"[ERROR] upload_capts: {e}")
@@ -980,28 +1295,18 @@ async def delete_capt(inter: discord.Interaction, номер: int):
     if not has_role(inter.user, ADMIN_ROLES):
         return await inter.response.send_message("❌ Нет доступа", ephemeral=True)
     
-    capts = load_capts()
-    if номер < 1 or номер > len(capts):
+    capt_id = capt_id_by_number(номер)
+    if capt_id is None:
         return await inter.response.send_message("❌ Капт не найден", ephemeral=True)
     
-    removed_capt = capts.pop(-номер)
+    try:
+        removed_capt = await store_writer.submit("capt_deleted", capt_id=capt_id)
+    except LookupError:
+        # Капт удалили между поиском номера и записью
+        return await inter.response.send_message("❌ Капт не найден", ephemeral=True)
+    await store.durable("capts", "stats")
     
-    st = load_stats()
-    for player in removed_capt["players"]:
-        uid = str(player["user_id"])
-        if uid in st:
-            st[uid]["damage"] -= player["damage"]
-            st[uid]["kills"] -= player["kills"]
-            st[uid]["games"] -= 1
-            if st[uid]["games"] <= 0:
-                del st[uid]
-    
-    save_stats(st)
-    save_capts(capts)
-    
-    asyncio.create_task(update_capts_list())
-    asyncio.create_task(update_avg_top())
-    asyncio.create_task(update_kills_top())
+    refresh.request("capts_list", "avg_top", "kills_top")
     
     await log_action(
         inter.guild, inter.user,
@@ -1034,19 +1339,15 @@ async def reset_stats(inter: discord.Interaction):
             stats = load_stats()
             
             try:
-                with open(f"backup_stats_{backup_time}.json", "w", encoding="utf-8") as f:
-                    json.dump(stats, f, ensure_ascii=False, indent=2)
-                with open(f"backup_capts_{backup_time}.json", "w", encoding="utf-8") as f:
-                    json.dump(capts, f, ensure_ascii=False, indent=2)
+                await asyncio.to_thread(codec.dump_file, stats, f"backup_stats_{backup_time}.json")
+                await asyncio.to_thread(codec.dump_file, capts, f"backup_capts_{backup_time}.json")
             except:
                 pass
             
-            save_stats({})
-            save_capts([])
+            await store_writer.submit("stats_reset")
+            await store.durable("capts", "stats")
             
-            asyncio.create_task(update_capts_list())
-            asyncio.create_task(update_avg_top())
-            asyncio.create_task(update_kills_top())
+            refresh.request("capts_list", "avg_top", "kills_top")
             
             await log_action(inter.guild, inter.user, "Сброс статистики", f"Удалено {len(capts)} каптов и {len(stats)} записей (бекап: backup_{backup_time})")
             
@@ -1080,7 +1381,8 @@ async def list_capts(inter: discord.Interaction, period: str = "all"):
         defer_used = False
     
     try:
-        view = CaptsListView(inter.guild, period)
+        view = get_capts_list_view(period)
+        view.show(0)
         embed = await view.create_embed()
         
         if defer_used:
@@ -1126,21 +1428,20 @@ async def restore_backup(inter: discord.Interaction, файл: str):
         return await inter.response.send_message("Нет доступа", ephemeral=True)
     
     try:
-        with open(файл, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = await asyncio.to_thread(codec.load_file, файл)
         
         if "backup_stats" in файл:
-            save_stats(data)
+            await store_writer.run(save_stats, data)
+            await store.durable("stats")
             await inter.response.send_message(f"✅ Статистика восстановлена из {файл}", ephemeral=True)
         elif "backup_capts" in файл:
-            save_capts(data)
+            await store_writer.run(save_capts, data)
+            await store.durable("capts")
             await inter.response.send_message(f"✅ Капты восстановлены из {файл}", ephemeral=True)
         else:
             await inter.response.send_message("❌ Неизвестный тип бекапа", ephemeral=True)
         
-        asyncio.create_task(update_capts_list())
-        asyncio.create_task(update_avg_top())
-        asyncio.create_task(update_kills_top())
+        refresh.request("capts_list", "avg_top", "kills_top")
         
     except FileNotFoundError:
         await inter.response.send_message(f"❌ Файл {файл} не найден", ephemeral=True)
@@ -1165,27 +1466,16 @@ async def top_avg(inter: discord.Interaction, period: str = "all"):
         defer_used = False
     
     try:
-        if period == "week":
-            capts = get_capts_in_period(7)
-            period_text = "за неделю"
-        elif period == "month":
-            capts = get_capts_in_period(30)
-            period_text = "за месяц"
-        else:
-            capts = load_capts()
-            period_text = "за всё время"
-        
-        st = calculate_stats(capts)
-        filtered = {uid: d for uid, d in st.items() if d["games"] >= 3}
+        period_text = {"week": "за неделю", "month": "за месяц"}.get(period, "за всё время")
+        boards = get_leaderboards(PERIOD_DAYS.get(period))
+        users = boards["avg"].top(10)
         
-        if not filtered:
+        if not users:
             if defer_used:
                 await inter.followup.send("📭 Нет игроков с 3+ играми", ephemeral=True)
             else:
                 await inter.response.send_message("📭 Нет игроков с 3+ играми", ephemeral=True)
             return
-
-        users = sorted(filtered.items(), key=lambda x: x[1]["damage"]/x[1]["games"], reverse=True)[:10]
         
         embed = discord.Embed(
             title=f"🏆 ТОП-10 СРЕДНЕГО УРОНА",
@@ -1196,11 +1486,7 @@ async def top_avg(inter: discord.Interaction, period: str = "all"):
         
         desc = ""
         for i, (uid, data) in enumerate(users, 1):
-            try:
-                member = await inter.guild.fetch_member(int(uid))
-                name = member.display_name
-            except:
-                name = f"Игрок {uid}"
+            name = await member_names.resolve(inter.guild, uid) or f"Игрок {uid}"
             
             avg = data["damage"] // data["games"]
             
@@ -1247,27 +1533,17 @@ async def top_kills(inter: discord.Interaction, period: str = "all"):
         defer_used = False
     
     try:
-        if period == "week":
-            capts = get_capts_in_period(7)
-            period_text = "за неделю"
-        elif period == "month":
-            capts = get_capts_in_period(30)
-            period_text = "за месяц"
-        else:
-            capts = load_capts()
-            period_text = "за всё время"
+        period_text = {"week": "за неделю", "month": "за месяц"}.get(period, "за всё время")
+        boards = get_leaderboards(PERIOD_DAYS.get(period))
+        users = boards["kills"].top(10)
         
-        st = calculate_stats(capts)
-        
-        if not st:
+        if not users:
             if defer_used:
                 await inter.followup.send("📭 Статистика пуста", ephemeral=True)
             else:
                 await inter.response.send_message("📭 Статистика пуста", ephemeral=True)
             return
 
-        users = sorted(st.items(), key=lambda x: x[1]["kills"], reverse=True)[:10]
-
         embed = discord.Embed(
             title=f"☠️ ТОП-10 ПО КИЛЛАМ",
             description=f"*Статистика {period_text}*",
@@ -1277,18 +1553,14 @@ async def top_kills(inter: discord.Interaction, period: str = "all"):
         
         desc = ""
         for i, (uid, data) in enumerate(users, 1):
-            try:
-                member = await inter.guild.fetch_member(int(uid))
-                name = member.display_name
-            except:
-                name = f"Игрок {uid}"
+            name = await member_names.resolve(inter.guild, uid) or f"Игрок {uid}"
             
             if i <= 3:
                 desc += f"{medal(i)} **{name}**\n"
             else:
                 desc += f"`{i}.` **{name}**\n"
             
-            desc += f"```Киллов:      {data['kills']}\nИгр:         {data['games']}\nСредний урон: {data['damage']//data['games']:,}```\n"
+            desc += f"```Киллов:      {data['kills']}\nИгр:         {data['games']}\nСредний урон: {data['damage']//data['games'] if data['games'] > 0 else 0:,}```\n"
         
         embed.description = f"*Статистика {period_text}*\n\n" + desc
         
@@ -1325,17 +1597,9 @@ async def my_stats(inter: discord.Interaction, period: str = "all"):
         defer_used = False
     
     try:
-        if period == "week":
-            capts = get_capts_in_period(7)
-            period_text = "за неделю"
-        elif period == "month":
-            capts = get_capts_in_period(30)
-            period_text = "за месяц"
-        else:
-            capts = load_capts()
-            period_text = "за всё время"
-        
-        st = calculate_stats(capts)
+        period_text = {"week": "за неделю", "month": "за месяц"}.get(period, "за всё время")
+        boards = get_leaderboards(PERIOD_DAYS.get(period))
+        st = boards["kills"].data
         uid = str(inter.user.id)
         
         if uid not in st:
@@ -1362,11 +1626,8 @@ async def my_stats(inter: discord.Interaction, period: str = "all"):
             inline=False
         )
         
-        avg_users = sorted(st.items(), key=lambda x: x[1]["damage"]/x[1]["games"] if x[1]["games"] >= 3 else 0, reverse=True)
-        kills_users = sorted(st.items(), key=lambda x: x[1]["kills"], reverse=True)
-        
-        avg_pos = next((i+1 for i, (u, _) in enumerate(avg_users) if u == uid and data["games"] >= 3), None)
-        kills_pos = next((i+1 for i, (u, _) in enumerate(kills_users) if u == uid), None)
+        avg_pos = boards["avg"].rank(uid)
+        kills_pos = boards["kills"].rank(uid)
         
         positions = ""
         if avg_pos:
@@ -1425,6 +1686,7 @@ async def help_cmd(inter: discord.Interaction):
                 "`/загрузить_каптов` - Загрузить из файла\n"
                 "`/удалить_капт` - Удалить капт\n"
                 "`/сбросить_статистику` - Сброс всего\n"
+                "`/журнал` - Состояние журнала\n"
                 "`/sync` - Синхронизация команд"
             ),
             inline=False
@@ -1446,12 +1708,19 @@ async def help_cmd(inter: discord.Interaction):
     await inter.response.send_message(embed=embed, ephemeral=True)
 
 @tree.command(name="sync", description="🔄 Синхронизировать команды", guild=discord.Object(GUILD_ID))
-async def sync_commands(inter: discord.Interaction):
+@app_commands.describe(принудительно="Синхронизировать, даже если схема команд не изменилась")
+async def sync_commands(inter: discord.Interaction, принудительно: bool = False):
     if not has_role(inter.user, ADMIN_ROLES):
         return await inter.response.send_message("❌ Нет доступа", ephemeral=True)
     
     try:
-        synced = await tree.sync(guild=discord.Object(GUILD_ID))
+        synced = await sync_commands_if_changed(force=принудительно)
+        if synced is None:
+            return await inter.response.send_message(
+                "✅ Команды не изменились - синхронизация не нужна\n"
+                "Принудительно: `/sync принудительно:True`",
+                ephemeral=True
+            )
         
         embed = discord.Embed(
             title="✅ Команды синхронизированы",
@@ -1534,51 +1803,85 @@ async def backup_command(inter: discord.Interaction):
     
     try:
         backup_time = time.strftime("%Y-%m-%d_%H-%M-%S")
-        shutil.copy(DB_STATS, f"backup_stats_{backup_time}.json")
-        shutil.copy(DB_CAPTS, f"backup_capts_{backup_time}.json")
+        # Бекап из памяти: файлы на диске могут отставать или храниться в SQLite
+        await asyncio.to_thread(codec.dump_file, load_stats(), f"backup_stats_{backup_time}.json")
+        await asyncio.to_thread(codec.dump_file, load_capts(), f"backup_capts_{backup_time}.json")
         await inter.response.send_message(f"✅ Бекап создан: backup_*_{backup_time}.json", ephemeral=True)
     except Exception as e:
         await inter.response.send_message(f"❌ Ошибка: {str(e)}", ephemeral=True)
 
+@tree.command(name="журнал", description="🧾 Состояние журнала изменений", guild=discord.Object(GUILD_ID))
+async def journal_status(inter: discord.Interaction):
+    if not has_role(inter.user, ADMIN_ROLES):
+        return await inter.response.send_message("Нет доступа", ephemeral=True)
+    
+    embed = discord.Embed(title="🧾 ЖУРНАЛ ИЗМЕНЕНИЙ", color=0x3498db, timestamp=now())
+    if isinstance(store, JournalStore):
+        info = store.journal_info()
+        embed.add_field(name="Размер", value=f"{info['size'] / 1024:.1f} KB", inline=True)
+        embed.add_field(name="Записей после сжатия", value=str(info["records"]), inline=True)
+        embed.add_field(
+            name="Доигрывание при запуске",
+            value=f"{store.replayed} записей за {store.replay_time * 1000:.1f} мс",
+            inline=False
+        )
+    else:
+        embed.description = f"Журнал выключен (бэкенд: {STORAGE_BACKEND})"
+    embed.add_field(name="Последняя запись на диск", value=f"{store.write_time * 1000:.1f} мс (в фоне)", inline=True)
+    embed.add_field(name="Задержка event loop", value=loop_lag.summary(), inline=True)
+    embed.add_field(name="Исходящие запросы", value=outbound.summary(), inline=False)
+    await inter.response.send_message(embed=embed, ephemeral=True)
+
 @tree.command(name="капт", description="Edit a capt: view, edit players, edit capt", guild=discord.Object(GUILD_ID))
 @app_commands.describe(номер="Capt number (1=latest)")
 async def edit_capt_cmd(inter: discord.Interaction, номер: int = 1):
     if not has_role(inter.user, ADMIN_ROLES):
         return await inter.response.send_message("No access", ephemeral=True)
     
-    capts = load_capts()
-    if номер < 1 or номер > len(capts):
+    capt_id = capt_id_by_number(номер)
+    if capt_id is None:
         return await inter.response.send_message("Capt not found", ephemeral=True)
     
-    capt_idx = -номер
-    capt = capts[capt_idx]
+    capt = capt_ids.get(capt_id)
     
     # Create view with options to edit capt details or player
     class CaptEditView(discord.ui.View):
-        def __init__(self, capt_data, capt_idx):
+        def __init__(self, capt_id):
             super().__init__(timeout=300)
-            self.capt = capt_data
-            self.idx = capt_idx
+            self.capt_id = capt_id
         
         @discord.ui.button(label="Edit Capt", style=discord.ButtonStyle.primary, custom_id="edit_capt_details")
         async def edit_capt_details(self, btn_inter: discord.Interaction, button: discord.ui.Button):
+            capt = capt_ids.get(self.capt_id)
+            if capt is None:
+                return await btn_inter.response.send_message("Capt not found", ephemeral=True)
+            capt_id = self.capt_id
             class EditCaptModal(discord.ui.Modal, title="Edit Capt"):
-                vs = discord.ui.TextInput(label="Enemy name", default=self.capt.get("vs", ""))
-                win = discord.ui.TextInput(label="Result (win/lose)", default="win" if self.capt.get("win") else "lose")
+                vs = discord.ui.TextInput(label="Enemy name", default=capt.get("vs", ""))
+                win = discord.ui.TextInput(label="Result (win/lose)", default="win" if capt.get("win") else "lose")
                 
                 async def on_submit(self, modal_inter: discord.Interaction):
-                    self.capt["vs"] = self.vs.value.strip()
-                    self.capt["win"] = self.win.value.strip().lower() in ["win", "победа", "в"]
-                    save_capts(capts)
-                    asyncio.create_task(update_capts_list())
+                    try:
+                        await store_writer.submit(
+                            "capt_edited", capt_id=capt_id,
+                            vs=self.vs.value.strip(),
+                            win=self.win.value.strip().lower() in ["win", "победа", "в"]
+                        )
+                    except LookupError:
+                        return await modal_inter.response.send_message("Capt not found", ephemeral=True)
+                    refresh.request("capts_list")
                     await modal_inter.response.send_message("Capt updated", ephemeral=True)
             
             await btn_inter.response.send_modal(EditCaptModal())
         
         @discord.ui.button(label="Edit Player", style=discord.ButtonStyle.secondary, custom_id="edit_player_in_capt")
         async def edit_player_in_capt(self, btn_inter: discord.Interaction, button: discord.ui.Button):
-            if not self.capt.get("players"):
+            capt = capt_ids.get(self.capt_id)
+            if capt is None:
+                return await btn_inter.response.send_message("Capt not found", ephemeral=True)
+            if not capt.get("players"):
                 return await btn_inter.response.send_message("No players", ephemeral=True)
+            capt_id = self.capt_id
             
             # Create select menu for players
             class PlayerSelect(discord.ui.Select):
@@ -1602,26 +1905,14 @@ async def edit_capt_cmd(inter: discord.Interaction, номер: int = 1):
                         
                         async def on_submit(self, edit_inter: discord.Interaction):
                             try:
-                                old_k = player.get("kills", 0)
-                                old_d = player.get("damage", 0)
                                 new_k = int(self.kills.value)
                                 new_d = int(self.damage.value)
                                 
-                                player["kills"] = new_k
-                                player["damage"] = new_d
-                                
-                                # Update stats
-                                st = load_stats()
-                                uid = str(player["user_id"])
-                                if uid in st:
-                                    st[uid]["kills"] += (new_k - old_k)
-                                    st[uid]["damage"] += (new_d - old_d)
-                                    save_stats(st)
-                                
-                                save_capts(capts)
-                                asyncio.create_task(update_capts_list())
-                                asyncio.create_task(update_avg_top())
-                                asyncio.create_task(update_kills_top())
+                                try:
+                                    await store_writer.submit("player_edited", capt_id=capt_id, user_id=str(player["user_id"]), damage=new_d, kills=new_k)
+                                except LookupError:
+                                    return await edit_inter.response.send_message("Capt not found", ephemeral=True)
+                                refresh.request("capts_list", "avg_top", "kills_top")
                                 
                                 await edit_inter.response.send_message("Player updated", ephemeral=True)
                             except Exception as e:
@@ -1630,7 +1921,7 @@ async def edit_capt_cmd(inter: discord.Interaction, номер: int = 1):
                     await select_inter.response.send_modal(EditPlayerModal())
             
             view = discord.ui.View()
-            view.add_item(PlayerSelect(self.capt.get("players", [])))
+            view.add_item(PlayerSelect(capt.get("players", [])))
             await btn_inter.response.send_message("Select player to edit:", view=view, ephemeral=True)
     
     # Show capt info
@@ -1646,7 +1937,7 @@ async def edit_capt_cmd(inter: discord.Interaction, номер: int = 1):
     if players_text:
         embed.add_field(name="Players list", value=players_text, inline=False)
     
-    await inter.response.send_message(embed=embed, view=CaptEditView(capt, capt_idx), ephemeral=True)
+    await inter.response.send_message(embed=embed, view=CaptEditView(capt_id), ephemeral=True)
 
 @tree.command(name="конфиг_недельный_отчет", description="🔧 Настроить еженедельный отчет", guild=discord.Object(GUILD_ID))
 @app_commands.describe(
@@ -1666,18 +1957,75 @@ async def config_weekly(inter: discord.Interaction, день: int = 0, час: i
     await inter.response.send_message(f"✅ Отчет будет отправляться в {days[день % 7]} в {час:02d}:00", ephemeral=True)
 
 # ==================== АВТООБНОВЛЕНИЕ ====================
+# Последний опубликованный хэш по ключу поста и счётчики публикаций
+publish_counts = {"edited": 0, "sent": 0, "skipped": 0}
+
+def content_hash(**fields) -> str:
+    """Хэш содержимого поста без метки времени: одинаковый текст и кнопки - одинаковый хэш"""
+    payload = {"content": fields.get("content")}
+    embed = fields.get("embed")
+    if embed is not None:
+        payload["embed"] = {k: v for k, v in embed.to_dict().items() if k != "timestamp"}
+    view = fields.get("view")
+    if view is not None:
+        payload["view"] = [
+            (type(c).__name__, getattr(c, "custom_id", None), getattr(c, "label", None),
+             getattr(c, "disabled", None), getattr(c, "options", None))
+            for c in view.children
+        ]
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+async def publish_managed(key: str, channel, marker: str, **fields) -> str:
+    """Обновить управляемый пост (топ, список каптов, панель): правка по сохранённому ID
+    одним запросом; поиск в истории канала - только если сообщение пропало.
+    Если содержимое не изменилось с прошлой публикации, запрос не делается; хэш хранится
+    вместе с ID сообщения, поэтому после перезапуска неизменные посты не правятся.
+    Возвращает "edited", "sent" или "skipped" """
+    digest = content_hash(**fields)
+    msgs = load_message_map()
+    entry = msgs.get(key)
+    if isinstance(entry, int):  # старый формат: только ID сообщения
+        entry = {"channel_id": channel.id, "message_id": entry}
+    if entry and entry.get("channel_id") == channel.id:
+        if entry.get("hash") == digest:
+            publish_counts["skipped"] += 1
+            return "skipped"
+        try:
+            partial = channel.get_partial_message(int(entry["message_id"]))
+            await outbound.submit("visible", channel.id, lambda: partial.edit(**fields))
+            msgs[key] = dict(entry, hash=digest)
+            save_message_map(msgs)
+            publish_counts["edited"] += 1
+            return "edited"
+        except discord.HTTPException:
+            pass
+
+    message = None
+    async for msg in channel.history(limit=50):
+        if msg.author.id == client.user.id and msg.embeds and marker in (msg.embeds[0].title or ""):
+            try:
+                await outbound.submit("visible", channel.id, lambda: msg.edit(**fields))
+                message = msg
+                break
+            except discord.HTTPException:
+                pass
+    status = "edited" if message else "sent"
+    if message is None:
+        message = await outbound.submit("visible", channel.id, lambda: channel.send(**fields))
+    msgs[key] = {"channel_id": channel.id, "message_id": message.id, "hash": digest}
+    save_message_map(msgs)
+    publish_counts[status] += 1
+    return status
+
 async def update_avg_top():
     channel = client.get_channel(STATS_AVG_CHANNEL_ID)
     if not channel:
         return
 
-    st = load_stats()
-    filtered = {uid: d for uid, d in st.items() if d["games"] >= 3}
-    if not filtered:
+    users = leaderboards["avg"].top(10)
+    if not users:
         return
 
-    users = sorted(filtered.items(), key=lambda x: x[1]["damage"]/x[1]["games"], reverse=True)[:10]
-
     embed = discord.Embed(
         title="🏆 ТОП-10 СРЕДНЕГО УРОНА",
         color=0x9b59b6,
@@ -1686,11 +2034,7 @@ async def update_avg_top():
 
     desc = ""
     for i, (uid, data) in enumerate(users, 1):
-        try:
-            member = await channel.guild.fetch_member(int(uid))
-            name = member.display_name
-        except:
-            name = f"Игрок {uid}"
+        name = await member_names.resolve(channel.guild, uid) or f"Игрок {uid}"
 
         avg = data["damage"] // data["games"]
         leader_avg = users[0][1]["damage"] // users[0][1]["games"]
@@ -1702,17 +2046,8 @@ async def update_avg_top():
     embed.description = desc
     embed.set_footer(text="Обновляется каждый час • Минимум 3 игры")
 
-    async for msg in channel.history(limit=50):
-        if msg.author.id == client.user.id and msg.embeds:
-            if "ТОП-10 СРЕДНЕГО УРОНА" in msg.embeds[0].title:
-                try:
-                    await msg.edit(embed=embed)
-                    return
-                except:
-                    pass
-
     try:
-        await channel.send(embed=embed)
+        await publish_managed("avg_top", channel, "ТОП-10 СРЕДНЕГО УРОНА", embed=embed)
     except:
         pass
 
@@ -1721,12 +2056,10 @@ async def update_kills_top():
     if not channel:
         return
 
-    st = load_stats()
-    if not st:
+    users = leaderboards["kills"].top(10)
+    if not users:
         return
 
-    users = sorted(st.items(), key=lambda x: x[1]["kills"], reverse=True)[:10]
-
     embed = discord.Embed(
         title="☠️ ТОП-10 ПО КИЛЛАМ",
         color=0xe74c3c,
@@ -1735,11 +2068,7 @@ async def update_kills_top():
 
     desc = ""
     for i, (uid, data) in enumerate(users, 1):
-        try:
-            member = await channel.guild.fetch_member(int(uid))
-            name = member.display_name
-        except:
-            name = f"Игрок {uid}"
+        name = await member_names.resolve(channel.guild, uid) or f"Игрок {uid}"
 
         leader_kills = users[0][1]["kills"]
         percent = (data["kills"] / leader_kills * 100) if leader_kills > 0 else 0
@@ -1750,41 +2079,30 @@ async def update_kills_top():
     embed.description = desc
     embed.set_footer(text="Обновляется каждый час")
 
-    async for msg in channel.history(limit=50):
-        if msg.author.id == client.user.id and msg.embeds:
-            if "ТОП-10 ПО КИЛЛАМ" in msg.embeds[0].title:
-                try:
-                    await msg.edit(embed=embed)
-                    return
-                except:
-                    pass
-
     try:
-        await channel.send(embed=embed)
+        await publish_managed("kills_top", channel, "ТОП-10 ПО КИЛЛАМ", embed=embed)
     except:
         pass
 
+capts_list_token = None  # версия данных последней публикации списка каптов
+
 async def update_capts_list():
+    global capts_list_token
     channel = client.get_channel(CAPTS_LIST_CHANNEL_ID)
     if not channel:
         return
 
-    view = CaptsListView(channel.guild, "all")
+    view = get_capts_list_view("all")
+    token = view.update_data()
+    if token == capts_list_token:
+        return
+    view.show(0)
     embed = await view.create_embed()
 
-    async for msg in channel.history(limit=50):
-        if msg.author.id == client.user.id and msg.embeds:
-            if "История каптов" in msg.embeds[0].title:
-                try:
-                    await msg.edit(embed=embed, view=view)
-                    print("[OK] Capts list updated")
-                    return
-                except:
-                    pass
-
     try:
-        await channel.send(embed=embed, view=view)
-        print("[OK] Capts list sent")
+        status = await publish_managed("capts_list", channel, "История каптов", embed=embed, view=view)
+        capts_list_token = token
+        print(f"[OK] Capts list {'updated' if status == 'edited' else 'sent'}")
     except:
         pass
 
@@ -1811,11 +2129,7 @@ async def send_weekly_report():
     
     desc = ""
     for i, (uid, data) in enumerate(top_avg, 1):
-        try:
-            member = await channel.guild.fetch_member(int(uid))
-            name = member.display_name
-        except:
-            name = f"Игрок {uid}"
+        name = await member_names.resolve(channel.guild, uid) or f"Игрок {uid}"
         avg = data["damage"] // data["games"] if data["games"] > 0 else 0
         desc += f"{i}. **{name}** - {avg:,} ср. урона\n"
     
@@ -1823,27 +2137,52 @@ async def send_weekly_report():
     
     desc = ""
     for i, (uid, data) in enumerate(top_kills, 1):
-        try:
-            member = await channel.guild.fetch_member(int(uid))
-            name = member.display_name
-        except:
-            name = f"Игрок {uid}"
+        name = await member_names.resolve(channel.guild, uid) or f"Игрок {uid}"
         desc += f"{i}. **{name}** - {data['kills']} киллов\n"
     
     embed.add_field(name="☠️ ТОП-5 ПО КИЛЛАМ", value=desc or "Нет данных", inline=False)
     
     try:
-        await channel.send(embed=embed)
+        await outbound.submit("visible", channel.id, lambda: channel.send(embed=embed))
     except:
         pass
 
+refresh = RefreshScheduler(
+    {"capts_list": update_capts_list, "avg_top": update_avg_top, "kills_top": update_kills_top},
+    REFRESH_DEBOUNCE
+)
+
+loop_lag = LoopLagMonitor(LOOP_LAG_INTERVAL)
+
 @tasks.loop(hours=1)
 
 async def auto_update():
-    await update_avg_top()
-    await update_kills_top()
-    await update_capts_list()
-    print(f"[OK] Auto-update done: {datetime.now().strftime('%H:%M:%S')}")
+    member_names.evict_expired()
+    refresh.request()
+    print(f"[OK] Auto-update queued: {datetime.now().strftime('%H:%M:%S')} (refreshes done/requested: {refresh.summary()})")
+    print(f"[OK] Posts: edited {publish_counts['edited']}, sent {publish_counts['sent']}, unchanged {publish_counts['skipped']}")
+    print(f"[OK] Loop lag: {loop_lag.summary()}, last write {store.write_time * 1000:.1f} ms")
+    print(f"[OK] Store writer: {store_writer.applied} mutations in {store_writer.batches} batches")
+    print(f"[OK] Outbound: {outbound.summary()}")
+
+@tasks.loop(seconds=LOOP_LAG_INTERVAL)
+async def measure_loop_lag():
+    loop_lag.tick()
+
+@tasks.loop(minutes=ROLLING_EXPIRE_MINUTES)
+async def expire_rolling():
+    """Снять из недельных/месячных агрегатов капты, выпавшие из окна"""
+    for window in rolling.values():
+        window.expire()
+
+@tasks.loop(minutes=JOURNAL_COMPACT_MINUTES)
+async def compact_journal():
+    """Фоновое сжатие журнала изменений в снапшот"""
+    if isinstance(store, JournalStore) and store.seq > store.compacted_seq:
+        try:
+            store.compact()
+        except Exception as e:
+            print(f"[ERROR] Journal compact: {e}")
 
 @tasks.loop(hours=24)
 async def weekly_report_task():
@@ -1859,17 +2198,57 @@ async def weekly_report_task():
     if now_dt.weekday() == target_day and now_dt.hour == target_hour:
         await send_weekly_report()
 
+# ==================== СИНХРОНИЗАЦИЯ КОМАНД ====================
+def command_schema_hash() -> str:
+    """Хэш схемы команд гильдии - того, что tree.sync отправляет в Discord"""
+    commands = sorted(
+        (cmd.to_dict() for cmd in tree.get_commands(guild=discord.Object(GUILD_ID))),
+        key=lambda c: c["name"]
+    )
+    return hashlib.sha1(json.dumps(commands, sort_keys=True, default=str).encode()).hexdigest()
+
+async def sync_commands_if_changed(force: bool = False):
+    """Синхронизировать команды, если схема изменилась с последней успешной синхронизации
+    (хэш хранится в bot_state.json). force - синхронизировать в любом случае.
+    Возвращает список синхронизированных команд или None, если синхронизация не нужна"""
+    digest = command_schema_hash()
+    state = load_bot_state()
+    if not force and state.get("commands_hash") == digest:
+        return None
+    synced = await tree.sync(guild=discord.Object(GUILD_ID))
+    save_bot_state(dict(state, commands_hash=digest))
+    return synced
+
 # ==================== СОБЫТИЯ ====================
+startup_done = False  # разовые действия при запуске уже выполнены (on_ready приходит и после переподключений)
+
+@client.event
+async def setup_hook():
+    """Регистрация постоянных view до подключения: кнопки уже опубликованных сообщений
+    работают сразу после перезапуска, править посты при старте не нужно"""
+    client.add_view(AdminPanelView())
+    for period in ("all", "week", "month"):
+        get_capts_list_view(period)
+    raffles = [r for r in load_raffles() if r.get("id")]
+    for raffle in raffles:
+        client.add_view(RaffleView(raffle["id"]))
+    print(f"[OK] Persistent views registered (raffles: {len(raffles)})")
+
 @client.event
 async def on_ready():
+    global startup_done
     print(f"[OK] Bot started: {client.user}")
     
     try:
-        await tree.sync(guild=discord.Object(GUILD_ID))
-        print("[OK] Commands synced")
+        synced = await sync_commands_if_changed()
+        print("[OK] Commands unchanged, sync skipped" if synced is None else f"[OK] Commands synced ({len(synced)})")
     except Exception as e:
         print(f"[ERROR] Sync error: {e}")
     
+    if startup_done:
+        return
+    startup_done = True
+    
     if not auto_update.is_running():
         auto_update.start()
         print("[OK] Auto-update started")
@@ -1877,6 +2256,16 @@ async def on_ready():
     if not weekly_report_task.is_running():
         weekly_report_task.start()
         print("[OK] Weekly report started")
+    
+    if not expire_rolling.is_running():
+        expire_rolling.start()
+    
+    if not measure_loop_lag.is_running():
+        measure_loop_lag.start()
+    
+    if isinstance(store, JournalStore) and not compact_journal.is_running():
+        compact_journal.start()
+        print(f"[OK] Journal compaction started (replayed {store.replayed} in {store.replay_time * 1000:.1f} ms)")
     # Post admin panel message to ADMIN_CHANNEL_ID on startup (edit existing if present)
     try:
         channel = client.get_channel(ADMIN_CHANNEL_ID)
@@ -1896,63 +2285,46 @@ async def on_ready():
             embed.add_field(name="🔸 Теги на капт", value="Отправка упоминаний в канал", inline=False)
             embed.add_field(name="🔸 Синхронизировать", value="Синхронизация команд", inline=False)
 
-            msgs = load_message_map()
-            mid = msgs.get('admin')
-            if mid:
-                try:
-                    m = await channel.fetch_message(int(mid))
-                    if m and m.author.id == client.user.id:
-                        try:
-                            await m.edit(embed=embed, view=AdminPanelView())
-                        except:
-                            pass
-                        else:
-                            msgs['admin'] = m.id
-                            save_message_map(msgs)
-                except:
-                    pass
-
-            # Fallback: search recent messages and edit the panel if found
-            found = False
-            async for msg in channel.history(limit=50):
-                if msg.author.id == client.user.id and msg.embeds:
-                    if "ПАНЕЛЬ УПРАВЛЕНИЯ" in (msg.embeds[0].title or ""):
-                        try:
-                            await msg.edit(embed=embed, view=AdminPanelView())
-                            msgs['admin'] = msg.id
-                            save_message_map(msgs)
-                            found = True
-                            break
-                        except:
-                            pass
-
-            if not found:
-                try:
-                    sent = await channel.send(embed=embed, view=AdminPanelView())
-                    msgs['admin'] = sent.id
-                    save_message_map(msgs)
-                except:
-                    pass
+            await publish_managed("admin", channel, "ПАНЕЛЬ УПРАВЛЕНИЯ", embed=embed, view=AdminPanelView())
     except Exception:
         pass
 
+@client.event
+async def on_interaction(interaction: discord.Interaction):
+    outbound.track(interaction)
+
+@client.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    # Команда отработала: не ждать ACK_TIMEOUT, если она так и не ответила
+    outbound.untrack(interaction)
+
+@tree.error
+async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    outbound.untrack(interaction)
+    name = interaction.command.name if interaction.command else "?"
+    print(f"[ERROR] Command /{name}: {error}")
+
+@client.event
+async def on_member_join(member: discord.Member):
+    member_names.put(member)
+
+@client.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    member_names.put(after)
+
 @client.event
 async def on_member_remove(member: discord.Member):
-    st = load_stats()
+    member_names.forget(member.id)
     uid = str(member.id)
     
-    if uid in st:
-        del st[uid]
-        save_stats(st)
-        
+    if uid in load_stats() and await store_writer.submit("member_removed", user_id=uid) is not None:
         await log_action(
             member.guild, client.user,
             "👋 Игрок покинул сервер",
             f"{member.mention} ({member.display_name})\nСтатистика удалена"
         )
         
-        asyncio.create_task(update_avg_top())
-        asyncio.create_task(update_kills_top())
+        refresh.request("avg_top", "kills_top")
 
 # ==================== ЗАПУСК ====================
 if __name__ == "__main__":
@@ -1962,4 +2334,15 @@ if __name__ == "__main__":
                 json.dump({} if db == DB_STATS else [], f)
             print(f"📁 Создан {db}")
 
-    client.run(TOKEN)
+    store.load_all()
+    leaderboards_reload()
+    if capt_ids.rebuild(load_capts()):
+        store.mark_dirty("capts")  # сохранить id, выданные старым каптам
+    capt_tally.rebuild(load_capts())
+    capt_dates.rebuild(load_capts())
+    rolling_reload()
+    try:
+        client.run(TOKEN)
+    finally:
+        store.flush()
+        store.io.shutdown()
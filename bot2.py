@@ -1,9 +1,14 @@
 # -------------- bot.py (исправленная версия 6.0) --------------
-import discord, json, os, asyncio, re, traceback
+import discord, json, os, re, hashlib, traceback
 from datetime import datetime, timedelta, timezone
 from discord.ext import tasks
 from discord import app_commands
 from discord.ui import Button, View
+from botcore import (
+    Capt, PlayerEntry, capts_from_json, capt_ts, DataStore, JournalStore, SqliteStore, StoreWriter,
+    OutboundQueue, CaptDateIndex, CaptIdIndex, CaptTally, build_leaderboards, CaptColumns, RollingStats,
+    resolve_members, MemberNameCache, RefreshScheduler, LoopLagMonitor
+)
 
 # ==================== НАСТРОЙКИ ====================
 TOKEN = os.getenv("TOKEN")
@@ -17,6 +22,11 @@ STATS_KILLS_CHANNEL_ID = 1467543933209809076
 CAPTS_LIST_CHANNEL_ID = 1467544000088117451
 LOG_CHANNEL_ID = 1467598151269150822  # ID канала для логов
 
+# Сколько запросов fetch_member выполнять одновременно при массовой загрузке
+MEMBER_FETCH_CONCURRENCY = int(os.getenv("MEMBER_FETCH_CONCURRENCY", "5"))
+# Время жизни имени участника в кэше (сек)
+MEMBER_NAME_TTL = 3600
+
 # Московское время (UTC+3)
 MSK_TZ = timezone(timedelta(hours=3))
 
@@ -28,6 +38,40 @@ tree = app_commands.CommandTree(client)
 
 DB_STATS = "stats.json"
 DB_CAPTS = "capts.json"
+DB_MESSAGES = "messages.json"
+DB_BOT_STATE = "bot_state.json"
+
+# Бэкенд хранения: "json" (файлы), "journal" (снапшот + журнал мутаций) или "sqlite" (DB_SQLITE, точечная запись изменений)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+DB_SQLITE = "bot.db"
+DB_SNAPSHOT = "snapshot.json"
+DB_JOURNAL = "journal.jsonl"
+# Период фонового сжатия журнала в снапшот (мин)
+JOURNAL_COMPACT_MINUTES = 10
+# Бэкенд journal: при сжатии переписывать и stats.json/capts.json (нужно, чтобы вернуться на бэкенд json)
+JOURNAL_MIRROR_FILES = os.getenv("JOURNAL_MIRROR_FILES", "0") == "1"
+
+# Задержка отложенной записи на диск (сек): изменения за это окно пишутся одним разом
+FLUSH_DELAY = 5
+# Окно группового коммита (сек): записи журнала и ожидания store.durable() за это окно - одна запись с fsync
+GROUP_COMMIT_DELAY = 0.05
+# Период замера задержки event loop (сек): насколько опаздывает таймер из-за блокирующей работы
+LOOP_LAG_INTERVAL = 1
+# Исходящие запросы к Discord: сколько фоновых запросов идёт одновременно, минимальный интервал
+# между запросами в один канал (сек; лимит Discord - 5 сообщений за 5 сек) и ёмкость очередей
+# по классам запросов (порядок классов - их приоритет)
+OUTBOUND_WORKERS = 2
+OUTBOUND_CHANNEL_INTERVAL = 1.0
+OUTBOUND_LIMITS = {"visible": 200, "log": 100}
+
+# Период снятия устаревших каптов из недельных/месячных агрегатов (мин)
+ROLLING_EXPIRE_MINUTES = 15
+
+# Окно накопления запросов на обновление топов и списка каптов (сек)
+REFRESH_DEBOUNCE = 2
+
+# ==================== ИСХОДЯЩИЕ ЗАПРОСЫ ====================
+outbound = OutboundQueue(OUTBOUND_WORKERS, OUTBOUND_CHANNEL_INTERVAL, OUTBOUND_LIMITS)
 
 # ==================== УТИЛИТЫ ====================
 def now_msk():
@@ -38,38 +82,60 @@ def now():
     """Алиас для now_msk для совместимости"""
     return now_msk()
 
+def capt_date_msk(date_str: str) -> str:
+    """Дата капта для показа: хранится как есть, переводится в МСК при выводе"""
+    return datetime.fromtimestamp(capt_ts(date_str), MSK_TZ).strftime("%d.%m.%Y %H:%M")
+
 def load_stats() -> dict:
-    try:
-        with open(DB_STATS, "r", encoding="utf-8") as f:
-            return json.load(f) or {}
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+    return store.get("stats")
 
-def save_stats(data: dict):
-    with open(DB_STATS, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def save_stats(data: dict, *uids):
+    """uids - чьи записи изменились; без них рейтинги пересобираются (и файл пишется) целиком"""
+    store.set("stats", data, *map(str, uids))
+    if uids:
+        leaderboards_touch(*uids)
+    else:
+        leaderboards_reload()
 
 def load_capts() -> list:
-    try:
-        with open(DB_CAPTS, "r", encoding="utf-8") as f:
-            capts = json.load(f) or []
-            for capt in capts:
-                if "date" in capt and isinstance(capt["date"], str):
-                    try:
-                        if "T" in capt["date"]:
-                            dt = datetime.fromisoformat(capt["date"].replace("Z", "+00:00"))
-                            if dt.tzinfo is None:
-                                dt = dt.replace(tzinfo=timezone.utc)
-                            capt["date"] = dt.astimezone(MSK_TZ).isoformat()
-                    except:
-                        pass
-            return capts
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
+    return store.get("capts")
 
 def save_capts(data: list):
-    with open(DB_CAPTS, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+    data = capts_from_json(data)
+    store.set("capts", data)
+    capt_ids.rebuild(data)
+    capt_tally.rebuild(data)
+    capt_dates.rebuild(data)
+    rolling_reload()
+
+def load_message_map() -> dict:
+    return store.get("messages")
+
+def save_message_map(m: dict):
+    store.set("messages", m)
+
+def load_bot_state() -> dict:
+    return store.get("bot_state")
+
+def save_bot_state(state: dict):
+    store.set("bot_state", state)
+
+# id каптов (нужны и хранилищу SQLite: игроки в базе привязаны к id капта)
+capt_ids = CaptIdIndex(load_capts)
+
+STORE_FILES = {
+    "stats": (DB_STATS, dict, None),
+    "capts": (DB_CAPTS, list, capts_from_json),
+    "messages": (DB_MESSAGES, dict, None),
+    "bot_state": (DB_BOT_STATE, dict, None),
+}
+STORE_OPTIONS = {"flush_delay": FLUSH_DELAY, "group_commit_delay": GROUP_COMMIT_DELAY}
+if STORAGE_BACKEND == "sqlite":
+    store = SqliteStore(STORE_FILES, DB_SQLITE, capt_ids, **STORE_OPTIONS)
+elif STORAGE_BACKEND == "journal":
+    store = JournalStore(STORE_FILES, DB_SNAPSHOT, DB_JOURNAL, JOURNAL_MIRROR_FILES, **STORE_OPTIONS)
+else:
+    store = DataStore(STORE_FILES, **STORE_OPTIONS)
 
 def has_role(member: discord.Member, roles: list) -> bool:
     if not member or not member.roles:
@@ -93,33 +159,15 @@ def progress_bar(percent: int, length: int = 10):
 def medal(pos: int) -> str:
     return {1: "🥇", 2: "🥈", 3: "🥉"}.get(pos, "")
 
+capt_dates = CaptDateIndex()
+
+capt_tally = CaptTally()
+
 def get_capts_in_period(days: int = None):
-    """Получить капты за период (в московском времени)"""
-    capts = load_capts()
+    """Получить капты за период: без периода - все в порядке добавления, иначе по индексу дат"""
     if days is None:
-        return capts
-    
-    cutoff = now_msk() - timedelta(days=days)
-    result = []
-    
-    for capt in capts:
-        if "date" in capt and capt["date"]:
-            try:
-                if isinstance(capt["date"], str):
-                    capt_date = datetime.fromisoformat(capt["date"].replace("Z", "+00:00"))
-                    if capt_date.tzinfo is None:
-                        capt_date = capt_date.replace(tzinfo=timezone.utc).astimezone(MSK_TZ)
-                    else:
-                        capt_date = capt_date.astimezone(MSK_TZ)
-                else:
-                    continue
-                
-                if capt_date >= cutoff:
-                    result.append(capt)
-            except:
-                continue
-    
-    return result
+        return load_capts()
+    return capt_dates.since(period_cutoff(days))
 
 def calculate_stats(capts_list: list) -> dict:
     """Рассчитать статистику из списка каптов"""
@@ -134,6 +182,38 @@ def calculate_stats(capts_list: list) -> dict:
             stats[uid]["games"] += 1
     return stats
 
+PERIOD_DAYS = {"week": 7, "month": 30}
+
+def period_cutoff(days: int = None):
+    return None if days is None else (now_msk() - timedelta(days=days)).timestamp()
+
+def get_period_stats(days: int = None) -> dict:
+    """Статистика игроков за период: вся история и неделя/месяц - из скользящих агрегатов,
+    остальное - по индексу дат"""
+    if days in rolling:
+        rolling[days].expire()
+        return rolling[days].stats
+    return calculate_stats(get_capts_in_period(days))
+
+def get_capts_summary(days: int = None) -> tuple:
+    """Количество каптов и побед за период: вся история и неделя/месяц - из счётчиков"""
+    if days is None:
+        return capt_tally.total, capt_tally.wins
+    if days in rolling:
+        rolling[days].expire()
+        return len(rolling[days].members), rolling[days].wins
+    capts = get_capts_in_period(days)
+    return len(capts), sum(1 for c in capts if c["win"])
+
+def get_capts_page(days: int, offset: int, limit: int) -> list:
+    """Страница каптов за период, от новых к старым. Берётся срезом с конца истории
+    (или индекса дат для периода) - стоимость зависит от размера страницы, а не истории"""
+    if days is not None:
+        return capt_dates.newest(period_cutoff(days), offset, limit)
+    capts = load_capts()
+    end = max(0, len(capts) - offset)
+    return capts[max(0, end - limit):end][::-1]
+
 async def log_action(guild: discord.Guild, user: discord.Member, action: str, details: str = "", color: int = 0x3498db):
     """Логирование действий в лог-канал"""
     if not LOG_CHANNEL_ID:
@@ -152,7 +232,7 @@ async def log_action(guild: discord.Guild, user: discord.Member, action: str, de
     embed.set_author(name=user.display_name, icon_url=user.display_avatar.url)
     
     try:
-        await channel.send(embed=embed)
+        outbound.post("log", channel.id, lambda: channel.send(embed=embed))
     except Exception as e:
         print(f"❌ Ошибка отправки лога: {e}")
 
@@ -212,66 +292,272 @@ async def log_system_event(event: str, details: str):
     )
     
     try:
-        await channel.send(embed=embed)
+        outbound.post("log", channel.id, lambda: channel.send(embed=embed))
     except:
         pass
 
+# Рейтинги за всё время: обновляются мутациями статистики, пересобираются при загрузке
+leaderboards = build_leaderboards({})
+
+def leaderboards_touch(*uids):
+    for board in leaderboards.values():
+        for uid in uids:
+            board.update(str(uid))
+
+def leaderboards_reload():
+    for board in leaderboards.values():
+        board.rebuild(load_stats())
+
+def get_leaderboards(days: int = None) -> dict:
+    """Рейтинги по каптам за период: за всё время и за неделю/месяц - готовые, иначе по выборке.
+    Посты с топами строятся по stats.json (leaderboards), команды - по истории каптов"""
+    if days in rolling:
+        rolling[days].expire()
+        return rolling[days].boards
+    return build_leaderboards(get_period_stats(days))
+
+# Окна "За всё время" (None) / "За неделю" / "За месяц": дни -> агрегаты по каптам
+rolling = {days: RollingStats(days) for days in (None, *PERIOD_DAYS.values())}
+
+def rolling_add(capt: dict):
+    for window in rolling.values():
+        window.add(capt)
+
+def rolling_remove(capt: dict):
+    for window in rolling.values():
+        window.remove(capt)
+
+def rolling_reload():
+    """Пересобрать окна по всей истории; с NumPy колонки строятся один раз на все окна"""
+    capts = load_capts()
+    columns = CaptColumns.build(capts)
+    for window in rolling.values():
+        window.rebuild(capts, columns)
+
+member_names = MemberNameCache(MEMBER_NAME_TTL)
+
+async def member_label(guild: discord.Guild, user_id) -> str:
+    """Упоминание с именем для списков или «Игрок ID», если участника нет"""
+    name = await member_names.resolve(guild, user_id)
+    return f"<@{user_id}> ({name})" if name else f"Игрок {user_id}"
+
+# ==================== МУТАЦИИ ====================
+# Все изменения каптов и статистики проходят через store.commit(op, ...):
+# так их можно писать в журнал и доигрывать при запуске.
+# Обработчики команд не вызывают commit сами, а ставят мутацию в очередь store_writer.
+def capt_id_by_number(номер: int):
+    """Номер капта, который видит пользователь (1 = последний) -> id капта или None.
+    Номер переводится в id один раз, дальше капт ищется только по id"""
+    capts = load_capts()
+    if номер < 1 or номер > len(capts):
+        return None
+    return capts[-номер]["id"]
+
+
+def stats_add_player(st: dict, player: dict):
+    uid = str(player["user_id"])
+    if uid not in st:
+        st[uid] = {"damage": 0, "kills": 0, "games": 0}
+    st[uid]["damage"] += player["damage"]
+    st[uid]["kills"] += player["kills"]
+    st[uid]["games"] += 1
+    store.touch("stats", uid)
+    leaderboards_touch(uid)
+
+def stats_remove_player(st: dict, player: dict):
+    uid = str(player["user_id"])
+    if uid in st:
+        st[uid]["damage"] -= player["damage"]
+        st[uid]["kills"] -= player["kills"]
+        st[uid]["games"] -= 1
+        if st[uid]["games"] <= 0:
+            del st[uid]
+        store.touch("stats", uid)
+        leaderboards_touch(uid)
+
+@store.mutation("capt_created", "capts", "stats")
+def m_capt_created(capt: dict):
+    if not capt.get("id"):
+        # id пишем в аргументы: журнал сохранит его, и доигрывание даст тот же id
+        capt["id"] = capt_ids.new_id()
+    capt = Capt.from_dict(capt)
+    load_capts().append(capt)
+    store.touch("capts", capt["id"])
+    capt_ids.add(capt)
+    capt_tally.add(capt)
+    capt_dates.add(capt)
+    rolling_add(capt)
+    st = load_stats()
+    for player in capt["players"]:
+        stats_add_player(st, player)
+    return capt
+
+@store.mutation("player_added", "capts", "stats")
+def m_player_added(idx: int, player: dict):
+    """None - игрок уже в капте: проверка здесь, в очереди писателя, без гонок"""
+    player = PlayerEntry.from_dict(player)
+    capt = load_capts()[idx]
+    if capt.player(player["user_id"]):
+        return None
+    rolling_remove(capt)
+    capt.add_players([player])
+    rolling_add(capt)
+    store.touch("capts", capt["id"])
+    stats_add_player(load_stats(), player)
+    return player
+
+@store.mutation("players_added", "capts", "stats")
+def m_players_added(idx: int, players: list):
+    """Возвращает реально добавленных: уже бывшие в капте и повторы пропускаются"""
+    capt = load_capts()[idx]
+    added = {}
+    for p in players:
+        player = PlayerEntry.from_dict(p)
+        if player["user_id"] not in added and not capt.player(player["user_id"]):
+            added[player["user_id"]] = player
+    players = list(added.values())
+    if not players:
+        return players
+    rolling_remove(capt)
+    capt.add_players(players)
+    rolling_add(capt)
+    store.touch("capts", capt["id"])
+    st = load_stats()
+    for player in players:
+        stats_add_player(st, player)
+    return players
+
+@store.mutation("capt_deleted", "capts", "stats")
+def m_capt_deleted(idx: int):
+    removed = load_capts().pop(idx)
+    store.touch("capts", removed["id"])
+    capt_ids.remove(removed)
+    capt_tally.remove(removed)
+    capt_dates.remove(removed)
+    rolling_remove(removed)
+    st = load_stats()
+    for player in removed["players"]:
+        stats_remove_player(st, player)
+    return removed
+
+@store.mutation("stats_reset", "capts", "stats")
+def m_stats_reset():
+    store.data["stats"] = {}
+    store.data["capts"] = []
+    store.touch("stats")
+    store.touch("capts")
+    leaderboards_reload()
+    capt_ids.rebuild([])
+    capt_tally.rebuild([])
+    capt_dates.rebuild([])
+    rolling_reload()
+
+@store.mutation("member_stats_set", "stats")
+def m_member_stats_set(user_id: str, damage: int, kills: int, games: int):
+    load_stats()[user_id] = {"damage": damage, "kills": kills, "games": games, "points": 0.0}
+    store.touch("stats", user_id)
+    leaderboards_touch(user_id)
+
+@store.mutation("member_removed", "stats")
+def m_member_removed(user_id: str):
+    removed = load_stats().pop(user_id, None)
+    if removed is not None:
+        store.touch("stats", user_id)
+        leaderboards_touch(user_id)
+    return removed
+
+store_writer = StoreWriter(store, capt_ids)
+
 # ==================== VIEW ДЛЯ СПИСКА КАПТОВ ====================
 class CaptsListView(View):
-    def __init__(self, guild: discord.Guild, period: str = "all"):
+    """Список каптов за период. На каждый период при запуске регистрируется один view
+    (get_capts_list_view), он обслуживает все сообщения со списком: период записан в custom_id
+    кнопок, страница - в подписи счётчика страниц самого сообщения. Поэтому после
+    перезапуска кнопки работают без правки опубликованных постов"""
+
+    def __init__(self, period: str = "all"):
         super().__init__(timeout=None)
-        self.guild = guild
         self.period = period
         self.current_page = 0
         self.capts_per_page = 10
+        self.days = PERIOD_DAYS.get(period)
+        self.token = None
+        self.shown = {}  # id сообщения -> версия данных, с которой оно отрисовано
+        for button in (self.previous_page, self.page_info, self.next_page, self.refresh):
+            button.custom_id = f"{button.custom_id}:{period}"
+        self.show(0)
+
+    def data_token(self) -> tuple:
+        """Версия данных списка: правки каптов меняют версию хранилища, сдвиг окна периода - сводку"""
+        return store.versions.get("capts", 0), get_capts_summary(self.days)
+
+    def update_data(self) -> tuple:
+        """Подтянуть сводку, если данные изменились. Возвращает версию данных"""
+        token = self.data_token()
+        if token != self.token:
+            self.token = token
+            self.total, self.wins = token[1]
+            self.total_pages = max(1, (self.total + self.capts_per_page - 1) // self.capts_per_page)
+        return token
+
+    def page_of(self, interaction: discord.Interaction) -> int:
+        """Страница, показанная в сообщении: по подписи счётчика ("3/5")"""
+        for row in interaction.message.components:
+            for child in getattr(row, "children", []):
+                if getattr(child, "custom_id", None) == self.page_info.custom_id:
+                    try:
+                        return int(child.label.split("/")[0]) - 1
+                    except (AttributeError, ValueError):
+                        return 0
+        return 0
+
+    def show(self, page: int):
+        """Перейти на страницу (в пределах текущих данных) и обновить кнопки"""
         self.update_data()
+        self.current_page = max(0, min(page, self.total_pages - 1))
+        self.update_buttons()
 
-    def update_data(self):
-        if self.period == "week":
-            self.capts = get_capts_in_period(7)
-        elif self.period == "month":
-            self.capts = get_capts_in_period(30)
-        else:
-            self.capts = load_capts()
-        
-        self.total_pages = max(1, (len(self.capts) + self.capts_per_page - 1) // self.capts_per_page)
-        if self.current_page >= self.total_pages:
-            self.current_page = max(0, self.total_pages - 1)
+    def remember(self, message_id: int):
+        """Запомнить версию данных, с которой отрисовано сообщение (хранятся последние 500)"""
+        self.shown.pop(message_id, None)
+        self.shown[message_id] = self.token
+        if len(self.shown) > 500:
+            self.shown.pop(next(iter(self.shown)))
 
     @discord.ui.button(label="⬅️", style=discord.ButtonStyle.secondary, custom_id="capts_prev")
     async def previous_page(self, interaction: discord.Interaction, button: Button):
         await interaction.response.defer()
-        if self.current_page > 0:
-            self.current_page -= 1
-            await self.update_message(interaction)
+        page = self.page_of(interaction)
+        if page > 0:
+            await self.update_message(interaction, page - 1)
 
-    @discord.ui.button(label="1/1", style=discord.ButtonStyle.primary, custom_id="capts_page")
+    @discord.ui.button(label="1/1", style=discord.ButtonStyle.primary, custom_id="capts_page", disabled=True)
     async def page_info(self, interaction: discord.Interaction, button: Button):
         await interaction.response.defer()
 
     @discord.ui.button(label="➡️", style=discord.ButtonStyle.secondary, custom_id="capts_next")
     async def next_page(self, interaction: discord.Interaction, button: Button):
         await interaction.response.defer()
-        if self.current_page < self.total_pages - 1:
-            self.current_page += 1
-            await self.update_message(interaction)
+        page = self.page_of(interaction)
+        self.update_data()
+        if page < self.total_pages - 1:
+            await self.update_message(interaction, page + 1)
 
     @discord.ui.button(label="🔄", style=discord.ButtonStyle.success, custom_id="capts_refresh")
     async def refresh(self, interaction: discord.Interaction, button: Button):
         await interaction.response.defer()
-        self.update_data()
-        await self.update_message(interaction)
+        if self.shown.get(interaction.message.id) != self.update_data():
+            await self.update_message(interaction, self.page_of(interaction))
 
-    async def update_message(self, interaction: discord.Interaction):
+    def update_buttons(self):
+        self.page_info.label = f"{self.current_page + 1}/{self.total_pages}"
+        self.previous_page.disabled = self.current_page == 0
+        self.next_page.disabled = self.current_page >= self.total_pages - 1
+
+    async def update_message(self, interaction: discord.Interaction, page: int):
+        self.show(page)
         embed = await self.create_embed()
-        for child in self.children:
-            if isinstance(child, Button):
-                if child.custom_id == "capts_page":
-                    child.label = f"{self.current_page + 1}/{self.total_pages}"
-                elif child.custom_id == "capts_prev":
-                    child.disabled = self.current_page == 0
-                elif child.custom_id == "capts_next":
-                    child.disabled = self.current_page >= self.total_pages - 1
+        self.remember(interaction.message.id)
 
         try:
             await interaction.message.edit(embed=embed, view=self)
@@ -291,42 +577,36 @@ class CaptsListView(View):
             timestamp=now_msk()
         )
 
-        if not self.capts:
+        if not self.total:
             embed.description = "📭 Нет каптов за этот период"
         else:
-            reversed_capts = list(reversed(self.capts))
             start = self.current_page * self.capts_per_page
-            end = min(start + self.capts_per_page, len(reversed_capts))
+            page = get_capts_page(self.days, start, self.capts_per_page)
 
             desc = ""
-            for i in range(start, end):
-                capt = reversed_capts[i]
-                num = len(self.capts) - i
+            for i, capt in enumerate(page, start):
+                num = self.total - i
                 
                 date_str = "Дата неизвестна"
                 if "date" in capt and capt["date"]:
                     try:
                         if isinstance(capt["date"], str):
-                            dt = datetime.fromisoformat(capt["date"].replace("Z", "+00:00"))
-                            if dt.tzinfo is None:
-                                dt = dt.replace(tzinfo=timezone.utc)
-                            dt = dt.astimezone(MSK_TZ)
-                            date_str = dt.strftime("%d.%m.%Y %H:%M")
+                            date_str = capt_date_msk(capt["date"])
                     except:
                         pass
                 
                 result = "✅" if capt["win"] else "❌"
                 players = len(capt["players"])
-                damage = sum(p["damage"] for p in capt["players"])
-                kills = sum(p["kills"] for p in capt["players"])
+                damage = capt.total_damage
+                kills = capt.total_kills
 
                 desc += f"**#{num}. Семья vs {capt['vs']}** {result}\n"
                 desc += f"🕐 {date_str} │ 👥 {players} │ 💥 {damage:,} │ ☠️ {kills}\n\n"
 
             embed.description = desc
 
-            wins = sum(1 for c in self.capts if c["win"])
-            total = len(self.capts)
+            wins = self.wins
+            total = self.total
             winrate = (wins/total*100) if total > 0 else 0
 
             embed.add_field(
@@ -338,12 +618,22 @@ class CaptsListView(View):
         embed.set_footer(text=f"Страница {self.current_page+1}/{self.total_pages} • Время МСК")
         return embed
 
+capts_list_views = {}  # период -> зарегистрированный CaptsListView
+
+def get_capts_list_view(period: str) -> CaptsListView:
+    """View списка каптов за период: создаётся и регистрируется в клиенте один раз"""
+    view = capts_list_views.get(period)
+    if view is None:
+        view = capts_list_views[period] = CaptsListView(period)
+        client.add_view(view)
+    return view
+
 # ==================== VIEW ДЛЯ ДЕТАЛЕЙ КАПТА ====================
 class CaptDetailsView(View):
-    def __init__(self, capt_index: int, capt_data: dict, original_inter: discord.Interaction):
+    def __init__(self, capt_id: int, original_inter: discord.Interaction):
         super().__init__(timeout=180)
-        self.capt_index = capt_index
-        self.capt_data = capt_data
+        self.capt_id = capt_id
+        self.capt_data = capt_ids.get(capt_id)
         self.original_inter = original_inter
         self.current_page = 0
         self.players_per_page = 10
@@ -374,15 +664,17 @@ class CaptDetailsView(View):
     @discord.ui.button(label="🔄 Обновить", style=discord.ButtonStyle.success, row=1)
     async def refresh(self, interaction: discord.Interaction, button: Button):
         await interaction.response.defer()
-        capts = load_capts()
-        if self.capt_index <= len(capts):
-            self.capt_data = capts[-self.capt_index]
-            self.update_players()
-            await self.update_embed(interaction)
+        capt = capt_ids.get(self.capt_id)
+        if capt is None:
+            await interaction.followup.send("❌ Капт удалён", ephemeral=True)
+            return
+        self.capt_data = capt
+        self.update_players()
+        await self.update_embed(interaction)
 
     async def update_embed(self, interaction: discord.Interaction):
         try:
-            date = datetime.fromisoformat(self.capt_data["date"]).strftime("%d.%m.%Y %H:%M")
+            date = capt_date_msk(self.capt_data["date"])
         except:
             date = "Дата неизвестна"
 
@@ -410,17 +702,13 @@ class CaptDetailsView(View):
             text = ""
             for i in range(start, end):
                 p = self.players_sorted[i]
-                try:
-                    member = await interaction.guild.fetch_member(p["user_id"])
-                    name = f"{member.mention} ({member.display_name})"
-                except:
-                    name = f"Игрок {p['user_id']}"
+                name = await member_label(interaction.guild, p["user_id"])
                 text += f"**{i+1}.** {name} — {p['damage']:,} урона, {p['kills']} киллов\n"
 
             embed.add_field(name=f"👥 Участники — стр. {self.current_page+1}/{self.total_pages}", value=text, inline=False)
         
-        total_dmg = sum(p["damage"] for p in self.capt_data["players"])
-        total_kills = sum(p["kills"] for p in self.capt_data["players"])
+        total_dmg = self.capt_data.total_damage
+        total_kills = self.capt_data.total_kills
         cnt = len(self.capt_data["players"])
         avg_dmg = total_dmg // cnt if cnt else 0
         avg_kills = total_kills / cnt if cnt else 0
@@ -483,11 +771,11 @@ async def add_capt(inter: discord.Interaction, против: str, результ
         "players": []
     }
     
-    capts = load_capts()
-    capts.append(new_capt)
-    save_capts(capts)
+    await store_writer.submit("capt_created", capt=new_capt)
+    # Отвечаем, когда капт уже на диске
+    await store.durable("capts")
     
-    asyncio.create_task(update_capts_list())
+    refresh.request("capts_list")
     
     await log_command_success(inter, "добавить_капт", f"Капт против {против} создан")
     
@@ -517,41 +805,30 @@ async def add_player(inter: discord.Interaction, игрок: discord.Member, у
         "номер_капта": номер_капта
     })
 
-    capts = load_capts()
-    if номер_капта < 1 or номер_капта > len(capts):
+    capt_id = capt_id_by_number(номер_капта)
+    if capt_id is None:
         await log_command_error(inter, "добавить_игрока", f"Капт не найден: номер {номер_капта}")
         await inter.response.send_message("❌ Капт не найден", ephemeral=True)
         return
 
-    capt = capts[-номер_капта]
-    
-    if any(p["user_id"] == игрок.id for p in capt["players"]):
+    # Дубль проверяет мутация: между проверкой здесь и записью игрока могли добавить
+    try:
+        added = await store_writer.submit("player_added", capt_id=capt_id, player={
+            "user_id": игрок.id,
+            "user_name": игрок.display_name,
+            "damage": урон,
+            "kills": киллы
+        })
+    except LookupError:
+        await log_command_error(inter, "добавить_игрока", f"Капт удалён: номер {номер_капта}")
+        await inter.response.send_message("❌ Капт не найден", ephemeral=True)
+        return
+    if added is None:
         await log_command_error(inter, "добавить_игрока", f"Игрок уже в капте: {игрок.display_name}")
         await inter.response.send_message(f"❌ {игрок.mention} уже в капте", ephemeral=True)
         return
-
-    capt["players"].append({
-        "user_id": игрок.id,
-        "user_name": игрок.display_name,
-        "damage": урон,
-        "kills": киллы
-    })
-
-    st = load_stats()
-    uid = str(игрок.id)
-    if uid not in st:
-        st[uid] = {"damage": 0, "kills": 0, "games": 0}
     
-    st[uid]["damage"] += урон
-    st[uid]["kills"] += киллы
-    st[uid]["games"] += 1
-    
-    save_stats(st)
-    save_capts(capts)
-    
-    asyncio.create_task(update_avg_top())
-    asyncio.create_task(update_kills_top())
-    asyncio.create_task(update_capts_list())
+    refresh.request("avg_top", "kills_top", "capts_list")
     
     await log_command_success(inter, "добавить_игрока", f"Игрок {игрок.mention} добавлен в капт #{номер_капта}")
     
@@ -579,17 +856,17 @@ async def upload_players(inter: discord.Interaction, данные: str, номе
     await inter.response.defer(ephemeral=True)
     
     try:
-        capts = load_capts()
-        if номер_капта < 1 or номер_капта > len(capts):
+        capt_id = capt_id_by_number(номер_капта)
+        if capt_id is None:
             await log_command_error(inter, "загрузить_игроков", f"Капт не найден: номер {номер_капта}")
             await inter.followup.send("❌ Капт не найден", ephemeral=True)
             return
         
-        capt = capts[-номер_капта]
         lines = данные.strip().split('\n')
-        added = 0
         errors = []
         
+        # 1. Разбираем и проверяем всю пачку целиком
+        parsed = []
         for line in lines:
             line = line.strip()
             if not line:
@@ -608,39 +885,48 @@ async def upload_players(inter: discord.Interaction, данные: str, номе
                 errors.append(f"❌ Ошибка парсинга: {line}")
                 continue
             
-            try:
-                member = await inter.guild.fetch_member(user_id)
-            except:
+            parsed.append((user_id, damage, kills))
+        
+        # 2. Участников получаем параллельно
+        members, _ = await resolve_members(inter.guild, [user_id for user_id, _, _ in parsed], MEMBER_FETCH_CONCURRENCY)
+        
+        seen = set()  # повторы внутри пачки; уже бывших в капте отсеивает мутация
+        players = []
+        for user_id, damage, kills in parsed:
+            member = members.get(user_id)
+            if not member:
                 errors.append(f"❌ Игрок {user_id} не найден")
                 continue
             
-            if any(p["user_id"] == user_id for p in capt["players"]):
+            if user_id in seen:
                 errors.append(f"⚠️ {member.mention} уже добавлен")
                 continue
+            seen.add(user_id)
             
-            capt["players"].append({
+            players.append({
                 "user_id": user_id,
                 "user_name": member.display_name,
                 "damage": damage,
                 "kills": kills
             })
-            
-            st = load_stats()
-            uid = str(user_id)
-            if uid not in st:
-                st[uid] = {"damage": 0, "kills": 0, "games": 0}
-            st[uid]["damage"] += damage
-            st[uid]["kills"] += kills
-            st[uid]["games"] += 1
-            save_stats(st)
-            
-            added += 1
         
-        save_capts(capts)
+        # 3. Все игроки - одной мутацией и одной записью
+        if players:
+            # Капт передаём по id: пока ждали участников, список мог измениться
+            try:
+                added_ids = {p["user_id"] for p in await store_writer.submit(
+                    "players_added", capt_id=capt_id, players=players)}
+            except LookupError:
+                players = []
+                errors.append("❌ Капт удалён во время загрузки")
+            else:
+                for p in players:
+                    if p["user_id"] not in added_ids:
+                        errors.append(f"⚠️ <@{p['user_id']}> уже добавлен")
+                players = [p for p in players if p["user_id"] in added_ids]
+        added = len(players)
         
-        asyncio.create_task(update_avg_top())
-        asyncio.create_task(update_kills_top())
-        asyncio.create_task(update_capts_list())
+        refresh.request("avg_top", "kills_top", "capts_list")
         
         await log_command_success(inter, "загрузить_игроков", f"Добавлено {added} игроков, ошибок: {len(errors)}")
         
@@ -683,16 +969,15 @@ async def upload_capts(inter: discord.Interaction, файл: discord.Attachment,
         content = await файл.read()
         text = content.decode('utf-8')
         
-        capts = load_capts()
-        st = load_stats()
         lines = text.strip().split('\n')
         
-        current_capt_players = []
+        current_capt_players = {}  # user_id -> игрок, в порядке строк
         current_family_name = ""
         current_date_time = None
         current_result = результат
         added_capts = 0
         errors = []
+        new_capts = []
         
         def save_current_capt():
             nonlocal added_capts
@@ -707,18 +992,10 @@ async def upload_capts(inter: discord.Interaction, файл: discord.Attachment,
                         "vs": current_family_name,
                         "date": dt.isoformat(),
                         "win": current_result.lower() in ["win", "w", "1", "true", "победа", "в"],
-                        "players": current_capt_players.copy()
+                        "players": list(current_capt_players.values())
                     }
-                    capts.append(new_capt)
+                    new_capts.append(new_capt)
                     added_capts += 1
-                    
-                    for player in current_capt_players:
-                        uid = str(player["user_id"])
-                        if uid not in st:
-                            st[uid] = {"damage": 0, "kills": 0, "games": 0}
-                        st[uid]["damage"] += player["damage"]
-                        st[uid]["kills"] += player["kills"]
-                        st[uid]["games"] += 1
                         
                 except Exception as e:
                     errors.append(f"❌ Ошибка сохранения капта: {str(e)}")
@@ -728,7 +1005,7 @@ async def upload_capts(inter: discord.Interaction, файл: discord.Attachment,
             
             if not line:
                 save_current_capt()
-                current_capt_players = []
+                current_capt_players = {}
                 current_family_name = ""
                 current_date_time = None
                 current_result = результат
@@ -736,7 +1013,7 @@ async def upload_capts(inter: discord.Interaction, файл: discord.Attachment,
             
             if line.lower().startswith("семья"):
                 save_current_capt()
-                current_capt_players = []
+                current_capt_players = {}
                 current_family_name = ""
                 current_date_time = None
                 current_result = результат
@@ -775,22 +1052,16 @@ async def upload_capts(inter: discord.Interaction, файл: discord.Attachment,
                         damage = int(parts[1])
                         kills = int(parts[2])
                         
-                        if any(p["user_id"] == user_id for p in current_capt_players):
+                        if user_id in current_capt_players:
                             errors.append(f"⚠️ Строка {line_num}: Игрок {user_id} уже в капте")
                             continue
                         
-                        try:
-                            member = await inter.guild.fetch_member(user_id)
-                            user_name = member.display_name
-                        except:
-                            user_name = f"Игрок {user_id}"
-                        
-                        current_capt_players.append({
+                        current_capt_players[user_id] = {
                             "user_id": user_id,
-                            "user_name": user_name,
+                            "user_name": None,
                             "damage": damage,
                             "kills": kills
-                        })
+                        }
                         
                     except Exception as e:
                         errors.append(f"❌ Строка {line_num}: Ошибка обработки игрока - {str(e)}")
@@ -799,15 +1070,24 @@ async def upload_capts(inter: discord.Interaction, файл: discord.Attachment,
         
         save_current_capt()
         
+        # Имена участников: каждый ID один раз, сначала из кэша, остальные параллельно
+        members, lookup = await resolve_members(
+            inter.guild, [p["user_id"] for c in new_capts for p in c["players"]], MEMBER_FETCH_CONCURRENCY
+        )
+        for new_capt in new_capts:
+            for player in new_capt["players"]:
+                member = members.get(player["user_id"])
+                player["user_name"] = member.display_name if member else f"Игрок {player['user_id']}"
+            await store_writer.submit("capt_created", capt=new_capt)
+        await store.durable("capts", "stats")
+        
         if added_capts > 0:
-            save_capts(capts)
-            save_stats(st)
-            
-            asyncio.create_task(update_avg_top())
-            asyncio.create_task(update_kills_top())
-            asyncio.create_task(update_capts_list())
+            refresh.request("avg_top", "kills_top", "capts_list")
         
-        await log_command_success(inter, "загрузить_капты", f"Загружено {added_capts} каптов, ошибок: {len(errors)}")
+        await log_command_success(
+            inter, "загрузить_капты",
+            f"Загружено {added_capts} каптов, ошибок: {len(errors)}, участники: кэш {lookup['cache']} / API {lookup['api']}"
+        )
         
         if added_capts == 0:
             msg = "❌ Не удалось загрузить ни одного капта"
@@ -815,6 +1095,7 @@ async def upload_capts(inter: discord.Interaction, файл: discord.Attachment,
                 msg += f"\n\nОшибки:\n" + "\n".join(errors[:5])
         else:
             msg = f"✅ Загружено каптов: **{added_capts}**"
+            msg += f"\n👥 Участники: из кэша **{lookup['cache']}**, через API **{lookup['api']}**"
             if errors:
                 msg += f"\n\n⚠️ Ошибки ({len(errors)}):\n" + "\n".join(errors[:5])
                 if len(errors) > 5:
@@ -836,30 +1117,22 @@ async def delete_capt(inter: discord.Interaction, номер: int):
     
     await log_command_start(inter, "удалить_капт", {"номер": номер})
     
-    capts = load_capts()
-    if номер < 1 or номер > len(capts):
+    capt_id = capt_id_by_number(номер)
+    if capt_id is None:
         await log_command_error(inter, "удалить_капт", f"Капт не найден: номер {номер}")
         await inter.response.send_message("❌ Капт не найден", ephemeral=True)
         return
     
-    removed_capt = capts.pop(-номер)
+    try:
+        removed_capt = await store_writer.submit("capt_deleted", capt_id=capt_id)
+    except LookupError:
+        # Капт удалили между поиском номера и записью
+        await log_command_error(inter, "удалить_капт", f"Капт удалён: номер {номер}")
+        await inter.response.send_message("❌ Капт не найден", ephemeral=True)
+        return
+    await store.durable("capts", "stats")
     
-    st = load_stats()
-    for player in removed_capt["players"]:
-        uid = str(player["user_id"])
-        if uid in st:
-            st[uid]["damage"] -= player["damage"]
-            st[uid]["kills"] -= player["kills"]
-            st[uid]["games"] -= 1
-            if st[uid]["games"] <= 0:
-                del st[uid]
-    
-    save_stats(st)
-    save_capts(capts)
-    
-    asyncio.create_task(update_avg_top())
-    asyncio.create_task(update_kills_top())
-    asyncio.create_task(update_capts_list())
+    refresh.request("avg_top", "kills_top", "capts_list")
     
     await log_command_success(inter, "удалить_капт", f"Удален капт #{номер} против {removed_capt['vs']}")
     
@@ -879,12 +1152,10 @@ async def reset_stats(inter: discord.Interaction):
     capts = load_capts()
     stats_count = len(load_stats())
     
-    save_stats({})
-    save_capts([])
+    await store_writer.submit("stats_reset")
+    await store.durable("capts", "stats")
     
-    asyncio.create_task(update_avg_top())
-    asyncio.create_task(update_kills_top())
-    asyncio.create_task(update_capts_list())
+    refresh.request("avg_top", "kills_top", "capts_list")
     
     await log_command_success(inter, "сбросить_статистику", f"Удалено {len(capts)} каптов и {stats_count} записей статистики")
     
@@ -912,7 +1183,8 @@ async def list_capts(inter: discord.Interaction, period: str = "all"):
     await inter.response.defer(ephemeral=True)
     
     try:
-        view = CaptsListView(inter.guild, period)
+        view = get_capts_list_view(period)
+        view.show(0)
         embed = await view.create_embed()
         
         await inter.followup.send(embed=embed, view=view, ephemeral=True)
@@ -972,16 +1244,16 @@ async def capt_details(inter: discord.Interaction, номер: int = 1):
     await inter.response.defer()
     
     try:
-        capts = load_capts()
-        if not capts or номер < 1 or номер > len(capts):
+        capt_id = capt_id_by_number(номер)
+        if capt_id is None:
             await log_command_error(inter, "капт", f"Капт не найден: номер {номер}")
             await inter.followup.send("❌ Капт не найден", ephemeral=True)
             return
 
-        view = CaptDetailsView(номер, capts[-номер], inter)
+        view = CaptDetailsView(capt_id, inter)
         
         try:
-            date = datetime.fromisoformat(view.capt_data["date"]).strftime("%d.%m.%Y %H:%M")
+            date = capt_date_msk(view.capt_data["date"])
         except:
             date = "Дата неизвестна"
 
@@ -995,11 +1267,7 @@ async def capt_details(inter: discord.Interaction, номер: int = 1):
         if view.players_sorted:
             text = ""
             for i, p in enumerate(view.players_sorted[:10], 1):
-                try:
-                    member = await inter.guild.fetch_member(p["user_id"])
-                    name = f"{member.mention} ({member.display_name})"
-                except:
-                    name = f"Игрок {p['user_id']}"
+                name = await member_label(inter.guild, p["user_id"])
                 text += f"**{i}.** {name} — {p['damage']:,} урона, {p['kills']} киллов\n"
             embed.add_field(name="👥 Участники (первые 10)", value=text, inline=False)
 
@@ -1028,25 +1296,14 @@ async def top_avg(inter: discord.Interaction, period: str = "all"):
     await inter.response.defer(ephemeral=True)
     
     try:
-        if period == "week":
-            capts = get_capts_in_period(7)
-            period_text = "за неделю"
-        elif period == "month":
-            capts = get_capts_in_period(30)
-            period_text = "за месяц"
-        else:
-            capts = load_capts()
-            period_text = "за всё время"
-        
-        st = calculate_stats(capts)
-        filtered = {uid: d for uid, d in st.items() if d["games"] >= 3}
+        period_text = {"week": "за неделю", "month": "за месяц"}.get(period, "за всё время")
+        boards = get_leaderboards(PERIOD_DAYS.get(period))
+        users = boards["avg"].top(10)
         
-        if not filtered:
+        if not users:
             await log_command_error(inter, "топ_средний", "Нет игроков с 3+ играми")
             await inter.followup.send("📭 Нет игроков с 3+ играми", ephemeral=True)
             return
-
-        users = sorted(filtered.items(), key=lambda x: x[1]["damage"]/x[1]["games"], reverse=True)[:10]
         
         embed = discord.Embed(
             title=f"🏆 ТОП-10 СРЕДНЕГО УРОНА",
@@ -1057,11 +1314,7 @@ async def top_avg(inter: discord.Interaction, period: str = "all"):
         
         desc = ""
         for i, (uid, data) in enumerate(users, 1):
-            try:
-                member = await inter.guild.fetch_member(int(uid))
-                name = f"{member.mention} ({member.display_name})"
-            except:
-                name = f"Игрок {uid}"
+            name = await member_label(inter.guild, uid)
             
             avg = data["damage"] // data["games"]
             
@@ -1100,25 +1353,15 @@ async def top_kills(inter: discord.Interaction, period: str = "all"):
     await inter.response.defer(ephemeral=True)
     
     try:
-        if period == "week":
-            capts = get_capts_in_period(7)
-            period_text = "за неделю"
-        elif period == "month":
-            capts = get_capts_in_period(30)
-            period_text = "за месяц"
-        else:
-            capts = load_capts()
-            period_text = "за всё время"
-        
-        st = calculate_stats(capts)
+        period_text = {"week": "за неделю", "month": "за месяц"}.get(period, "за всё время")
+        boards = get_leaderboards(PERIOD_DAYS.get(period))
+        users = boards["kills"].top(10)
         
-        if not st:
+        if not users:
             await log_command_error(inter, "топ_киллы", "Статистика пуста")
             await inter.followup.send("📭 Статистика пуста", ephemeral=True)
             return
 
-        users = sorted(st.items(), key=lambda x: x[1]["kills"], reverse=True)[:10]
-
         embed = discord.Embed(
             title=f"☠️ ТОП-10 ПО КИЛЛАМ",
             description=f"*Статистика {period_text}*",
@@ -1128,18 +1371,14 @@ async def top_kills(inter: discord.Interaction, period: str = "all"):
         
         desc = ""
         for i, (uid, data) in enumerate(users, 1):
-            try:
-                member = await inter.guild.fetch_member(int(uid))
-                name = f"{member.mention} ({member.display_name})"
-            except:
-                name = f"Игрок {uid}"
+            name = await member_label(inter.guild, uid)
             
             if i <= 3:
                 desc += f"{medal(i)} **{name}**\n"
             else:
                 desc += f"`{i}.` **{name}**\n"
             
-            desc += f"```Киллов:      {data['kills']}\nИгр:         {data['games']}\nСредний урон: {data['damage']//data['games']:,}```\n"
+            desc += f"```Киллов:      {data['kills']}\nИгр:         {data['games']}\nСредний урон: {data['damage']//data['games'] if data['games'] > 0 else 0:,}```\n"
         
         embed.description = f"*Статистика {period_text}*\n\n" + desc
         
@@ -1168,17 +1407,9 @@ async def my_stats(inter: discord.Interaction, period: str = "all"):
     await inter.response.defer(ephemeral=True)
     
     try:
-        if period == "week":
-            capts = get_capts_in_period(7)
-            period_text = "за неделю"
-        elif period == "month":
-            capts = get_capts_in_period(30)
-            period_text = "за месяц"
-        else:
-            capts = load_capts()
-            period_text = "за всё время"
-        
-        st = calculate_stats(capts)
+        period_text = {"week": "за неделю", "month": "за месяц"}.get(period, "за всё время")
+        boards = get_leaderboards(PERIOD_DAYS.get(period))
+        st = boards["kills"].data
         uid = str(inter.user.id)
         
         if uid not in st:
@@ -1203,11 +1434,8 @@ async def my_stats(inter: discord.Interaction, period: str = "all"):
             inline=False
         )
         
-        avg_users = sorted(st.items(), key=lambda x: x[1]["damage"]/x[1]["games"] if x[1]["games"] >= 3 else 0, reverse=True)
-        kills_users = sorted(st.items(), key=lambda x: x[1]["kills"], reverse=True)
-        
-        avg_pos = next((i+1 for i, (u, _) in enumerate(avg_users) if u == uid and data["games"] >= 3), None)
-        kills_pos = next((i+1 for i, (u, _) in enumerate(kills_users) if u == uid), None)
+        avg_pos = boards["avg"].rank(uid)
+        kills_pos = boards["kills"].rank(uid)
         
         positions = ""
         if avg_pos:
@@ -1268,6 +1496,7 @@ async def help_cmd(inter: discord.Interaction):
                 "`/удалить_капт` - Удалить капт\n"
                 "`/сбросить_статистику` - Сброс всего\n"
                 "`/обновить` - Обновить все топы\n"
+                "`/журнал` - Состояние журнала\n"
                 "`/sync` - Синхронизация команд"
             ),
             inline=False
@@ -1289,6 +1518,33 @@ async def help_cmd(inter: discord.Interaction):
     await inter.response.send_message(embed=embed, ephemeral=True)
     await log_command_success(inter, "справка", "Показана справка")
 
+@tree.command(name="журнал", description="🧾 Состояние журнала изменений", guild=discord.Object(GUILD_ID))
+async def journal_status(inter: discord.Interaction):
+    if not is_admin(inter.user):
+        await inter.response.send_message("❌ Нет доступа", ephemeral=True)
+        return
+    
+    await log_command_start(inter, "журнал", {})
+    
+    embed = discord.Embed(title="🧾 Журнал изменений", color=0x3498db, timestamp=now_msk())
+    if isinstance(store, JournalStore):
+        info = store.journal_info()
+        embed.add_field(name="📦 Размер", value=f"{info['size'] / 1024:.1f} KB", inline=True)
+        embed.add_field(name="📝 Записей после сжатия", value=str(info["records"]), inline=True)
+        embed.add_field(
+            name="⏱️ Доигрывание при запуске",
+            value=f"{store.replayed} записей за {store.replay_time * 1000:.1f} мс",
+            inline=False
+        )
+    else:
+        embed.description = f"📭 Журнал выключен (бэкенд: {STORAGE_BACKEND})"
+    embed.add_field(name="💾 Последняя запись на диск", value=f"{store.write_time * 1000:.1f} мс (в фоне)", inline=True)
+    embed.add_field(name="🐢 Задержка event loop", value=loop_lag.summary(), inline=True)
+    embed.add_field(name="📤 Исходящие запросы", value=outbound.summary(), inline=False)
+    
+    await inter.response.send_message(embed=embed, ephemeral=True)
+    await log_command_success(inter, "журнал", f"Задержка event loop: {loop_lag.summary()}")
+
 @tree.command(name="обновить", description="🔄 Принудительно обновить топы и список каптов", guild=discord.Object(GUILD_ID))
 async def manual_update(inter: discord.Interaction):
     if not is_admin(inter.user):
@@ -1304,9 +1560,7 @@ async def manual_update(inter: discord.Interaction):
         await log_system_event("🔄 Ручное обновление топов", f"Инициировано пользователем {inter.user.mention}")
         
         # Обновляем все топы
-        await update_avg_top()
-        await update_kills_top()
-        await update_capts_list()
+        await refresh.run_now("avg_top", "kills_top", "capts_list")
         
         await log_command_success(inter, "обновить", "Все топы обновлены")
         await log_system_event("✅ Ручное обновление завершено", "Все топы успешно обновлены")
@@ -1318,17 +1572,26 @@ async def manual_update(inter: discord.Interaction):
         await inter.followup.send(f"❌ Ошибка при обновлении: {str(e)}", ephemeral=True)
 
 @tree.command(name="sync", description="🔄 Синхронизировать команды", guild=discord.Object(GUILD_ID))
-async def sync_commands(inter: discord.Interaction):
+@app_commands.describe(принудительно="Синхронизировать, даже если схема команд не изменилась")
+async def sync_commands(inter: discord.Interaction, принудительно: bool = False):
     if not is_admin(inter.user):
         await inter.response.send_message("❌ Нет доступа", ephemeral=True)
         return
     
-    await log_command_start(inter, "sync", {})
+    await log_command_start(inter, "sync", {"принудительно": принудительно})
     
     await inter.response.defer(ephemeral=True)
     
     try:
-        synced = await tree.sync(guild=discord.Object(GUILD_ID))
+        synced = await sync_commands_if_changed(force=принудительно)
+        if synced is None:
+            await inter.followup.send(
+                "✅ Команды не изменились - синхронизация не нужна\n"
+                "Принудительно: `/sync принудительно:True`",
+                ephemeral=True
+            )
+            await log_command_success(inter, "sync", "Схема команд не изменилась, синхронизация пропущена")
+            return
         
         # Логируем синхронизацию
         await log_system_event("🔄 Синхронизация команд", f"Синхронизировано команд: {len(synced)}")
@@ -1364,6 +1627,66 @@ async def sync_commands(inter: discord.Interaction):
         await log_command_error(inter, "sync", str(e))
 
 # ==================== АВТООБНОВЛЕНИЕ ====================
+# Последний опубликованный хэш по ключу поста и счётчики публикаций
+publish_counts = {"edited": 0, "sent": 0, "skipped": 0}
+
+def content_hash(**fields) -> str:
+    """Хэш содержимого поста без метки времени: одинаковый текст и кнопки - одинаковый хэш"""
+    payload = {"content": fields.get("content")}
+    embed = fields.get("embed")
+    if embed is not None:
+        payload["embed"] = {k: v for k, v in embed.to_dict().items() if k != "timestamp"}
+    view = fields.get("view")
+    if view is not None:
+        payload["view"] = [
+            (type(c).__name__, getattr(c, "custom_id", None), getattr(c, "label", None),
+             getattr(c, "disabled", None), getattr(c, "options", None))
+            for c in view.children
+        ]
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+async def publish_managed(key: str, channel, marker: str, **fields) -> str:
+    """Обновить управляемый пост (топ, список каптов, панель): правка по сохранённому ID
+    одним запросом; поиск в истории канала - только если сообщение пропало.
+    Если содержимое не изменилось с прошлой публикации, запрос не делается; хэш хранится
+    вместе с ID сообщения, поэтому после перезапуска неизменные посты не правятся.
+    Возвращает "edited", "sent" или "skipped" """
+    digest = content_hash(**fields)
+    msgs = load_message_map()
+    entry = msgs.get(key)
+    if isinstance(entry, int):  # старый формат: только ID сообщения
+        entry = {"channel_id": channel.id, "message_id": entry}
+    if entry and entry.get("channel_id") == channel.id:
+        if entry.get("hash") == digest:
+            publish_counts["skipped"] += 1
+            return "skipped"
+        try:
+            partial = channel.get_partial_message(int(entry["message_id"]))
+            await outbound.submit("visible", channel.id, lambda: partial.edit(**fields))
+            msgs[key] = dict(entry, hash=digest)
+            save_message_map(msgs)
+            publish_counts["edited"] += 1
+            return "edited"
+        except discord.HTTPException:
+            pass
+
+    message = None
+    async for msg in channel.history(limit=50):
+        if msg.author.id == client.user.id and msg.embeds and marker in (msg.embeds[0].title or ""):
+            try:
+                await outbound.submit("visible", channel.id, lambda: msg.edit(**fields))
+                message = msg
+                break
+            except discord.HTTPException:
+                pass
+    status = "edited" if message else "sent"
+    if message is None:
+        message = await outbound.submit("visible", channel.id, lambda: channel.send(**fields))
+    msgs[key] = {"channel_id": channel.id, "message_id": message.id, "hash": digest}
+    save_message_map(msgs)
+    publish_counts[status] += 1
+    return status
+
 async def update_avg_top():
     """Обновление топа по среднему урону"""
     channel = client.get_channel(STATS_AVG_CHANNEL_ID)
@@ -1372,12 +1695,10 @@ async def update_avg_top():
         return
 
     try:
-        st = load_stats()
-        
         # Фильтруем только игроков с 3+ играми
-        filtered = {uid: d for uid, d in st.items() if d["games"] >= 3}
+        users = leaderboards["avg"].top(10)
         
-        if not filtered:
+        if not users:
             # Если нет игроков с 3+ играми, покажем сообщение об этом
             embed = discord.Embed(
                 title="🏆 ТОП-10 СРЕДНЕГО УРОНА",
@@ -1387,28 +1708,16 @@ async def update_avg_top():
             )
             embed.set_footer(text="Минимум 3 игры для участия")
             
-            # Ищем сообщение для редактирования
-            async for msg in channel.history(limit=50):
-                if msg.author.id == client.user.id and msg.embeds:
-                    if "ТОП-10 СРЕДНЕГО УРОНА" in msg.embeds[0].title:
-                        try:
-                            await msg.edit(embed=embed)
-                            await log_system_event("✅ Топ урона обновлен", "Нет игроков с 3+ играми")
-                            return
-                        except Exception as e:
-                            await log_system_event("❌ Ошибка редактирования топа урона", f"Ошибка: {str(e)}")
-            
-            # Если не нашли сообщение, отправляем новое
             try:
-                await channel.send(embed=embed)
-                await log_system_event("✅ Топ урона отправлен", "Нет игроков с 3+ играми")
+                status = await publish_managed("avg_top", channel, "ТОП-10 СРЕДНЕГО УРОНА", embed=embed)
+                if status == "edited":
+                    await log_system_event("✅ Топ урона обновлен", "Нет игроков с 3+ играми")
+                elif status == "sent":
+                    await log_system_event("✅ Топ урона отправлен", "Нет игроков с 3+ играми")
             except Exception as e:
                 await log_system_event("❌ Ошибка отправки топа урона", f"Ошибка: {str(e)}")
             return
 
-        # Сортируем игроков по среднему урону
-        users = sorted(filtered.items(), key=lambda x: x[1]["damage"]/x[1]["games"], reverse=True)[:10]
-
         embed = discord.Embed(
             title="🏆 ТОП-10 СРЕДНЕГО УРОНА",
             color=0x9b59b6,
@@ -1417,11 +1726,7 @@ async def update_avg_top():
 
         desc = ""
         for i, (uid, data) in enumerate(users, 1):
-            try:
-                member = await channel.guild.fetch_member(int(uid))
-                name = member.display_name
-            except:
-                name = f"Игрок {uid}"
+            name = await member_names.resolve(channel.guild, uid) or f"Игрок {uid}"
 
             avg = data["damage"] // data["games"]
             leader_avg = users[0][1]["damage"] // users[0][1]["games"]
@@ -1433,27 +1738,14 @@ async def update_avg_top():
         embed.description = desc
         embed.set_footer(text="Обновляется каждый час • Минимум 3 игры")
 
-        # Ищем существующее сообщение для редактирования
-        found = False
-        async for msg in channel.history(limit=50):
-            if msg.author.id == client.user.id and msg.embeds:
-                if "ТОП-10 СРЕДНЕГО УРОНА" in msg.embeds[0].title:
-                    try:
-                        await msg.edit(embed=embed)
-                        await log_system_event("✅ Топ урона обновлен", f"Обновлено {len(users)} игроков")
-                        found = True
-                        break
-                    except Exception as e:
-                        await log_system_event("❌ Ошибка редактирования топа урона", f"Ошибка: {str(e)}")
-                        found = False
-        
-        # Если не нашли сообщение, отправляем новое
-        if not found:
-            try:
-                await channel.send(embed=embed)
+        try:
+            status = await publish_managed("avg_top", channel, "ТОП-10 СРЕДНЕГО УРОНА", embed=embed)
+            if status == "edited":
+                await log_system_event("✅ Топ урона обновлен", f"Обновлено {len(users)} игроков")
+            elif status == "sent":
                 await log_system_event("✅ Топ урона отправлен", f"Отправлено {len(users)} игроков")
-            except Exception as e:
-                await log_system_event("❌ Ошибка отправки топа урона", f"Ошибка: {str(e)}")
+        except Exception as e:
+            await log_system_event("❌ Ошибка отправки топа урона", f"Ошибка: {str(e)}")
                 
     except Exception as e:
         await log_system_event("❌ Критическая ошибка в update_avg_top", f"Ошибка: {str(e)}")
@@ -1466,9 +1758,9 @@ async def update_kills_top():
         return
 
     try:
-        st = load_stats()
+        users = leaderboards["kills"].top(10)
         
-        if not st:
+        if not users:
             embed = discord.Embed(
                 title="☠️ ТОП-10 ПО КИЛЛАМ",
                 description="📭 Статистика пуста",
@@ -1477,25 +1769,16 @@ async def update_kills_top():
             )
             embed.set_footer(text="Обновляется каждый час")
             
-            async for msg in channel.history(limit=50):
-                if msg.author.id == client.user.id and msg.embeds:
-                    if "ТОП-10 ПО КИЛЛАМ" in msg.embeds[0].title:
-                        try:
-                            await msg.edit(embed=embed)
-                            await log_system_event("✅ Топ киллов обновлен", "Статистика пуста")
-                            return
-                        except Exception as e:
-                            await log_system_event("❌ Ошибка редактирования топа киллов", f"Ошибка: {str(e)}")
-            
             try:
-                await channel.send(embed=embed)
-                await log_system_event("✅ Топ киллов отправлен", "Статистика пуста")
+                status = await publish_managed("kills_top", channel, "ТОП-10 ПО КИЛЛАМ", embed=embed)
+                if status == "edited":
+                    await log_system_event("✅ Топ киллов обновлен", "Статистика пуста")
+                elif status == "sent":
+                    await log_system_event("✅ Топ киллов отправлен", "Статистика пуста")
             except Exception as e:
                 await log_system_event("❌ Ошибка отправки топа киллов", f"Ошибка: {str(e)}")
             return
 
-        users = sorted(st.items(), key=lambda x: x[1]["kills"], reverse=True)[:10]
-
         embed = discord.Embed(
             title="☠️ ТОП-10 ПО КИЛЛАМ",
             color=0xe74c3c,
@@ -1504,11 +1787,7 @@ async def update_kills_top():
 
         desc = ""
         for i, (uid, data) in enumerate(users, 1):
-            try:
-                member = await channel.guild.fetch_member(int(uid))
-                name = member.display_name
-            except:
-                name = f"Игрок {uid}"
+            name = await member_names.resolve(channel.guild, uid) or f"Игрок {uid}"
 
             leader_kills = users[0][1]["kills"]
             percent = (data["kills"] / leader_kills * 100) if leader_kills > 0 else 0
@@ -1519,123 +1798,220 @@ async def update_kills_top():
         embed.description = desc
         embed.set_footer(text="Обновляется каждый час")
 
-        found = False
-        async for msg in channel.history(limit=50):
-            if msg.author.id == client.user.id and msg.embeds:
-                if "ТОП-10 ПО КИЛЛАМ" in msg.embeds[0].title:
-                    try:
-                        await msg.edit(embed=embed)
-                        await log_system_event("✅ Топ киллов обновлен", f"Обновлено {len(users)} игроков")
-                        found = True
-                        break
-                    except Exception as e:
-                        await log_system_event("❌ Ошибка редактирования топа киллов", f"Ошибка: {str(e)}")
-                        found = False
-        
-        if not found:
-            try:
-                await channel.send(embed=embed)
+        try:
+            status = await publish_managed("kills_top", channel, "ТОП-10 ПО КИЛЛАМ", embed=embed)
+            if status == "edited":
+                await log_system_event("✅ Топ киллов обновлен", f"Обновлено {len(users)} игроков")
+            elif status == "sent":
                 await log_system_event("✅ Топ киллов отправлен", f"Отправлено {len(users)} игроков")
-            except Exception as e:
-                await log_system_event("❌ Ошибка отправки топа киллов", f"Ошибка: {str(e)}")
+        except Exception as e:
+            await log_system_event("❌ Ошибка отправки топа киллов", f"Ошибка: {str(e)}")
                 
     except Exception as e:
         await log_system_event("❌ Критическая ошибка в update_kills_top", f"Ошибка: {str(e)}")
 
+capts_list_token = None  # версия данных последней публикации списка каптов
+
 async def update_capts_list():
-    """Обновление списка каптов"""
+    """Обновление списка каптов; если данные не менялись с прошлой публикации - ничего не делает"""
+    global capts_list_token
     channel = client.get_channel(CAPTS_LIST_CHANNEL_ID)
     if not channel:
         await log_system_event("❌ Канал не найден", f"Канал CAPTS_LIST_CHANNEL_ID ({CAPTS_LIST_CHANNEL_ID}) не найден")
         return
 
     try:
-        view = CaptsListView(channel.guild, "all")
+        view = get_capts_list_view("all")
+        token = view.update_data()
+        if token == capts_list_token:
+            return
+        view.show(0)
         embed = await view.create_embed()
 
-        found = False
-        async for msg in channel.history(limit=50):
-            if msg.author.id == client.user.id and msg.embeds:
-                if "История каптов" in msg.embeds[0].title:
-                    try:
-                        await msg.edit(embed=embed, view=view)
-                        await log_system_event("✅ Список каптов обновлен", f"Загружено {len(view.capts)} каптов")
-                        found = True
-                        break
-                    except Exception as e:
-                        await log_system_event("❌ Ошибка редактирования списка каптов", f"Ошибка: {str(e)}")
-                        found = False
-        
-        if not found:
-            try:
-                await channel.send(embed=embed, view=view)
-                await log_system_event("✅ Список каптов отправлен", f"Загружено {len(view.capts)} каптов")
-            except Exception as e:
-                await log_system_event("❌ Ошибка отправки списка каптов", f"Ошибка: {str(e)}")
+        try:
+            status = await publish_managed("capts_list", channel, "История каптов", embed=embed, view=view)
+            capts_list_token = token
+            if status == "edited":
+                await log_system_event("✅ Список каптов обновлен", f"Загружено {view.total} каптов")
+            elif status == "sent":
+                await log_system_event("✅ Список каптов отправлен", f"Загружено {view.total} каптов")
+        except Exception as e:
+            await log_system_event("❌ Ошибка отправки списка каптов", f"Ошибка: {str(e)}")
                 
     except Exception as e:
         await log_system_event("❌ Критическая ошибка в update_capts_list", f"Ошибка: {str(e)}")
 
+async def refresh_failed(name: str, error: Exception):
+    await log_system_event(f"❌ Ошибка обновления {name}", f"Ошибка: {str(error)}")
+
+refresh = RefreshScheduler(
+    {"capts_list": update_capts_list, "avg_top": update_avg_top, "kills_top": update_kills_top},
+    REFRESH_DEBOUNCE,
+    refresh_failed
+)
+
+loop_lag = LoopLagMonitor(LOOP_LAG_INTERVAL)
+
 @tasks.loop(hours=1)
 async def auto_update():
     """Автоматическое обновление топов каждый час"""
-    await log_system_event("⏰ Начало автообновления", "Запущено автоматическое обновление топов")
-    await update_avg_top()
-    await update_kills_top()
-    await update_capts_list()
-    await log_system_event("✅ Автообновление завершено", "Все топы успешно обновлены")
+    member_names.evict_expired()
+    refresh.request()
+    await log_system_event(
+        "⏰ Автообновление запрошено",
+        f"Обновлений выполнено/запрошено: {refresh.summary()}\n"
+        f"Постов изменено: {publish_counts['edited']}, отправлено: {publish_counts['sent']}, "
+        f"без изменений (пропущено): {publish_counts['skipped']}\n"
+        f"Задержка event loop: {loop_lag.summary()}, последняя запись: {store.write_time * 1000:.1f} мс\n"
+        f"Очередь изменений: {store_writer.summary()}\n"
+        f"Исходящие запросы: {outbound.summary()}"
+    )
+
+@tasks.loop(seconds=LOOP_LAG_INTERVAL)
+async def measure_loop_lag():
+    loop_lag.tick()
+
+@tasks.loop(minutes=ROLLING_EXPIRE_MINUTES)
+async def expire_rolling():
+    """Снять из недельных/месячных агрегатов капты, выпавшие из окна"""
+    for window in rolling.values():
+        window.expire()
+
+@tasks.loop(minutes=JOURNAL_COMPACT_MINUTES)
+async def compact_journal():
+    """Фоновое сжатие журнала изменений в снапшот"""
+    if isinstance(store, JournalStore) and store.seq > store.compacted_seq:
+        try:
+            store.compact()
+        except Exception as e:
+            await log_system_event("❌ Ошибка сжатия журнала", f"Ошибка: {str(e)}")
+
+# ==================== СИНХРОНИЗАЦИЯ КОМАНД ====================
+def command_schema_hash() -> str:
+    """Хэш схемы команд гильдии - того, что tree.sync отправляет в Discord"""
+    commands = sorted(
+        (cmd.to_dict() for cmd in tree.get_commands(guild=discord.Object(GUILD_ID))),
+        key=lambda c: c["name"]
+    )
+    return hashlib.sha1(json.dumps(commands, sort_keys=True, default=str).encode()).hexdigest()
+
+async def sync_commands_if_changed(force: bool = False):
+    """Синхронизировать команды, если схема изменилась с последней успешной синхронизации
+    (хэш хранится в bot_state.json). force - синхронизировать в любом случае.
+    Возвращает список синхронизированных команд или None, если синхронизация не нужна"""
+    digest = command_schema_hash()
+    state = load_bot_state()
+    if not force and state.get("commands_hash") == digest:
+        return None
+    synced = await tree.sync(guild=discord.Object(GUILD_ID))
+    save_bot_state(dict(state, commands_hash=digest))
+    return synced
 
 # ==================== СОБЫТИЯ ====================
+startup_done = False  # разовые действия при запуске уже выполнены (on_ready приходит и после переподключений)
+
+@client.event
+async def setup_hook():
+    """Регистрация постоянных view до подключения: кнопки уже опубликованных списков каптов
+    работают сразу после перезапуска, править посты при старте не нужно"""
+    for period in ("all", "week", "month"):
+        get_capts_list_view(period)
+
 @client.event
 async def on_ready():
+    global startup_done
     print(f"✅ Бот запущен: {client.user}")
     
     try:
-        # Синхронизируем команды только для указанной гильдии
-        synced = await tree.sync(guild=discord.Object(GUILD_ID))
-        print(f"✅ Команды синхронизированы: {len(synced)} команд")
-        
-        # Логируем запуск
-        await log_system_event("✅ Бот запущен", f"Бот успешно запущен. Синхронизировано {len(synced)} команд")
-        
-        # Показываем список синхронизированных команд
-        for cmd in synced:
-            print(f"  • /{cmd.name}")
+        # Синхронизируем команды только для указанной гильдии и только если схема изменилась
+        synced = await sync_commands_if_changed()
+        if synced is None:
+            print("✅ Команды не изменились, синхронизация пропущена")
+            sync_text = "Команды не изменились, синхронизация пропущена"
+        else:
+            print(f"✅ Команды синхронизированы: {len(synced)} команд")
+            sync_text = f"Синхронизировано {len(synced)} команд"
+            
+            # Показываем список синхронизированных команд
+            for cmd in synced:
+                print(f"  • /{cmd.name}")
     except Exception as e:
+        sync_text = None
         print(f"❌ Ошибка синхронизации: {e}")
         await log_system_event("❌ Ошибка синхронизации", f"Ошибка: {str(e)}")
     
+    # После переподключения к шлюзу: задачи уже запущены, списки уже обновлены
+    if startup_done:
+        return
+    startup_done = True
+    
+    if sync_text:
+        # Логируем запуск
+        await log_system_event("✅ Бот запущен", f"Бот успешно запущен. {sync_text}")
+    
     if not auto_update.is_running():
         auto_update.start()
         print("✅ Автообновление запущено")
         await log_system_event("✅ Автообновление запущено", "Топы будут обновляться каждый час")
     
+    if not expire_rolling.is_running():
+        expire_rolling.start()
+    
+    if not measure_loop_lag.is_running():
+        measure_loop_lag.start()
+    
+    if isinstance(store, JournalStore) and not compact_journal.is_running():
+        compact_journal.start()
+        await log_system_event(
+            "🧾 Журнал изменений",
+            f"Доиграно {store.replayed} записей за {store.replay_time * 1000:.1f} мс"
+        )
+    
     # Принудительно обновляем все списки при запуске
     try:
         await log_system_event("🔄 Обновление при запуске", "Начато принудительное обновление топов при запуске")
-        await update_capts_list()
-        await update_avg_top()
-        await update_kills_top()
+        await refresh.run_now("capts_list", "avg_top", "kills_top")
         await log_system_event("✅ Обновление завершено", "Все топы обновлены при запуске")
         print("✅ Все списки обновлены при запуске")
     except Exception as e:
         print(f"⚠️ Ошибка при обновлении списков: {e}")
         await log_system_event("❌ Ошибка обновления", f"Ошибка при обновлении списков: {str(e)}")
 
+@client.event
+async def on_interaction(interaction: discord.Interaction):
+    outbound.track(interaction)
+
+@client.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    # Команда отработала: не ждать ACK_TIMEOUT, если она так и не ответила
+    outbound.untrack(interaction)
+
+@tree.error
+async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    outbound.untrack(interaction)
+    name = interaction.command.name if interaction.command else "?"
+    print(f"❌ Ошибка команды /{name}: {error}")
+    traceback.print_exception(type(error), error, error.__traceback__)
+    await log_command_error(interaction, name, str(error))
+
+@client.event
+async def on_member_join(member: discord.Member):
+    member_names.put(member)
+
+@client.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    member_names.put(after)
+
 @client.event
 async def on_member_remove(member: discord.Member):
-    st = load_stats()
+    member_names.forget(member.id)
     uid = str(member.id)
     
-    if uid in st:
-        del st[uid]
-        save_stats(st)
-        
+    if uid in load_stats() and await store_writer.submit("member_removed", user_id=uid) is not None:
         await log_system_event("👤 Игрок покинул сервер", 
                              f"Игрок {member.mention} ({member.display_name}) покинул сервер. Статистика удалена.")
         
-        asyncio.create_task(update_avg_top())
-        asyncio.create_task(update_kills_top())
+        refresh.request("avg_top", "kills_top")
 
 # ==================== ЗАПУСК ====================
 if __name__ == "__main__":
@@ -1646,7 +2022,17 @@ if __name__ == "__main__":
                 json.dump({} if db == DB_STATS else [], f)
             print(f"📁 Создан {db}")
 
+    store.load_all()
+    leaderboards_reload()
+    if capt_ids.rebuild(load_capts()):
+        store.mark_dirty("capts")  # сохранить id, выданные старым каптам
+    capt_tally.rebuild(load_capts())
+    capt_dates.rebuild(load_capts())
+    rolling_reload()
     try:
         client.run(TOKEN)
     except Exception as e:
         print(f"❌ Критическая ошибка: {e}")
+    finally:
+        store.flush()
+        store.io.shutdown()
@@ -0,0 +1,1537 @@
+# -------------- botcore.py: общее для bot.py и bot2.py - записи, хранилище, очереди, индексы --------------
+import discord, json, os, sys, asyncio, heapq, itertools, time, sqlite3, threading
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+try:
+    import orjson  # необязательно: быстрый JSON
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec  # необязательно: быстрый JSON, если нет orjson
+except ImportError:
+    msgspec = None
+
+try:
+    import numpy as np  # необязательно: колоночная пересборка агрегатов (CaptColumns)
+except ImportError:
+    np = None
+
+# ==================== НАСТРОЙКИ ====================
+# Сериализатор JSON: "auto" (orjson, затем msgspec, затем json), "orjson", "msgspec" или "json"
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto")
+# Писать файлы с отступами (удобно читать глазами); по умолчанию - компактно
+JSON_PRETTY = os.getenv("JSON_PRETTY", "0") == "1"
+
+# ==================== ЗАПИСИ ====================
+class Record:
+    """Компактная запись на слотах с доступом как у dict (rec["damage"], .get, in, update),
+    чтобы остальной код работал с ней как со словарём. Неизвестные ключи - в extra"""
+
+    __slots__ = ("extra",)
+    FIELDS = ()
+    DEFAULTS = {}
+
+    def __init__(self, **fields):
+        for key in self.FIELDS:
+            setattr(self, key, fields.pop(key, self.DEFAULTS.get(key)))
+        self.extra = fields or None
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return key in self.FIELDS or bool(self.extra) and key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, fields: dict):
+        for key, value in fields.items():
+            self[key] = value
+
+    def to_dict(self) -> dict:
+        d = {key: getattr(self, key) for key in self.FIELDS}
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+def intern_str(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+def as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+class PlayerEntry(Record):
+    """Игрок в капте: ID - int, имя интернировано (одна строка на все капты игрока)"""
+
+    __slots__ = ("user_id", "user_name", "damage", "kills")
+    FIELDS = __slots__
+    DEFAULTS = {"damage": 0, "kills": 0}
+
+    @classmethod
+    def from_dict(cls, d):
+        if isinstance(d, cls):
+            return d
+        d = dict(d)
+        d["user_id"] = as_int(d.get("user_id"))
+        d["user_name"] = intern_str(d.get("user_name"))
+        return cls(**d)
+
+class Capt(Record):
+    """Капт; id - постоянный номер записи (см. CaptIdIndex), не зависит от места в списке.
+    by_user - user_id -> игрок (те же объекты, что в players), total_damage/total_kills - суммы
+    по игрокам; это производные данные, на диск не пишутся"""
+
+    __slots__ = ("id", "vs", "date", "win", "players", "by_user", "total_damage", "total_kills")
+    FIELDS = ("id", "vs", "date", "win", "players")
+    DEFAULTS = {"win": False}
+
+    def __init__(self, **fields):
+        super().__init__(**fields)
+        if self.players is None:
+            self.players = []
+        self.reindex()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if key == "players":
+            self.reindex()
+
+    def reindex(self):
+        """Пересобрать by_user (при повторе ID - первое вхождение) и суммы по списку игроков"""
+        self.by_user = {}
+        self.total_damage = self.total_kills = 0
+        for player in self.players:
+            self.by_user.setdefault(player["user_id"], player)
+            self.total_damage += player["damage"] or 0
+            self.total_kills += player["kills"] or 0
+
+    def player(self, user_id):
+        """Игрок капта по ID (int или str) или None"""
+        return self.by_user.get(as_int(user_id))
+
+    def add_players(self, players: list):
+        self.players.extend(players)
+        for player in players:
+            self.by_user.setdefault(player["user_id"], player)
+            self.total_damage += player["damage"] or 0
+            self.total_kills += player["kills"] or 0
+
+    def edit_player(self, player, damage: int, kills: int):
+        """Поменять урон/киллы игрока вместе с суммами капта"""
+        self.total_damage += damage - (player["damage"] or 0)
+        self.total_kills += kills - (player["kills"] or 0)
+        player["damage"] = damage
+        player["kills"] = kills
+
+    @classmethod
+    def from_dict(cls, d):
+        if isinstance(d, cls):
+            return d
+        d = dict(d)
+        d["vs"] = intern_str(d.get("vs"))
+        d["players"] = [PlayerEntry.from_dict(p) for p in d.get("players") or []]
+        return cls(**d)
+
+def capts_from_json(capts: list) -> list:
+    """Граница с диском: список словарей -> записи Capt"""
+    return [Capt.from_dict(c) for c in capts]
+
+def to_json(value):
+    """default для json.dump: записи - словарями, остальное - строкой"""
+    if isinstance(value, Record):
+        return value.to_dict()
+    return str(value)
+
+# ==================== ХРАНИЛИЩЕ ====================
+def write_atomic(path: str, payload: bytes):
+    """Записать файл целиком или никак: временный файл + fsync + переименование поверх старого"""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    try:
+        # Само переименование тоже должно дойти до диска
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return  # Windows: каталог так не открыть
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class JsonCodec:
+    """Сериализатор JSON: orjson или msgspec, если установлены, иначе стандартный json.
+    Пишет компактно (pretty=True - с отступами); при чтении подходит любой вид"""
+
+    def __init__(self, backend: str = "auto", pretty: bool = False):
+        if backend == "auto":
+            backend = "orjson" if orjson else "msgspec" if msgspec else "json"
+        if backend == "orjson" and not orjson or backend == "msgspec" and not msgspec:
+            print(f"[WARN] {backend} не установлен, используется json")
+            backend = "json"
+        self.name = backend
+        self.pretty = pretty
+        if backend == "msgspec":
+            self._encoder = msgspec.json.Encoder(enc_hook=to_json)
+
+    def dumps(self, value, pretty: bool = None) -> bytes:
+        pretty = self.pretty if pretty is None else pretty
+        if self.name == "orjson":
+            option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+            return orjson.dumps(value, default=to_json, option=option)
+        if self.name == "msgspec":
+            data = self._encoder.encode(value)
+            return msgspec.json.format(data, indent=2) if pretty else data
+        if pretty:
+            return json.dumps(value, ensure_ascii=False, indent=2, default=to_json).encode("utf-8")
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=to_json).encode("utf-8")
+
+    def loads(self, data):
+        """bytes или str -> значение; ошибка разбора всегда ValueError"""
+        if self.name == "orjson":
+            return orjson.loads(data)
+        if self.name == "msgspec":
+            try:
+                return msgspec.json.decode(data)
+            except msgspec.DecodeError as e:
+                raise ValueError(str(e)) from e
+        return json.loads(data)
+
+    def dump_file(self, value, path: str, pretty: bool = None):
+        write_atomic(path, self.dumps(value, pretty))
+
+    def load_file(self, path: str):
+        with open(path, "rb") as f:
+            return self.loads(f.read())
+
+codec = JsonCodec(JSON_BACKEND, JSON_PRETTY)
+
+class DataStore:
+    """Данные в памяти: файл читается один раз, запись на диск отложена и объединяется.
+    Снимок для записи берётся в event loop (мутации идут там же), в поток store-io уходят только
+    неизменяемые байты/строки. Большие файлы (PIECES) кодируются по записям: байты записи
+    кэшируются до её изменения, в loop кодируются только изменённые, склейка файла - в store-io"""
+
+    PIECES = ("stats", "capts")
+
+    def __init__(self, files: dict, flush_delay: float = 5, group_commit_delay: float = 0.05):
+        # files: имя -> (путь к файлу, фабрика значения по умолчанию, разбор после чтения)
+        self.files = files
+        # flush_delay - окно отложенной записи, group_commit_delay - окно группового коммита (сек)
+        self.flush_delay = flush_delay
+        self.group_commit_delay = group_commit_delay
+        self.data = {}
+        self.dirty = {}  # имя -> изменённые ключи (None - весь файл)
+        self.touched = None  # ключи, изменённые текущей мутацией (см. touch)
+        self.mutations = {}  # op -> (функция, какие данные она может менять), см. mutation()
+        self.pieces = {name: {} for name in self.PIECES}  # имя -> ключ записи -> её байты (см. _encode)
+        self.versions = {}  # имя -> счётчик изменений (для кэшей поверх данных)
+        self._flush_handle = None
+        # Один поток на запись: писатели выполняются строго по очереди
+        self.io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store-io")
+        self.io_lock = threading.Lock()
+        self.write_time = 0.0  # длительность последней записи (сек)
+        self.written = {}  # имя -> версия, которая уже на диске
+        self.waiters = []  # (имя -> нужная версия, future) для store.durable()
+
+    def _read(self, name: str):
+        path, default, _ = self.files[name]
+        try:
+            return codec.load_file(path) or default()
+        except (FileNotFoundError, ValueError):
+            return default()
+
+    def _encode(self, name: str, keys=None):
+        """Снимок данных name для записи (в event loop): живые данные поток store-io не трогает.
+        Для PIECES - (начало, байты записей, конец): капт - по id, словарь - по ключу; заново
+        кодируются только записи без кэша. keys - изменённые записи; файл всё равно пишется
+        целиком, точечно пишет только SQLite"""
+        value = self.data[name]
+        cache = self.pieces.get(name)
+        if cache is None:
+            return codec.dumps(value)
+        parts = []
+        if isinstance(value, dict):
+            for key, item in value.items():
+                piece = cache.get(key)
+                if piece is None:
+                    piece = cache[key] = codec.dumps({key: item}, pretty=False)[1:-1]
+                parts.append(piece)
+            return b"{", parts, b"}"
+        for item in value:
+            key = item.get("id")
+            piece = cache.get(key)
+            if piece is None:
+                piece = codec.dumps(item, pretty=False)
+                if key is not None:
+                    cache[key] = piece
+            parts.append(piece)
+        return b"[", parts, b"]"
+
+    @staticmethod
+    def _join(payload, pretty: bool = None) -> bytes:
+        """Снимок -> байты файла (в потоке store-io): записи склеиваются здесь, а не в event loop"""
+        if isinstance(payload, bytes):
+            return payload
+        start, parts, end = payload
+        data = start + b",".join(parts) + end
+        if codec.pretty if pretty is None else pretty:
+            data = codec.dumps(codec.loads(data), pretty=True)
+        return data
+
+    def _forget(self, name: str, keys=None):
+        """Сбросить кэш байтов изменённых записей name (без keys - всех)"""
+        cache = self.pieces.get(name)
+        if cache is None:
+            return
+        if not keys:
+            cache.clear()
+            return
+        for key in keys:
+            cache.pop(key, None)
+
+    def _write_payload(self, name: str, payload):
+        """Записать готовый снимок (в потоке store-io)"""
+        write_atomic(self.files[name][0], self._join(payload))
+
+    def _encode_names(self, dirty: dict) -> tuple:
+        """Снимки для записи (имя -> изменённые ключи) -> (имя -> снимок, имена, которые не удалось закодировать)"""
+        payloads, failed = {}, []
+        for name, keys in dirty.items():
+            try:
+                payloads[name] = self._encode(name, keys)
+            except Exception as e:
+                failed.append(name)
+                print(f"[ERROR] Flush {name}: {e}")
+        return payloads, failed
+
+    def _write_names(self, payloads: dict) -> list:
+        """Записать снимки (в потоке store-io); вернуть имена, которые не удалось записать"""
+        failed = []
+        for name, payload in payloads.items():
+            try:
+                self._write_payload(name, payload)
+            except Exception as e:
+                failed.append(name)
+                print(f"[ERROR] Flush {name}: {e}")
+        return failed
+
+    def _in_background(self, func, *args, wait: bool = False, done=None):
+        """Выполнить func в потоке store-io, done(результат) - потом в event loop.
+        Без event loop (запуск/остановка) или с wait=True - сразу, в текущем потоке"""
+        def run():
+            with self.io_lock:
+                started = time.perf_counter()
+                try:
+                    return func(*args)
+                finally:
+                    self.write_time = time.perf_counter() - started
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or wait:
+            result = run()
+            if done:
+                done(result)
+            return
+        future = loop.run_in_executor(self.io, run)
+        if done:
+            future.add_done_callback(lambda f: f.cancelled() or f.exception() or done(f.result()))
+
+
+    def load_all(self):
+        for name in self.files:
+            self.get(name)
+        if self.dirty:
+            self.flush()
+
+    def _decode(self, name: str, value):
+        decode = self.files[name][2]
+        return decode(value) if decode else value
+
+    def get(self, name: str):
+        if name not in self.data:
+            self.data[name] = self._decode(name, self._read(name))
+        return self.data[name]
+
+    def set(self, name: str, value, *keys):
+        if value is not self.data.get(name):
+            self._forget(name)  # другой объект: кэш записей от старого не годится
+        self.data[name] = value
+        self.mark_dirty(name, *keys)
+
+    def mark_dirty(self, name: str, *keys):
+        """keys - какие записи изменились (SQLite запишет только их); без keys - весь файл"""
+        self._forget(name, keys)
+        if keys and self.dirty.get(name, ()) is not None:
+            self.dirty.setdefault(name, {}).update(dict.fromkeys(keys))
+        else:
+            self.dirty[name] = None
+        self.versions[name] = self.versions.get(name, 0) + 1
+        self._schedule_flush(self.flush_delay)
+
+    def _schedule_flush(self, delay: float):
+        """Запланировать запись не позже чем через delay сек (уже назначенную раньше - не двигаем)"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop (запуск/остановка) пишем сразу
+            self.flush()
+            return
+        if self._flush_handle is not None:
+            if self._flush_handle.when() <= loop.time() + delay:
+                return
+            self._flush_handle.cancel()
+        self._flush_handle = loop.call_later(delay, self.flush)
+
+    def _retry_flush(self):
+        """После ошибки записи повторить через flush_delay. Вне event loop не повторяем
+        (иначе flush вызывал бы сам себя): данные остаются изменёнными до следующего flush"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._schedule_flush(self.flush_delay)
+
+    async def durable(self, *names):
+        """Дождаться, пока уже сделанные изменения names (по умолчанию - всех файлов) будут на диске.
+        Ожидания в пределах group_commit_delay попадают в одну запись; ошибка записи - OSError"""
+        targets = {
+            name: self.versions[name]
+            for name in (names or list(self.versions))
+            if self.versions.get(name, 0) > self.written.get(name, 0)
+        }
+        if not targets:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((targets, future))
+        self._schedule_flush(self.group_commit_delay)
+        await future
+
+    def _mark_written(self, versions: dict, failed=()):
+        """Отметить записанные версии и разбудить дождавшихся store.durable()"""
+        for name, version in versions.items():
+            if name not in failed:
+                self.written[name] = max(self.written.get(name, 0), version)
+        waiting = []
+        for targets, future in self.waiters:
+            if future.done():
+                continue
+            lost = [name for name in targets if name in failed]
+            if lost:
+                future.set_exception(OSError(f"Не удалось записать: {', '.join(lost)}"))
+            elif all(self.written.get(name, 0) >= v for name, v in targets.items()):
+                future.set_result(None)
+            else:
+                waiting.append((targets, future))
+        self.waiters = waiting
+
+    def mutation(self, op: str, *touches: str):
+        """Декоратор: зарегистрировать мутацию op; touches - какие данные она может менять.
+        Что именно изменилось, мутация сообщает через touch(имя, ключи)"""
+        def wrap(func):
+            self.mutations[op] = (func, touches)
+            return func
+        return wrap
+
+    def touch(self, name: str, *keys):
+        """Вызывается мутацией: какие записи name она изменила (без keys - всё целиком)"""
+        if self.touched is None:
+            return  # доигрывание журнала: писать нечего
+        if keys and self.touched.get(name, ()) is not None:
+            self.touched.setdefault(name, {}).update(dict.fromkeys(keys))
+        else:
+            self.touched[name] = None
+
+    def commit(self, op: str, **args):
+        """Применить мутацию к данным в памяти (см. mutation).
+        Помечаются только данные, о которых мутация сообщила через touch()"""
+        func, touches = self.mutations[op]
+        self.touched = {}
+        try:
+            result = func(**args)
+        finally:
+            touched, self.touched = self.touched, None
+        for name in touches:
+            if name in touched:
+                self.mark_dirty(name, *(touched[name] or ()))
+        return result
+
+    def flush(self, wait: bool = False):
+        """Записать на диск все изменённые файлы (в фоне; wait=True - дождаться записи).
+        Изменение во время фоновой записи снова помечает файл, и следующая запись его перекроет"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        dirty, self.dirty = self.dirty, {}
+        if not dirty:
+            return
+        versions = {name: self.versions.get(name, 0) for name in dirty}
+        payloads, bad = self._encode_names(dirty)
+
+        def done(failed: list):
+            # Незаписанные файлы остаются изменёнными и уйдут со следующей записью (целиком)
+            failed = bad + failed
+            self.dirty.update(dict.fromkeys(failed))
+            self._mark_written(versions, failed)
+            if failed:
+                self._retry_flush()
+
+        self._in_background(self._write_names, payloads, wait=wait, done=done)
+
+class JournalStore(DataStore):
+    """JSON-снапшот + журнал мутаций (JSONL): каждое изменение - одна строка в конце файла.
+    Строки за окно group_commit_delay дописываются одной записью с fsync.
+    mirror_files=True - при сжатии переписывать и обычные JSON-файлы журналируемых данных
+    (чтобы можно было вернуться на бэкенд json); по умолчанию пишется только снапшот"""
+
+    JOURNALED = ("stats", "capts")
+
+    def __init__(self, files: dict, snapshot_path: str, journal_path: str, mirror_files: bool = False, **options):
+        super().__init__(files, **options)
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.mirror_files = mirror_files
+        self.seq = 0
+        self.compacted_seq = 0
+        self.replayed = 0
+        self.replay_time = 0.0
+        self.pending = []  # строки журнала, ещё не дописанные на диск
+        self.pending_versions = {}
+
+    def load_all(self):
+        try:
+            snap = codec.load_file(self.snapshot_path)
+            self.seq = self.compacted_seq = snap.get("seq", 0)
+            for name in self.JOURNALED:
+                self.data[name] = self._decode(name, snap["data"].get(name) or self.files[name][1]())
+        except (FileNotFoundError, ValueError):
+            pass  # снапшота ещё нет: начинаем с обычных JSON-файлов
+        super().load_all()
+        self._replay()
+
+    def _replay(self):
+        """Доиграть хвост журнала поверх снапшота"""
+        started = time.perf_counter()
+        count = 0
+        try:
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    try:
+                        rec = codec.loads(line)
+                    except ValueError:
+                        break  # недописанная строка после падения
+                    if rec["seq"] <= self.seq:
+                        continue
+                    self.mutations[rec["op"]][0](**rec["args"])
+                    self.seq = rec["seq"]
+                    count += 1
+        except FileNotFoundError:
+            pass
+        if count:
+            # Доигранные мутации не сообщают, какие записи меняли: кэш байтов собирается заново
+            for name in self.JOURNALED:
+                self._forget(name)
+        self.replayed = count
+        self.replay_time = time.perf_counter() - started
+
+    def commit(self, op: str, **args):
+        func, touches = self.mutations[op]
+        self.touched = {}
+        try:
+            result = func(**args)
+        finally:
+            touched, self.touched = self.touched, None
+        for name, keys in touched.items():
+            self._forget(name, keys)
+        self.seq += 1
+        for name in touches:
+            self.versions[name] = self.pending_versions[name] = self.versions.get(name, 0) + 1
+        self.pending.append(codec.dumps({"seq": self.seq, "op": op, "args": args}, pretty=False) + b"\n")
+        self._schedule_flush(self.group_commit_delay)
+        return result
+
+    def _flush_journal(self, wait: bool = False):
+        """Дописать накопленные строки журнала одной записью"""
+        if not self.pending:
+            return
+        lines, versions = self.pending, self.pending_versions
+        self.pending, self.pending_versions = [], {}
+
+        def done(ok: bool):
+            if not ok:
+                # Вернуть строки в начало очереди: порядок seq сохраняется
+                self.pending[:0] = lines
+                for name, version in versions.items():
+                    self.pending_versions.setdefault(name, version)
+            self._mark_written(versions, () if ok else tuple(versions))
+            if not ok:
+                self._retry_flush()
+
+        self._in_background(self._append_journal, lines, wait=wait, done=done)
+
+    def _append_journal(self, lines: list) -> bool:
+        try:
+            with open(self.journal_path, "ab") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            return True
+        except Exception as e:
+            print(f"[ERROR] Journal append: {e}")
+            return False
+
+    def compact(self, wait: bool = False):
+        """Свернуть журнал в снапшот и обнулить его.
+        Снимок берётся здесь же (он должен совпасть с seq), склеивается и пишется - в потоке store-io"""
+        self._flush_journal(wait)
+        seq = self.seq
+        for name in self.JOURNALED:
+            self.get(name)
+        payloads, bad = self._encode_names(dict.fromkeys(self.JOURNALED))
+        if bad:
+            self.dirty.update(dict.fromkeys(self.JOURNALED))
+            self._retry_flush()
+            return
+        versions = {name: self.versions.get(name, 0) for name in self.JOURNALED}
+
+        def done(ok: bool):
+            if ok:
+                self.compacted_seq = seq
+                self._mark_written(versions)
+            else:
+                self.dirty.update(dict.fromkeys(self.JOURNALED))
+                self._retry_flush()
+
+        self._in_background(self._write_snapshot, seq, payloads, wait=wait, done=done)
+
+    def _write_snapshot(self, seq: int, payloads: dict) -> bool:
+        try:
+            # Снапшот собираем из снимков файлов: каждая запись закодирована один раз
+            payload = b"".join([
+                b'{"seq":', str(seq).encode(), b',"data":{',
+                b",".join(b'"%s":%s' % (name.encode(), self._join(data, False)) for name, data in payloads.items()),
+                b"}}",
+            ])
+            write_atomic(self.snapshot_path, payload)
+            self._truncate_journal(seq)
+        except Exception as e:
+            print(f"[ERROR] Journal compact: {e}")
+            return False
+        if self.mirror_files:
+            self._write_names(payloads)
+        return True
+
+    def _truncate_journal(self, seq: int):
+        """Убрать из журнала записи, вошедшие в снапшот seq (в потоке store-io, после дозаписей)"""
+        tail = []
+        if self.seq != seq:
+            # Пока снапшот писался, в журнал дописали новые мутации - их оставляем
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    try:
+                        if codec.loads(line)["seq"] > seq:
+                            tail.append(line)
+                    except ValueError:
+                        break
+        write_atomic(self.journal_path, b"".join(tail))
+
+    def flush(self, wait: bool = False):
+        self._flush_journal(wait)
+        journaled = [name for name in self.JOURNALED if name in self.dirty]
+        if journaled:
+            # Снапшот пишется целиком, после него журнал не нужен
+            for name in journaled:
+                del self.dirty[name]
+            self.compact(wait)
+        super().flush(wait)
+
+    def journal_info(self) -> dict:
+        try:
+            size = os.path.getsize(self.journal_path)
+        except OSError:
+            size = 0
+        return {"size": size, "records": self.seq - self.compacted_seq}
+
+def capt_ts(date_str: str) -> float:
+    """Дата капта (ISO) -> unix timestamp; без часового пояса считаем UTC"""
+    dt = datetime.fromisoformat(date_str.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+class SqliteStore(DataStore):
+    """Хранилище в SQLite (WAL). Данные читаются в память один раз при запуске, выборки по периоду
+    идут по индексам в памяти (CaptDateIndex и др.). Мутации пишутся точечно: UPSERT/DELETE изменённых игроков и каптов, а не таблица целиком"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS capts (id INTEGER PRIMARY KEY, pos INTEGER, vs TEXT, date TEXT, win INTEGER);
+    CREATE INDEX IF NOT EXISTS idx_capts_pos ON capts (pos);
+    CREATE TABLE IF NOT EXISTS capt_players (
+        capt_id INTEGER, pos INTEGER, user_id INTEGER, user_name TEXT, damage INTEGER, kills INTEGER,
+        PRIMARY KEY (capt_id, pos)
+    );
+    CREATE TABLE IF NOT EXISTS stats (user_id TEXT PRIMARY KEY, damage INTEGER, kills INTEGER, games INTEGER, points REAL);
+    CREATE TABLE IF NOT EXISTS raffles (pos INTEGER PRIMARY KEY, id TEXT, data TEXT);
+    CREATE TABLE IF NOT EXISTS messages (key TEXT PRIMARY KEY, value TEXT);
+    """
+    TABLES = {"stats": "stats", "capts": "capts", "raffles": "raffles", "messages": "messages"}
+
+    def __init__(self, files: dict, path: str, capt_ids, **options):
+        super().__init__(files, **options)
+        # Игроки в базе привязаны к id капта: индекс id (CaptIdIndex) нужен при чтении и точечной записи
+        self.capt_ids = capt_ids
+        # Запись идёт из потока store-io, чтение при запуске - из event loop; соединение делят под io_lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Коммит дожидается fsync: store.durable() должен означать "на диске"
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.executescript(self.SCHEMA)
+
+    def _read(self, name: str):
+        table = self.TABLES.get(name)
+        if not table:
+            return super()._read(name)
+        if self.db.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None:
+            # Пустая база: переносим данные из JSON-файла
+            value = super()._read(name)
+            if value:
+                if name == "capts":
+                    # Игроки в базе привязаны к id капта: старым каптам id нужен до первой записи
+                    self.capt_ids.rebuild(value)
+                self.dirty[name] = None
+            return value
+        return getattr(self, f"_read_{name}")()
+
+    def _encode(self, name: str, keys=None):
+        if name not in self.TABLES:
+            return super()._encode(name, keys)
+        return getattr(self, f"_rows_{name}")(self.data[name], keys)
+
+    def _write_payload(self, name: str, payload):
+        if name not in self.TABLES:
+            return super()._write_payload(name, payload)
+        with self.db:
+            getattr(self, f"_write_{name}")(payload)
+
+    def _read_stats(self) -> dict:
+        st = {}
+        for r in self.db.execute("SELECT * FROM stats"):
+            st[r["user_id"]] = {"damage": r["damage"], "kills": r["kills"], "games": r["games"]}
+            if r["points"] is not None:
+                st[r["user_id"]]["points"] = r["points"]
+        return st
+
+    @staticmethod
+    def _stats_row(uid: str, d: dict) -> tuple:
+        return (uid, d.get("damage", 0), d.get("kills", 0), d.get("games", 0), d.get("points"))
+
+    def _rows_stats(self, st: dict, keys=None) -> tuple:
+        """keys - изменённые игроки: запись есть - UPSERT, игрока уже нет - DELETE; None - вся таблица"""
+        if keys is None:
+            return None, [self._stats_row(uid, d) for uid, d in st.items()], []
+        return (
+            list(keys),
+            [self._stats_row(uid, st[uid]) for uid in keys if uid in st],
+            [(uid,) for uid in keys if uid not in st],
+        )
+
+    def _write_stats(self, payload: tuple):
+        keys, rows, removed = payload
+        if keys is None:
+            self.db.execute("DELETE FROM stats")
+        self.db.executemany("DELETE FROM stats WHERE user_id = ?", removed)
+        self.db.executemany(
+            "INSERT INTO stats (user_id, damage, kills, games, points) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET damage = excluded.damage, kills = excluded.kills, "
+            "games = excluded.games, points = excluded.points",
+            rows
+        )
+
+    def _read_capts(self) -> list:
+        capts = {}
+        for r in self.db.execute("SELECT * FROM capts ORDER BY pos"):
+            capts[r["id"]] = Capt(id=r["id"], vs=intern_str(r["vs"]), date=r["date"], win=bool(r["win"]))
+        for r in self.db.execute("SELECT * FROM capt_players ORDER BY capt_id, pos"):
+            capt = capts.get(r["capt_id"])
+            if capt is not None:
+                capt.players.append(PlayerEntry(
+                    user_id=r["user_id"],
+                    user_name=intern_str(r["user_name"]),
+                    damage=r["damage"],
+                    kills=r["kills"]
+                ))
+        for capt in capts.values():
+            capt.reindex()
+        return list(capts.values())
+
+    def _rows_capts(self, capts: list, keys=None) -> tuple:
+        """keys - id изменённых каптов (в порядке изменений): капт есть - UPSERT строки
+        и его игроков заново, капта уже нет - DELETE; None - все капты"""
+        changed = capts if keys is None else [c for c in map(self.capt_ids.get, keys) if c is not None]
+        rows, players = [], []
+        for c in changed:
+            rows.append((c.get("id"), c.get("vs"), c.get("date"), int(bool(c.get("win")))))
+            for j, p in enumerate(c.get("players", [])):
+                players.append((c["id"], j, p["user_id"], p.get("user_name"), p.get("damage", 0), p.get("kills", 0)))
+        return None if keys is None else list(keys), rows, players
+
+    def _write_capts(self, payload: tuple):
+        keys, rows, players = payload
+        if keys is None:
+            self.db.execute("DELETE FROM capts")
+            self.db.execute("DELETE FROM capt_players")
+        else:
+            kept = {row[0] for row in rows}
+            self.db.executemany("DELETE FROM capt_players WHERE capt_id = ?", [(k,) for k in keys])
+            self.db.executemany("DELETE FROM capts WHERE id = ?", [(k,) for k in keys if k not in kept])
+        # Новый капт встаёт в конец истории, у существующего место (pos) не меняется
+        self.db.executemany(
+            "INSERT INTO capts (id, pos, vs, date, win) "
+            "VALUES (?, (SELECT COALESCE(MAX(pos), -1) + 1 FROM capts), ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET vs = excluded.vs, date = excluded.date, win = excluded.win",
+            rows
+        )
+        self.db.executemany(
+            "INSERT INTO capt_players (capt_id, pos, user_id, user_name, damage, kills) VALUES (?, ?, ?, ?, ?, ?)",
+            players
+        )
+
+    def _read_raffles(self) -> list:
+        return [codec.loads(r["data"]) for r in self.db.execute("SELECT data FROM raffles ORDER BY pos")]
+
+    def _rows_raffles(self, raffles: list, keys=None) -> list:
+        # Розыгрышей немного - таблица пишется целиком
+        return [(i, r.get("id"), codec.dumps(r, pretty=False).decode("utf-8")) for i, r in enumerate(raffles)]
+
+    def _write_raffles(self, rows: list):
+        self.db.execute("DELETE FROM raffles")
+        self.db.executemany("INSERT INTO raffles (pos, id, data) VALUES (?, ?, ?)", rows)
+
+    def _read_messages(self) -> dict:
+        return {r["key"]: codec.loads(r["value"]) for r in self.db.execute("SELECT key, value FROM messages")}
+
+    def _rows_messages(self, m: dict, keys=None) -> list:
+        # Карта сообщений маленькая - пишется целиком
+        return [(k, codec.dumps(v, pretty=False).decode("utf-8")) for k, v in m.items()]
+
+    def _write_messages(self, rows: list):
+        self.db.execute("DELETE FROM messages")
+        self.db.executemany("INSERT INTO messages (key, value) VALUES (?, ?)", rows)
+
+class StoreWriter:
+    """Единственный писатель: мутации из обработчиков встают в одну очередь, одна задача
+    применяет их по порядку (пачкой всё, что накопилось), обработчик ждёт future с результатом.
+    Между await-ами обработчика никто не перезапишет чужое изменение"""
+
+    def __init__(self, store, capt_ids, batch_size: int = 100):
+        self.store = store
+        self.capt_ids = capt_ids
+        self.batch_size = batch_size
+        self.queue = None
+        self.task = None
+        self.applied = 0
+        self.batches = 0
+
+    def _start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _put(self, func):
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((func, future))
+        return await future
+
+    async def submit(self, op: str, capt_id=None, **args):
+        """Применить мутацию op. capt_id - id капта: индекс ищется в момент применения,
+        после всех мутаций, вставших в очередь раньше (капт удалён - LookupError)"""
+        def apply():
+            if capt_id is not None:
+                idx = self.capt_ids.position(capt_id)
+                if idx is None:
+                    raise LookupError("Капт не найден")
+                args["idx"] = idx
+            return self.store.commit(op, **args)
+        return await self._put(apply)
+
+    async def run(self, func, *args):
+        """Выполнить в очереди писателя изменение не из мутаций хранилища (восстановление из бекапа)"""
+        return await self._put(lambda: func(*args))
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            # Пачка применяется без await: запись на диск для неё одна (отложенная или групповая)
+            for func, future in batch:
+                try:
+                    result = func()
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                self.applied += 1
+            self.batches += 1
+
+    def summary(self) -> str:
+        return f"{self.applied} мутаций за {self.batches} пачек"
+
+# ==================== ИСХОДЯЩИЕ ЗАПРОСЫ ====================
+class OutboundQueue:
+    """Исходящие запросы к Discord с приоритетами. Ответы на взаимодействия отправляются сразу,
+    а пока хоть одно взаимодействие ждёт ответа (до ACK_TIMEOUT сек), фоновые запросы не начинаются.
+    Фоновые классы и ёмкость их очередей - limits, в порядке приоритета (например, сначала видимые
+    пользователям "visible": правки постов, отчёты, потом логи "log").
+    В один канал запросы идут не чаще channel_interval. Очереди ограничены: новый лог вытесняет
+    самый старый, остальное при переполнении отклоняется (asyncio.QueueFull)"""
+
+    ACK_TIMEOUT = 3.0
+    POLL = 0.05
+
+    def __init__(self, workers: int, channel_interval: float, limits: dict):
+        self.workers = workers
+        self.channel_interval = channel_interval
+        self.limits = limits
+        self.classes = tuple(limits)
+        self.queues = {cls: deque() for cls in self.classes}
+        self.next_at = {}  # id канала -> время (monotonic), раньше которого в него не слать
+        self.interactions = {}  # id взаимодействия -> (взаимодействие, время прихода)
+        self.wakeup = None
+        self.tasks = []
+        self.stats = {
+            cls: {"sent": 0, "failed": 0, "dropped": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for cls in self.classes
+        }
+
+    def start(self):
+        if not self.tasks:
+            self.wakeup = asyncio.Event()
+            self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def track(self, interaction: discord.Interaction):
+        """Пришло взаимодействие: фоновые запросы подождут, пока на него не ответят"""
+        self.interactions[interaction.id] = (interaction, time.monotonic())
+
+    def untrack(self, interaction: discord.Interaction):
+        """Обработчик завершился: даже без ответа взаимодействие больше не держит фоновые запросы"""
+        if self.interactions.pop(interaction.id, None) is not None and self.wakeup is not None:
+            self.wakeup.set()
+
+    def _interaction_pending(self) -> bool:
+        moment = time.monotonic()
+        for key, (interaction, since) in list(self.interactions.items()):
+            if interaction.response.is_done() or moment - since > self.ACK_TIMEOUT:
+                del self.interactions[key]
+        return bool(self.interactions)
+
+    def submit(self, cls: str, channel_id: int, send) -> asyncio.Future:
+        """Поставить запрос в очередь. send - функция без аргументов, возвращающая корутину.
+        Future получает результат запроса; None - если лог вытеснен более новым"""
+        self.start()
+        queue = self.queues[cls]
+        limit = self.limits.get(cls)
+        if limit is not None and len(queue) >= limit:
+            if cls != "log":
+                raise asyncio.QueueFull(f"outbound queue '{cls}' is full ({limit})")
+            _, _, dropped, _ = queue.popleft()
+            self.stats[cls]["dropped"] += 1
+            if not dropped.done():
+                dropped.set_result(None)
+        future = asyncio.get_running_loop().create_future()
+        queue.append((send, channel_id, future, time.monotonic()))
+        self.wakeup.set()
+        return future
+
+    def post(self, cls: str, channel_id: int, send) -> asyncio.Future:
+        """Поставить запрос без ожидания результата: ошибка только печатается"""
+        future = self.submit(cls, channel_id, send)
+        future.add_done_callback(self._report)
+        return future
+
+    @staticmethod
+    def _report(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"[ERROR] Outbound request failed: {future.exception()}")
+
+    def _next_job(self):
+        """Следующий запрос: по приоритету классов, внутри класса - по порядку, но только в канал,
+        для которого истёк интервал. Возвращает (класс, запрос) или (None, сколько ждать)"""
+        if self._interaction_pending():
+            return None, self.POLL
+        moment = time.monotonic()
+        soonest = None
+        for cls in self.classes:
+            queue = self.queues[cls]
+            for i, job in enumerate(queue):
+                ready = self.next_at.get(job[1], 0.0)
+                if ready <= moment:
+                    del queue[i]
+                    self.next_at[job[1]] = moment + self.channel_interval
+                    return cls, job
+                soonest = ready if soonest is None else min(soonest, ready)
+        return None, None if soonest is None else soonest - moment
+
+    async def _worker(self):
+        while True:
+            cls, job = self._next_job()
+            if cls is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), job)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            send, _, future, queued = job
+            if future.done():
+                continue
+            stats = self.stats[cls]
+            wait = time.monotonic() - queued
+            stats["wait_total"] += wait
+            stats["wait_max"] = max(stats["wait_max"], wait)
+            try:
+                result = await send()
+            except Exception as e:
+                stats["failed"] += 1
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            stats["sent"] += 1
+            if not future.done():
+                future.set_result(result)
+
+    def summary(self) -> str:
+        parts = []
+        for cls in self.classes:
+            st = self.stats[cls]
+            done = st["sent"] + st["failed"]
+            avg = st["wait_total"] / done if done else 0.0
+            parts.append(
+                f"{cls}: в очереди {len(self.queues[cls])}, отправлено {st['sent']}, ошибок {st['failed']}, "
+                f"вытеснено {st['dropped']}, ожидание сред. {avg * 1000:.0f} мс / макс. {st['wait_max'] * 1000:.0f} мс"
+            )
+        return "; ".join(parts)
+
+# ==================== ИНДЕКСЫ ====================
+class CaptDateIndex:
+    """Даты каптов, разобранные один раз в epoch-секунды: отсортированный список
+    меток + капты в том же порядке. Период - бинарный поиск по границе"""
+
+    def __init__(self):
+        self.ts = []
+        self.capts = []
+        self.by_id = {}
+
+    @staticmethod
+    def parse(capt: dict):
+        try:
+            return int(capt_ts(capt["date"]))
+        except:
+            return None
+
+    def rebuild(self, capts: list):
+        self.by_id = {}
+        for capt in capts:
+            ts = self.parse(capt)
+            if ts is not None:
+                self.by_id[id(capt)] = ts
+        pairs = sorted(
+            ((self.by_id[id(c)], i) for i, c in enumerate(capts) if id(c) in self.by_id),
+        )
+        self.ts = [ts for ts, _ in pairs]
+        self.capts = [capts[i] for _, i in pairs]
+
+    def add(self, capt: dict):
+        ts = self.parse(capt)
+        if ts is None:
+            return
+        i = bisect_right(self.ts, ts)
+        self.ts.insert(i, ts)
+        self.capts.insert(i, capt)
+        self.by_id[id(capt)] = ts
+
+    def remove(self, capt: dict):
+        ts = self.by_id.pop(id(capt), None)
+        if ts is None:
+            return
+        i = bisect_left(self.ts, ts)
+        while i < len(self.ts) and self.ts[i] == ts:
+            if self.capts[i] is capt:
+                del self.ts[i]
+                del self.capts[i]
+                return
+            i += 1
+
+    def since(self, cutoff: float) -> list:
+        """Капты не раньше cutoff (epoch), от старых к новым"""
+        return self.capts[bisect_left(self.ts, cutoff):]
+
+    def newest(self, cutoff: float, offset: int, limit: int) -> list:
+        """Страница каптов не раньше cutoff, от новых к старым: срез с конца без копии периода"""
+        first = bisect_left(self.ts, cutoff)
+        end = len(self.capts) - offset
+        if end <= first:
+            return []
+        return self.capts[max(first, end - limit):end][::-1]
+
+
+class CaptIdIndex:
+    """id капта -> запись. id выдаётся один раз при создании и не переиспользуется,
+    поэтому view и модалки ссылаются на капт по id, а не по месту в списке"""
+
+    def __init__(self, load):
+        self.load = load  # load() -> текущий список каптов
+        self.by_id = {}
+        self.positions = {}  # id -> индекс в списке каптов; None - пересобрать при следующем запросе
+        self.last = 0
+
+    def new_id(self) -> int:
+        # Метка времени в мс (но всегда больше прошлой): уникальна и после перезапуска
+        self.last = max(self.last + 1, int(time.time() * 1000))
+        return self.last
+
+    def rebuild(self, capts: list) -> bool:
+        """Пересобрать индекс; каптам без id (старые данные) выдать id. True - если выдавали"""
+        self.by_id = {}
+        self.last = max((c["id"] for c in capts if c.get("id")), default=self.last)
+        assigned = False
+        for capt in capts:
+            if not capt.get("id") or capt["id"] in self.by_id:
+                capt["id"] = self.new_id()
+                assigned = True
+            self.by_id[capt["id"]] = capt
+        self.positions = {capt["id"]: i for i, capt in enumerate(capts)}
+        return assigned
+
+    def add(self, capt: dict):
+        """Капт только что добавлен в конец списка"""
+        self.by_id[capt["id"]] = capt
+        self.last = max(self.last, capt["id"])
+        if self.positions is not None:
+            self.positions[capt["id"]] = len(self.load()) - 1
+
+    def remove(self, capt: dict):
+        self.by_id.pop(capt.get("id"), None)
+        # Места всех каптов после удалённого сдвинулись: пересоберём при следующем запросе
+        self.positions = None
+
+    def get(self, capt_id):
+        return self.by_id.get(capt_id)
+
+    def position(self, capt_id):
+        """Индекс капта в списке или None; после удаления капта карта мест пересобирается один раз"""
+        if capt_id not in self.by_id:
+            return None
+        if self.positions is None:
+            self.positions = {capt["id"]: i for i, capt in enumerate(self.load())}
+        return self.positions.get(capt_id)
+
+
+class CaptTally:
+    """Победы/поражения за всю историю, поддерживаемые мутациями (без подсчёта по списку)"""
+
+    def __init__(self):
+        self.total = 0
+        self.wins = 0
+
+    def add(self, capt: dict, sign: int = 1):
+        self.total += sign
+        if capt.get("win"):
+            self.wins += sign
+
+    def remove(self, capt: dict):
+        self.add(capt, -1)
+
+    def rebuild(self, capts: list):
+        self.total = len(capts)
+        self.wins = sum(1 for c in capts if c.get("win"))
+
+
+class Leaderboard:
+    """Рейтинг игроков, поддерживаемый на лету: отсортированный список (-очки, id) +
+    id -> ключ. Место игрока ищется бинарным поиском, топ-N - срез"""
+
+    def __init__(self, score, min_games: int = 0):
+        self.score = score
+        self.min_games = min_games
+        self.data = {}
+        self.keys = []
+        self.by_uid = {}
+
+    def rebuild(self, st: dict):
+        self.data = st
+        self.by_uid = {
+            uid: (-self.score(d), uid) for uid, d in st.items()
+            if d.get("games", 0) >= self.min_games
+        }
+        self.keys = sorted(self.by_uid.values())
+
+    def update(self, uid: str):
+        """Пересчитать позицию игрока после изменения его статистики"""
+        old = self.by_uid.pop(uid, None)
+        if old is not None:
+            del self.keys[bisect_left(self.keys, old)]
+        d = self.data.get(uid)
+        if d and d.get("games", 0) >= self.min_games:
+            key = (-self.score(d), uid)
+            insort(self.keys, key)
+            self.by_uid[uid] = key
+
+    def top(self, n: int) -> list:
+        return [(uid, self.data[uid]) for _, uid in self.keys[:n]]
+
+    def rank(self, uid: str):
+        key = self.by_uid.get(uid)
+        return None if key is None else bisect_left(self.keys, key) + 1
+
+    def __len__(self):
+        return len(self.keys)
+
+def build_leaderboards(st: dict) -> dict:
+    """Рейтинги по среднему урону (от 3 игр) и по киллам"""
+    boards = {
+        "avg": Leaderboard(lambda d: d["damage"] / d["games"], min_games=3),
+        "kills": Leaderboard(lambda d: d["kills"])
+    }
+    for board in boards.values():
+        board.rebuild(st)
+    return boards
+
+class CaptColumns:
+    """Колоночное представление строк капт-игрок (NumPy): номер игрока, номер капта,
+    дата (epoch), урон, киллы, победа. Агрегаты - масками, bincount и reduceat.
+    Строится один раз на пересборку агрегатов (см. RollingStats.rebuild)"""
+
+    NO_DATE = -(2 ** 62)  # капт без даты не попадает ни в один период
+
+    def __init__(self, capts: list):
+        self.dates = []  # метка времени капта (None - без даты), как CaptDateIndex.parse
+        uid_pos = {}
+        users, capt_idx, damage, kills = [], [], [], []
+        capt_ts_list, capt_win = [], []
+        for i, capt in enumerate(capts):
+            ts = CaptDateIndex.parse(capt)
+            self.dates.append(ts)
+            capt_ts_list.append(self.NO_DATE if ts is None else ts)
+            capt_win.append(bool(capt.get("win")))
+            for player in capt.get("players", []):
+                users.append(uid_pos.setdefault(str(player.get("user_id")), len(uid_pos)))
+                capt_idx.append(i)
+                damage.append(int(player.get("damage", 0)))
+                kills.append(int(player.get("kills", 0)))
+        self.uids = list(uid_pos)
+        self.user = np.array(users, dtype=np.int64)
+        self.capt = np.array(capt_idx, dtype=np.int64)
+        self.damage = np.array(damage, dtype=np.int64)
+        self.kills = np.array(kills, dtype=np.int64)
+        self.capt_ts = np.array(capt_ts_list, dtype=np.int64)
+        self.capt_win = np.array(capt_win, dtype=bool)
+        self.ts = self.capt_ts[self.capt]
+        self.win = self.capt_win[self.capt]
+
+    @classmethod
+    def build(cls, capts: list):
+        """Колонки по каптам или None, если NumPy не установлен (тогда агрегаты считаются в Python)"""
+        return None if np is None else cls(capts)
+
+    def stats(self, since: float = None) -> dict:
+        """То же, что calculate_stats по каптам не раньше since"""
+        if since is None:
+            user, damage, kills = self.user, self.damage, self.kills
+        else:
+            mask = self.ts >= since
+            user, damage, kills = self.user[mask], self.damage[mask], self.kills[mask]
+        if not len(user):
+            return {}
+        games = np.bincount(user, minlength=len(self.uids))
+        # Суммы урона/киллов по игроку: сортируем строки по игроку и складываем отрезки
+        order = np.argsort(user, kind="stable")
+        user = user[order]
+        starts = np.flatnonzero(np.r_[True, user[1:] != user[:-1]])
+        ids = user[starts]
+        damage = np.add.reduceat(damage[order], starts)
+        kills = np.add.reduceat(kills[order], starts)
+        return {
+            self.uids[u]: {"damage": d, "kills": k, "games": g}
+            for u, d, k, g in zip(ids.tolist(), damage.tolist(), kills.tolist(), games[ids].tolist())
+        }
+
+    def summary(self, since: float = None) -> tuple:
+        """(каптов, побед) не раньше since"""
+        win = self.capt_win if since is None else self.capt_win[self.capt_ts >= since]
+        return len(win), int(np.count_nonzero(win))
+
+class RollingStats:
+    """Статистика игроков за скользящее окно (неделя/месяц), поддерживаемая на лету:
+    мутации добавляют и снимают капты, выпавшие из окна снимаются лениво (таймер, чтение).
+    days=None - вся история: без окна, капты не истекают"""
+
+    def __init__(self, days: int):
+        self.days = days
+        self.stats = {}
+        self.boards = build_leaderboards(self.stats)
+        self.members = {}  # id(капт) -> метка времени
+        self.wins = 0      # побед среди members
+        self.heap = []     # (метка, порядковый номер, капт) для истечения
+        self.counter = itertools.count()
+
+    def cutoff(self) -> float:
+        return None if self.days is None else time.time() - self.days * 86400
+
+    def _apply(self, capt: dict, sign: int, touch: bool = True):
+        for player in capt.get("players", []):
+            uid = str(player.get("user_id"))
+            d = self.stats.setdefault(uid, {"damage": 0, "kills": 0, "games": 0})
+            d["damage"] += sign * int(player.get("damage", 0))
+            d["kills"] += sign * int(player.get("kills", 0))
+            d["games"] += sign
+            if d["games"] <= 0:
+                del self.stats[uid]
+            if touch:
+                for board in self.boards.values():
+                    board.update(uid)
+
+    def add(self, capt: dict, touch: bool = True):
+        if id(capt) in self.members:
+            return
+        ts = CaptDateIndex.parse(capt)
+        if self.days is not None:
+            if ts is None or ts < self.cutoff():
+                return
+            heapq.heappush(self.heap, (ts, next(self.counter), capt))
+        self.members[id(capt)] = ts
+        if capt.get("win"):
+            self.wins += 1
+        self._apply(capt, 1, touch)
+
+    def remove(self, capt: dict):
+        if id(capt) in self.members:
+            del self.members[id(capt)]
+            if capt.get("win"):
+                self.wins -= 1
+            self._apply(capt, -1)
+
+    def expire(self):
+        if self.days is None:
+            return
+        cutoff = self.cutoff()
+        while self.heap and self.heap[0][0] < cutoff:
+            ts, _, capt = heapq.heappop(self.heap)
+            # Запись могла устареть (капт удалён или дата изменена)
+            if self.members.get(id(capt)) == ts:
+                self.remove(capt)
+
+    def rebuild(self, capts: list, columns: CaptColumns = None):
+        """Пересобрать окно по всей истории. columns - CaptColumns по тем же каптам: суммы
+        по игрокам и победы считаются колонками, даты уже разобраны; без них - по каптам в Python"""
+        self.stats.clear()
+        self.members.clear()
+        self.wins = 0
+        self.heap = []
+        if columns is None:
+            for capt in capts:
+                self.add(capt, touch=False)
+        else:
+            cutoff = self.cutoff()
+            for capt, ts in zip(capts, columns.dates):
+                if self.days is not None:
+                    if ts is None or ts < cutoff:
+                        continue
+                    heapq.heappush(self.heap, (ts, next(self.counter), capt))
+                self.members[id(capt)] = ts
+            self.stats.update(columns.stats(cutoff))
+            self.wins = columns.summary(cutoff)[1]
+        for board in self.boards.values():
+            board.rebuild(self.stats)
+
+
+# ==================== УЧАСТНИКИ ====================
+async def resolve_members(guild: discord.Guild, user_ids: list, concurrency: int) -> tuple:
+    """Получить участников по ID: без дублей, сначала из кэша гейтвея, остальных - параллельно
+    через API (не больше concurrency запросов сразу). Возвращает (участники, счётчики)"""
+    ids = list(dict.fromkeys(user_ids))
+    members = {}
+    missing = []
+    for uid in ids:
+        member = guild.get_member(uid)
+        if member:
+            members[uid] = member
+        else:
+            missing.append(uid)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(uid: int):
+        async with semaphore:
+            return await guild.fetch_member(uid)
+
+    results = await asyncio.gather(*(fetch(uid) for uid in missing), return_exceptions=True)
+    for uid, member in zip(missing, results):
+        if not isinstance(member, BaseException):
+            members[uid] = member
+    return members, {"cache": len(ids) - len(missing), "api": len(missing)}
+
+class MemberNameCache:
+    """Кэш отображаемых имён участников с TTL: кэш гейтвея и события участников,
+    запрос к API - только при промахе (неудачные запросы тоже кэшируются)"""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.names = {}  # user_id -> (имя или None, истекает)
+
+    def put(self, member: discord.Member):
+        self.names[member.id] = (member.display_name, time.monotonic() + self.ttl)
+
+    def forget(self, user_id: int):
+        self.names.pop(int(user_id), None)
+
+    def evict_expired(self):
+        now_ts = time.monotonic()
+        for uid in [uid for uid, (_, expires) in self.names.items() if expires <= now_ts]:
+            del self.names[uid]
+
+    async def resolve(self, guild: discord.Guild, user_id):
+        """Имя участника или None, если его нет на сервере"""
+        user_id = int(user_id)
+        entry = self.names.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+        member = guild.get_member(user_id)
+        if member is None:
+            try:
+                member = await guild.fetch_member(user_id)
+            except:
+                self.names[user_id] = (None, time.monotonic() + self.ttl)
+                return None
+        self.put(member)
+        return member.display_name
+
+
+# ==================== ФОНОВЫЕ ЗАДАЧИ ====================
+class RefreshScheduler:
+    """Обновление публичных постов по запросу: запросы за окно debounce склеиваются,
+    для каждого поста одновременно идёт не больше одного обновления.
+    on_error(имя, ошибка) - корутина для ошибок фонового обновления (по умолчанию - печать)"""
+
+    def __init__(self, jobs: dict, delay: float, on_error=None):
+        self.jobs = jobs
+        self.delay = delay
+        self.on_error = on_error
+        self.dirty = set()
+        self.running = set()
+        self.handle = None
+        self.locks = {name: asyncio.Lock() for name in jobs}
+        self.requested = dict.fromkeys(jobs, 0)
+        self.executed = dict.fromkeys(jobs, 0)
+
+    def request(self, *names):
+        """Пометить посты устаревшими (без аргументов - все)"""
+        for name in names or tuple(self.jobs):
+            self.requested[name] += 1
+            self.dirty.add(name)
+        self._schedule()
+
+    def _schedule(self):
+        if self.handle is not None or not self.dirty:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.handle = loop.call_later(self.delay, self._fire)
+
+    def _fire(self):
+        self.handle = None
+        for name in list(self.dirty - self.running):
+            self.dirty.discard(name)
+            self.running.add(name)
+            asyncio.create_task(self._run(name))
+
+    async def _run(self, name: str):
+        try:
+            async with self.locks[name]:
+                await self.jobs[name]()
+            self.executed[name] += 1
+        except Exception as e:
+            if self.on_error is None:
+                print(f"[ERROR] Refresh {name}: {e}")
+            else:
+                await self.on_error(name, e)
+        finally:
+            self.running.discard(name)
+            # Запросы, пришедшие во время обновления, выполнятся следующим заходом
+            self._schedule()
+
+    async def run_now(self, *names):
+        """Обновить сразу и дождаться результата (ручное обновление, запуск)"""
+        for name in names or tuple(self.jobs):
+            self.requested[name] += 1
+            self.dirty.discard(name)
+            async with self.locks[name]:
+                await self.jobs[name]()
+            self.executed[name] += 1
+
+    def summary(self) -> str:
+        return ", ".join(f"{n} {self.executed[n]}/{self.requested[n]}" for n in self.jobs)
+
+class LoopLagMonitor:
+    """Задержка event loop: на сколько позже срабатывает периодический таймер.
+    Блокирующая работа в loop (чтение/запись файлов, JSON) сразу видна здесь"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.expected = None
+        self.last = 0.0
+        self.max = 0.0
+        self.total = 0.0
+        self.samples = 0
+
+    def tick(self):
+        moment = time.perf_counter()
+        if self.expected is not None:
+            self.last = max(0.0, moment - self.expected)
+            self.max = max(self.max, self.last)
+            self.total += self.last
+            self.samples += 1
+        self.expected = moment + self.interval
+
+    def summary(self) -> str:
+        avg = self.total / self.samples if self.samples else 0.0
+        return f"{self.last * 1000:.1f} мс (сред. {avg * 1000:.1f}, макс. {self.max * 1000:.1f})"